@@ -0,0 +1,160 @@
+"""
+Circuit breakers for the systems Draugnet depends on (MISP and the RTIR, Flowintel and Ollama modules).
+
+After failure_threshold consecutive failures a system's breaker opens and calls to it fail straight away
+instead of each submission waiting out the full timeout. Once reset_timeout seconds have passed a single
+probe call is let through (half-open): if it succeeds the breaker closes again, otherwise it stays open for
+another reset_timeout. Module work skipped while a breaker is open is queued in Redis and replayed once the
+system is back. Breakers are kept per worker process.
+"""
+from __future__ import annotations
+import json
+import logging
+import threading
+import time
+from typing import Any, Dict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config.settings import draugnet_config
+
+logger = logging.getLogger('uvicorn.error')
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+REPLAY_KEY = "replay:queue:{name}"
+REPLAY_MAX_LENGTH = 10000
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name: str) -> None:
+        super().__init__(f"{name} is unavailable (circuit open)")
+        self.name = name
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30) -> None:
+        self.name = name
+        self.failure_threshold = max(failure_threshold, 1)
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started = 0.0
+        self.total_failures = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def is_open(self) -> bool:
+        # Like allow(), but without claiming the half-open probe
+        with self._lock:
+            return self.state == OPEN and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def allow(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and now - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self.probe_started = 0.0
+            # Only one probe at a time, but don't wait forever for a probe that never reported back
+            if self.state == HALF_OPEN and (not self.probe_started or now - self.probe_started >= self.reset_timeout):
+                self.probe_started = now
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != CLOSED:
+                logger.info("%s is reachable again, closing its circuit", self.name)
+            self.state = CLOSED
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self.total_failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                if self.state == CLOSED:
+                    logger.warning("%s failed %d times in a row, opening its circuit for %ss", self.name, self.failures, self.reset_timeout)
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def describe(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "total_failures": self.total_failures,
+                "rejected": self.rejected,
+                "open_for": round(time.monotonic() - self.opened_at, 1) if self.state != CLOSED else 0,
+            }
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    breaker = _breakers.get(name)
+    if breaker is not None:
+        return breaker
+    with _breakers_lock:
+        if name not in _breakers:
+            cfg = dict(draugnet_config.get("circuit_breakers") or {})
+            overrides = cfg.get(name) if isinstance(cfg.get(name), dict) else {}
+            _breakers[name] = CircuitBreaker(
+                name,
+                failure_threshold=int(overrides.get("failure_threshold", cfg.get("failure_threshold", 5))),
+                reset_timeout=float(overrides.get("reset_timeout", cfg.get("reset_timeout", 30)))
+            )
+        return _breakers[name]
+
+
+def breaker_states() -> Dict[str, Dict[str, Any]]:
+    return {name: breaker.describe() for name, breaker in list(_breakers.items())}
+
+
+class BreakerAdapter(HTTPAdapter):
+    """requests adapter failing fast while the breaker is open, and counting connection errors and 5xx."""
+
+    def __init__(self, breaker: CircuitBreaker, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.breaker = breaker
+
+    def send(self, request: requests.PreparedRequest, **kwargs: Any) -> requests.Response:
+        if not self.breaker.allow():
+            raise CircuitOpenError(self.breaker.name)
+        try:
+            response = super().send(request, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            self.breaker.record_failure()
+            raise
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+
+def queue_replay(redis: Any, name: str, item: Dict[str, Any]) -> None:
+    """Keep work that couldn't be done while name was unavailable, to be replayed later."""
+    key = REPLAY_KEY.format(name=name)
+    pipe = redis.pipeline(transaction=True)
+    pipe.rpush(key, json.dumps(item))
+    # Drop the oldest entries rather than growing without bound during a long outage
+    pipe.ltrim(key, -REPLAY_MAX_LENGTH, -1)
+    pipe.expire(key, int(draugnet_config.get("replay_ttl", 86400)))
+    pipe.execute()
+
+
+def replay_queue_lengths(redis: Any) -> Dict[str, int]:
+    prefix = REPLAY_KEY.format(name="")
+    return {
+        key.decode("utf-8")[len(prefix):]: redis.llen(key)
+        for key in redis.scan_iter(match=prefix + "*", count=100)
+    }
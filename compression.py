@@ -0,0 +1,206 @@
+"""
+HTTP compression for Draugnet.
+
+CompressionMiddleware negotiates zstd or gzip compression of responses (including the streamed /retrieve
+exports) and DecompressionMiddleware accepts gzip or zstd compressed request bodies. Decompression is bounded
+by a maximum decompressed size so that a small compressed upload can't be used as a zip bomb.
+zstd support requires the optional zstandard package, gzip is always available.
+"""
+from __future__ import annotations
+import io
+import zlib
+from typing import Dict, List, Optional
+
+import anyio.to_thread
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.middleware.gzip import GZipResponder, IdentityResponder
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Bodies and response chunks larger than this are (de)compressed in a worker thread to keep the event loop responsive
+THREAD_MINIMUM_SIZE = 256 * 1024
+READ_SIZE = 64 * 1024
+
+
+class DecompressedTooLarge(Exception):
+    pass
+
+
+def supported_encodings() -> List[str]:
+    encodings = ["gzip"]
+    if zstandard is not None:
+        encodings.insert(0, "zstd")
+    return encodings
+
+
+def parse_accept_encoding(header: str) -> Dict[str, float]:
+    """Map each coding in an Accept-Encoding header to its q-value."""
+    qualities: Dict[str, float] = {}
+    for item in header.lower().split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = min(max(float(value), 0.0), 1.0)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    return qualities
+
+
+def negotiate_encoding(header: str) -> Optional[str]:
+    """The supported encoding the client rates highest (zstd on a tie), None for no compression."""
+    qualities = parse_accept_encoding(header)
+    best, best_quality = None, 0.0
+    for encoding in supported_encodings():
+        quality = qualities.get(encoding, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+class ZstdResponder(IdentityResponder):
+    content_encoding = "zstd"
+
+    def __init__(self, app: ASGIApp, minimum_size: int, level: int = 3) -> None:
+        super().__init__(app, minimum_size)
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    async def apply_compression(self, body: bytes, *, more_body: bool) -> bytes:
+        if len(body) >= THREAD_MINIMUM_SIZE:
+            # Chunks run through the compressor one at a time, so it is never used by two threads at once
+            return await anyio.to_thread.run_sync(self.compress, body, more_body)
+        return self.compress(body, more_body)
+
+    def compress(self, body: bytes, more_body: bool) -> bytes:
+        compressed = self.compressor.compress(body)
+        if more_body:
+            # Flush a complete block so that streamed chunks reach the client without delay
+            return compressed + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return compressed + self.compressor.flush()
+
+
+class CompressionMiddleware:
+    """Compress responses of at least minimum_size bytes with zstd or gzip, whichever the client prefers."""
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024, gzip_level: int = 6, zstd_level: int = 3) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.zstd_level = zstd_level
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate_encoding(Headers(scope=scope).get("Accept-Encoding", ""))
+        responder: ASGIApp
+        if encoding == "zstd":
+            responder = ZstdResponder(self.app, self.minimum_size, level=self.zstd_level)
+        elif encoding == "gzip":
+            responder = GZipResponder(self.app, self.minimum_size, compresslevel=self.gzip_level)
+        else:
+            responder = IdentityResponder(self.app, self.minimum_size)
+        await responder(scope, receive, send)
+
+
+def decompress_body(encoding: str, data: bytes, max_size: int) -> bytes:
+    """Decompress a request body, never producing more than max_size bytes."""
+    output = bytearray()
+    if encoding == "gzip":
+        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while data:
+            output += decoder.decompress(data, max_size - len(output) + 1)
+            if len(output) > max_size:
+                raise DecompressedTooLarge()
+            data = decoder.unconsumed_tail
+    elif encoding == "zstd":
+        reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data), read_across_frames=True)
+        while True:
+            chunk = reader.read(READ_SIZE)
+            if not chunk:
+                break
+            output += chunk
+            if len(output) > max_size:
+                raise DecompressedTooLarge()
+    else:
+        raise ValueError(f"Unsupported content encoding: {encoding}")
+    return bytes(output)
+
+
+class DecompressionMiddleware:
+    """Accept gzip or zstd encoded request bodies, bounded by max_size bytes both before and after decoding."""
+
+    def __init__(self, app: ASGIApp, max_size: int) -> None:
+        self.app = app
+        self.max_size = max_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        encoding = headers.get("Content-Encoding", "").strip().lower()
+        if not encoding or encoding == "identity":
+            await self.app(scope, receive, send)
+            return
+        if encoding not in supported_encodings():
+            response = JSONResponse({"detail": f"Unsupported Content-Encoding: {encoding}."}, status_code=415)
+            await response(scope, receive, send)
+            return
+
+        # The handlers read the whole body anyway, so collect it here (bounded) and decode it in one go
+        compressed = bytearray()
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            compressed += message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if len(compressed) > self.max_size:
+                response = JSONResponse({"detail": "Request body too large."}, status_code=413)
+                await response(scope, receive, send)
+                return
+
+        try:
+            if len(compressed) >= THREAD_MINIMUM_SIZE:
+                body = await anyio.to_thread.run_sync(decompress_body, encoding, bytes(compressed), self.max_size)
+            else:
+                body = decompress_body(encoding, bytes(compressed), self.max_size)
+        except DecompressedTooLarge:
+            response = JSONResponse({"detail": "Decompressed request body too large."}, status_code=413)
+            await response(scope, receive, send)
+            return
+        except Exception:
+            response = JSONResponse({"detail": f"Invalid {encoding} request body."}, status_code=400)
+            await response(scope, receive, send)
+            return
+
+        # Hand the decoded body on as if it had been sent uncompressed
+        request_headers = MutableHeaders(scope=scope)
+        del request_headers["content-encoding"]
+        request_headers["content-length"] = str(len(body))
+
+        body_sent = False
+
+        async def receive_decompressed() -> Message:
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        await self.app(scope, receive_decompressed, send)
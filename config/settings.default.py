@@ -11,12 +11,22 @@ modules_config = {
             # 'url': '', # RTIR URL, e.g. https://my.rtir.instance  - don't add the REST/2.0 part
             # 'auth_key': '', # authey from RTIR
             # 'verifycert': True, # Set to False if using self-signed certificates or HTTP (but please don't use HTTP in production)
-            # 'queue': 'Draugnet Reports' # Make sure that the queue exists and is writable by the user associated with the auth_key
+            # 'queue': 'Draugnet Reports', # Make sure that the queue exists and is writable by the user associated with the auth_key
+            # 'rate_limit': 5, # Requests per second sent to RTIR (0 = no limit)
+            # 'rate_burst': 5, # Requests that may be sent at once before the rate limit applies
+            # 'max_parallel_requests': 8, # Requests to RTIR in flight at the same time
+            # 'max_report_chars': 20000, # Longer reports are cut off in the ticket, with a link to the event in MISP (0 = no limit)
+            # 'max_reports_chars': 100000 # Further reports are only counted once the ticket holds this many characters of reports (0 = no limit)
         },
         'flowintel': {
             # 'url': '',
             # 'auth_key': '',
-            # 'verifycert': True
+            # 'verifycert': True,
+            # 'rate_limit': 5, # See rtir above
+            # 'rate_burst': 5,
+            # 'max_parallel_requests': 8,
+            # 'max_report_chars': 20000,
+            # 'max_reports_chars': 100000
         }
     },
     "enhancements": {
@@ -26,7 +36,23 @@ modules_config = {
             # "model": "model_name",
             # "timeout": 120,
             # "temperature": 0.2,
-            # "max_tokens": 800,
+            # "max_tokens": 800, # Upper bound on generated tokens, passed to Ollama as num_predict
+            # "stream": True, # Stream the completion, dropping <think> blocks on the fly and stopping at the budgets below
+            # "max_chars": 4000, # Stop once the summary is this long (0 = no limit)
+            # "time_budget": 60, # Stop generating after this many seconds and keep what we have (0 = no limit)
+            # "think": False, # Disable reasoning for thinking models (requires Ollama 0.9+)
+            # "prompt_token_budget": 3000, # Approximate size of the input handed to the model, larger events are summarised by type counts
+            # "chunk_token_size": 2000, # Longer freetext is split into chunks of this size, summarised separately and then combined
+            # "map_concurrency": 4, # Number of chunks summarised in parallel
+            # "map_max_tokens": 300, # Upper bound on each chunk summary
+            # "batch_prompt": "...", # Prompt for batched enhancement (see enhancement_batch_window), must ask for {"summaries": [{"id", "summary"}]} JSON
+            # "backends": [ # Spread requests over several Ollama servers, url/model above are used as defaults
+            #     {"url": "http://ollama1:11434", "model": "qwen3:30b", "fallback_model": "qwen3:4b", "max_concurrent": 2},
+            #     {"url": "http://ollama2:11434", "model": "qwen3:8b", "max_concurrent": 1, "weight": 0.5},
+            # ],
+            # "fallback_at": 1, # Use a backend's fallback_model for requests arriving while this many are in flight on it
+            # "health_check_interval": 30, # Seconds between the background health checks of the backends
+            # "max_queue_wait": 30, # Skip the enhancement if no backend frees up within this many seconds
             #"language": "en", # default output language
             #"style": "concise_risk_intel", # see PROMPT_STYLES below
             # "title_template": "Summary for: ${submission_title}",
@@ -39,7 +65,8 @@ modules_config = {
 redis_config = {
     'host': 'localhost',
     'port': 6379,
-    'db': 5
+    'db': 5,
+    # 'max_connections': 50 # Maximum size of the per-worker connection pool
 }
 
 # List all allowed frontend origins here
@@ -58,5 +85,82 @@ draugnet_config = {
    ],
    "ssl_cert_path": "",
    "ssl_key_path": "",
-   "name": "Draugnet" # Name of the instance, used in various places to identify the source when multiple instances are used
+   "name": "Draugnet", # Name of the instance, used in various places to identify the source when multiple instances are used
+   # Server settings used by the production launcher (python main.py)
+   "host": "0.0.0.0",
+   "port": 8999,
+   "workers": 1, # Number of worker processes, set to 0 to use one worker per CPU core
+   "loop": "auto", # "auto", "uvloop" or "asyncio" - auto picks uvloop when installed
+   "http": "auto", # "auto", "httptools" or "h11" - auto picks httptools when installed
+   "timeout_keep_alive": 5, # Seconds to keep idle client connections open
+   "backlog": 2048, # Maximum number of pending connections
+   "limit_concurrency": None, # Maximum number of concurrent connections per worker before returning 503s (None = unlimited)
+   "timeout_graceful_shutdown": 30, # Seconds to wait for in-flight requests on shutdown
+   "proxy_headers": True, # Trust X-Forwarded-* headers when running behind a reverse proxy
+   # Per-worker HTTP pool used for direct MISP calls
+   "misp_timeout": 60,
+   "http_max_connections": 100,
+   "http_max_keepalive": 20,
+   # Sharing groups are cached in-process: served fresh for sharing_groups_ttl seconds, then served stale
+   # for up to sharing_groups_stale_ttl seconds while being refreshed in the background
+   "sharing_groups_ttl": 300,
+   "sharing_groups_stale_ttl": 3600,
+   # Freetext indicator extraction for /share/raw: "misp" runs MISP's extractAllFromReport server side,
+   # "local" extracts IPs, domains, URLs, hashes, emails and CVEs in Draugnet and sends them with the report
+   "freetext_extractor": "misp",
+   # STIX conversion for /share/stix: "misp" uploads the bundle to MISP's STIX importer, "local" converts it
+   # in Draugnet with misp-stix (pip install misp-stix) and falls back to MISP's importer if that fails
+   "stix_converter": "misp",
+   # Process pool for CPU-heavy work (freetext extraction, parsing of large STIX, CSV and MISP submissions),
+   # inputs smaller than process_pool_threshold bytes are handled inline on the event loop
+   "process_pool_workers": 2, # Set to 0 to disable the pool
+   "process_pool_threshold": 262144,
+   # Maximum request body size in bytes, compressed uploads (Content-Encoding: gzip or zstd) are also limited to this once decompressed
+   "max_request_body": 52428800,
+   # Responses of at least compression_min_size bytes are compressed with zstd (if the zstandard package is installed) or gzip
+   "compression_min_size": 1024,
+   "gzip_level": 6,
+   "zstd_level": 3,
+   # Token retention: tokens and everything keyed on them expire token_ttl seconds after their last update
+   # (None keeps them forever). The sweeper removes module mappings and timestamps left behind by expired tokens.
+   "token_ttl": None, # e.g. 7776000 for 90 days
+   "token_sweep_interval": 3600, # Seconds between sweeps, 0 disables the sweeper
+   "token_report_ttl": 300, # Seconds to cache the token keyspace memory report served on /metrics
+   # Every health_check_interval seconds each worker probes MISP, Redis, the enabled modules and the queue depths,
+   # /readyz serves the last result. A queue depth above readiness_max_queue_depth makes workers unready (0 = ignore)
+   "health_check_interval": 10,
+   "readiness_max_queue_depth": 0,
+   # Shared secret MISP sends in the Authorization header when calling /webhooks/misp to flag an event's tokens as updated
+   # (leave empty to disable the webhook)
+   "webhook_secret": "",
+   # MISP's ZeroMQ feed (e.g. "tcp://misp.local:50000"), when set one worker listens for event, attribute and object
+   # updates made in MISP and flags the affected tokens as updated (requires pip install pyzmq)
+   "misp_zmq_url": "",
+   "misp_zmq_topics": ["misp_json_event", "misp_json_attribute", "misp_json_object"],
+   # Responses to /share requests sent with an Idempotency-Key header are kept for idempotency_ttl seconds and replayed
+   # to retries with the same key and body. A request still running after idempotency_pending_ttl seconds is assumed lost.
+   "idempotency_ttl": 86400,
+   "idempotency_pending_ttl": 300,
+   # Updates to the same token (?token=) arriving within update_batch_window seconds of each other are merged into
+   # a single MISP update and a single reporting module update (0 still serialises them, but without waiting)
+   "update_batch_window": 0.2,
+   "update_lock_ttl": 120, # Seconds a batch of updates may take before another request takes over
+   # Opt-in: queue submissions for enhancement and summarise up to enhancement_batch_size of them per LLM call
+   # every enhancement_batch_window seconds. The summaries are added to the tickets as an update (0 = enhance inline)
+   "enhancement_batch_window": 0,
+   "enhancement_batch_size": 8,
+   "enhancement_batch_lock_ttl": 600, # Seconds a batch may take before another worker starts draining the queue
+   # Collect ticket creates and updates for this many seconds and send them together, merging updates of the same
+   # submission into a single comment (0 = send each one straight away)
+   "reporting_batch_window": 0,
+   # After failure_threshold failures in a row MISP or a module is considered down for reset_timeout seconds and
+   # calls to it fail straight away. Per system overrides go under its name, e.g. "ollama": {"reset_timeout": 120}
+   "circuit_breakers": {
+       "failure_threshold": 5,
+       "reset_timeout": 30
+   },
+   # Module calls skipped or failed during an outage are queued and retried every replay_interval seconds (0 = never)
+   "replay_interval": 30,
+   "replay_ttl": 86400, # Seconds queued calls are kept for
+   "replay_max_attempts": 5
 }
@@ -0,0 +1,141 @@
+"""
+Batched enhancement of submissions.
+
+With enhancement_batch_window set, modules_enhance doesn't call the enhancement modules while the submission
+waits. The request is queued in Redis instead and one worker at a time collects whatever was queued during the
+window, hands up to enhancement_batch_size submissions to each module at once (run_batch, a single LLM call
+for Ollama) and sends each resulting text to the reporting modules as an update of that submission's ticket.
+Modules without run_batch are called once per submission.
+"""
+from __future__ import annotations
+import asyncio
+import json
+import logging
+import os
+import secrets
+from typing import Any, Dict, List, Optional, Tuple
+
+from breaker import get_breaker, queue_replay
+from config.settings import draugnet_config
+from modules.base import EventSummary
+from utils import call_module, enabled_enhancement_modules, get_redis, modules_update, release_lock
+
+logger = logging.getLogger('uvicorn.error')
+
+PENDING_KEY = "enhancements:pending"
+LOCK_KEY = "enhancements:lock"
+
+
+def batching_enabled() -> bool:
+    return bool(draugnet_config.get("enhancement_batch_window", 0))
+
+
+def enhancement_item(action_type: str, context: str, data: Any, token: str) -> Dict[str, Any]:
+    # JSON form of a pending enhancement, see item_data() for the way back
+    item = {"id": secrets.token_hex(8), "token": token, "action_type": action_type, "context": context}
+    if isinstance(data, EventSummary):
+        item["summary"] = data.to_dict()
+    else:
+        item["text"] = data if isinstance(data, str) else str(data)
+    return item
+
+
+def queue_enhancement(action_type: str, context: str, data: Any, token: str) -> None:
+    item = enhancement_item(action_type, context, data, token)
+    redis = get_redis()
+    pipe = redis.pipeline(transaction=True)
+    pipe.rpush(PENDING_KEY, json.dumps(item))
+    # Don't let a queue nobody drains grow forever
+    pipe.expire(PENDING_KEY, 86400)
+    pipe.execute()
+
+
+def item_data(item: Dict[str, Any]) -> Any:
+    if "summary" in item:
+        return EventSummary.from_dict(item["summary"])
+    return item.get("text", "")
+
+
+def take_batch(size: int) -> List[Dict[str, Any]]:
+    redis = get_redis()
+    pipe = redis.pipeline(transaction=True)
+    pipe.lrange(PENDING_KEY, 0, size - 1)
+    pipe.ltrim(PENDING_KEY, size, -1)
+    items, _ = pipe.execute()
+    return [json.loads(item) for item in items]
+
+
+async def enhance_batch(items: List[Dict[str, Any]]) -> List[Optional[str]]:
+    """Run the enhancement modules over a batch, returning the enhanced text of each item (None if none)."""
+    batch: List[Tuple[str, str, Any]] = [(item["action_type"], item["context"], item_data(item)) for item in items]
+    results: List[Optional[str]] = [None] * len(items)
+    replayed = False
+    for mod_name, mod in enabled_enhancement_modules():
+        breaker = get_breaker(mod_name)
+        if not breaker.allow():
+            logger.warning("Enhancement module %s is unavailable, queueing a batch of %d for later", mod_name, len(batch))
+            _queue_replays(mod_name, items)
+            replayed = True
+            continue
+        try:
+            # Through the module's concurrency limit and timeout, like the inline enhancements
+            if hasattr(mod, "run_batch"):
+                outputs = await call_module(mod, "run_batch", batch)
+            else:
+                outputs = [await call_module(mod, "run", action_type, context, data) for action_type, context, data in batch]
+            breaker.record_success()
+        except Exception:
+            breaker.record_failure()
+            logger.exception("Enhancement module %s failed on a batch of %d", mod_name, len(batch))
+            _queue_replays(mod_name, items)
+            replayed = True
+            continue
+        # Like modules_enhance, each module works on the output of the previous one
+        batch = [(action_type, context, output) for (action_type, context, _), output in zip(batch, outputs)]
+        for i, output in enumerate(outputs):
+            if isinstance(output, str) and output:
+                results[i] = output
+    if replayed:
+        # The replay sends the text once the module is back, don't post a partial one now
+        return [None] * len(items)
+    return results
+
+
+def _queue_replays(mod_name: str, items: List[Dict[str, Any]]) -> None:
+    redis = get_redis()
+    for item in items:
+        queue_replay(redis, mod_name, dict(item, kind="enhance"))
+
+
+async def _process_batch(items: List[Dict[str, Any]]) -> None:
+    texts = await enhance_batch(items)
+    for item, text in zip(items, texts):
+        if not text:
+            continue
+        data = item_data(item)
+        summary = data if isinstance(data, EventSummary) else EventSummary(info=f"Draugnet {item['context']} submission")
+        modules_update(item["context"], "modify", summary, item["token"], [], text)
+    logger.info("Enhanced a batch of %d submission(s)", len(items))
+
+
+async def run_enhancement_batcher() -> None:
+    window = float(draugnet_config.get("enhancement_batch_window", 0))
+    size = max(int(draugnet_config.get("enhancement_batch_size", 8)), 1)
+    lock_ttl = int(draugnet_config.get("enhancement_batch_lock_ttl", 600))
+    lock_id = f"{os.getpid()}:{secrets.token_hex(4)}"
+    while True:
+        await asyncio.sleep(window)
+        try:
+            redis = get_redis()
+            # One worker drains the queue at a time, a single inference box gains nothing from parallel batches
+            if not redis.set(LOCK_KEY, lock_id, nx=True, ex=lock_ttl):
+                continue
+            try:
+                while items := await asyncio.to_thread(take_batch, size):
+                    await _process_batch(items)
+            finally:
+                release_lock(redis, LOCK_KEY, lock_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Enhancement batch failed: %s", e)
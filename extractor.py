@@ -0,0 +1,153 @@
+"""
+Local freetext indicator extraction.
+
+An in-process alternative to MISP's server side extractAllFromReport. All patterns are compiled once at
+import time and the module has no dependency on the rest of Draugnet, so extract_indicators can be shipped
+to a process pool for large texts.
+"""
+from __future__ import annotations
+import ipaddress
+import os
+import re
+from typing import Any, Dict, FrozenSet, List, Tuple
+
+# Defanged notations seen in the wild, mapped back to their original form
+REFANG_PATTERNS: List[Tuple[re.Pattern, str]] = [
+    (re.compile(r"\bh(?:xx|XX|\*\*)p(s?)(?=\[?:)", re.IGNORECASE), r"http\1"),
+    (re.compile(r"\bfxp(?=\[?:)", re.IGNORECASE), "ftp"),
+    (re.compile(r"\[:\]//|\[://\]"), "://"),
+    (re.compile(r"\[:\]"), ":"),
+    (re.compile(r"\[\.\]|\(\.\)|\{\.\}|\[dot\]|\(dot\)|\{dot\}", re.IGNORECASE), "."),
+    (re.compile(r"\[@\]|\(@\)|\{@\}|\[at\]|\(at\)|\{at\}", re.IGNORECASE), "@"),
+]
+
+URL_RE = re.compile(r"\b(?:https?|ftp)://[^\s<>\"'`]+", re.IGNORECASE)
+EMAIL_RE = re.compile(r"\b[A-Za-z0-9._%+\-]+@(?:[A-Za-z0-9](?:[A-Za-z0-9\-]{0,61}[A-Za-z0-9])?\.)+[A-Za-z]{2,24}\b")
+IPV4_RE = re.compile(r"(?<![\w.])(?:(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)\.){3}(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(?![\w]|\.\d)")
+# At least one hex group, "::" and other runs of colons are not worth reporting
+IPV6_RE = re.compile(r"(?<![\w:])(?=[0-9A-Fa-f:]*[0-9A-Fa-f])(?:[0-9A-Fa-f]{0,4}:){2,7}[0-9A-Fa-f]{0,4}(?![\w:])")
+DOMAIN_RE = re.compile(r"(?<![\w\-.@])(?:[A-Za-z0-9](?:[A-Za-z0-9\-]{0,61}[A-Za-z0-9])?\.)+[A-Za-z]{2,24}(?![\w\-@]|\.\w)")
+HASH_RE = re.compile(r"(?<![\w])(?:[A-Fa-f0-9]{128}|[A-Fa-f0-9]{64}|[A-Fa-f0-9]{40}|[A-Fa-f0-9]{32})(?![\w])")
+CVE_RE = re.compile(r"\bCVE-\d{4}-\d{4,7}\b", re.IGNORECASE)
+
+HASH_TYPES = {32: "md5", 40: "sha1", 64: "sha256", 128: "sha512"}
+
+
+def _load_suffixes(path: str) -> FrozenSet[str]:
+    with open(path, encoding="utf-8") as f:
+        return frozenset(line.strip().lower() for line in f if line.strip() and not line.startswith("#"))
+
+
+# Domains and hostnames have to end in a real public suffix, otherwise obj.method or Mr.Smith would be reported
+PUBLIC_SUFFIXES = _load_suffixes(os.path.join(os.path.dirname(os.path.abspath(__file__)), "public_suffixes.txt"))
+TLDS = frozenset(rule.rsplit(".", 1)[-1] for rule in PUBLIC_SUFFIXES)
+
+
+def public_suffix_length(labels: List[str]) -> int:
+    """Number of trailing labels forming the public suffix (co.uk in example.co.uk), 0 for an unknown TLD."""
+    if labels[-1] not in TLDS:
+        return 0
+    # Exceptions to wildcards win, otherwise the longest matching rule
+    for i in range(len(labels)):
+        if "!" + ".".join(labels[i:]) in PUBLIC_SUFFIXES:
+            return len(labels) - i - 1
+    for i in range(len(labels)):
+        if ".".join(labels[i:]) in PUBLIC_SUFFIXES or "*." + ".".join(labels[i + 1:]) in PUBLIC_SUFFIXES:
+            return len(labels) - i
+    return 1
+
+
+# Things that look like domains in prose but are almost always file names, even where they are valid TLDs
+FILE_EXTENSIONS = {
+    "md", "exe", "dll", "sys", "bat", "cmd", "ps1", "vbs", "js", "jar", "msi", "lnk", "scr", "hta",
+    "doc", "docx", "docm", "xls", "xlsx", "xlsm", "ppt", "pptx", "pdf", "rtf", "txt", "csv", "json",
+    "xml", "yml", "yaml", "ini", "cfg", "conf", "log", "tmp", "dat", "bin", "db", "bak",
+    "html", "htm", "php", "asp", "aspx", "jsp", "py", "rb", "pl", "sh", "elf", "so",
+    "zip", "rar", "7z", "gz", "tar", "tgz", "iso", "img", "vhd", "jpg", "jpeg", "png", "gif", "bmp", "svg",
+}
+
+# Category and IDS defaults for each type, mirroring MISP's describeTypes sane_defaults
+TYPE_DEFAULTS: Dict[str, Tuple[str, bool]] = {
+    "ip-dst": ("Network activity", True),
+    "domain": ("Network activity", True),
+    "hostname": ("Network activity", True),
+    "url": ("Network activity", True),
+    "email": ("Social network", True),
+    "md5": ("Payload delivery", True),
+    "sha1": ("Payload delivery", True),
+    "sha256": ("Payload delivery", True),
+    "sha512": ("Payload delivery", True),
+    "vulnerability": ("External analysis", False),
+}
+
+TRAILING_PUNCTUATION = ".,;:!?)]}>'\""
+
+
+def refang(text: str) -> str:
+    for pattern, replacement in REFANG_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def _mask(text: str, spans: List[Tuple[int, int]]) -> str:
+    # Blank out already extracted values so that e.g. the host of a URL isn't reported again as a domain
+    if not spans:
+        return text
+    chars = list(text)
+    for start, end in spans:
+        chars[start:end] = " " * (end - start)
+    return "".join(chars)
+
+
+def extract_indicators(text: str, refang_text: bool = True) -> List[Dict[str, Any]]:
+    """Extract IPs, domains, hostnames, URLs, hashes, email addresses and CVEs from freetext.
+
+    Returns a de-duplicated list of MISP attribute dicts (type, value, category, to_ids) in order of
+    first appearance.
+    """
+    if refang_text:
+        text = refang(text)
+    found: List[Tuple[int, str, str]] = []
+    spans: List[Tuple[int, int]] = []
+
+    for match in URL_RE.finditer(text):
+        value = match.group(0).rstrip(TRAILING_PUNCTUATION)
+        found.append((match.start(), "url", value))
+        spans.append((match.start(), match.start() + len(value)))
+    for match in EMAIL_RE.finditer(text):
+        found.append((match.start(), "email", match.group(0).lower()))
+        spans.append(match.span())
+    text = _mask(text, spans)
+
+    for match in IPV4_RE.finditer(text):
+        found.append((match.start(), "ip-dst", match.group(0)))
+    for match in IPV6_RE.finditer(text):
+        try:
+            value = str(ipaddress.IPv6Address(match.group(0)))
+        except ValueError:
+            continue
+        found.append((match.start(), "ip-dst", value))
+    for match in HASH_RE.finditer(text):
+        value = match.group(0)
+        found.append((match.start(), HASH_TYPES[len(value)], value.lower()))
+    for match in CVE_RE.finditer(text):
+        found.append((match.start(), "vulnerability", match.group(0).upper()))
+    for match in DOMAIN_RE.finditer(text):
+        value = match.group(0).lower()
+        labels = value.split(".")
+        suffix = public_suffix_length(labels)
+        # A bare suffix such as co.uk is not a domain either
+        if not suffix or suffix >= len(labels) or labels[-1] in FILE_EXTENSIONS:
+            continue
+        found.append((match.start(), "hostname" if len(labels) > suffix + 1 else "domain", value))
+
+    found.sort(key=lambda item: item[0])
+    seen = set()
+    indicators = []
+    for _, attr_type, value in found:
+        if (attr_type, value) in seen:
+            continue
+        seen.add((attr_type, value))
+        category, to_ids = TYPE_DEFAULTS[attr_type]
+        indicators.append({"type": attr_type, "value": value, "category": category, "to_ids": to_ids})
+    return indicators
@@ -0,0 +1,175 @@
+"""
+Idempotency-Key support for the /share endpoints.
+
+A client that retries a timed out submission with the same Idempotency-Key header gets the original
+response back instead of creating a second MISP event, token and set of tickets. Responses are kept in
+Redis for a configurable window, keyed on a hash of the idempotency key, and are only replayed for a
+request with the same method, path, query string and body.
+"""
+from __future__ import annotations
+import hashlib
+import json
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse, Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from utils import get_redis
+
+logger = logging.getLogger('uvicorn.error')
+
+MAX_KEY_LENGTH = 255
+# Response headers worth replaying, everything else (content-length, compression) is set again on the way out
+REPLAYED_HEADERS = {"content-type", "etag", "location"}
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+def fingerprint(scope: Scope, body: bytes) -> str:
+    digest = hashlib.sha256()
+    digest.update(scope["method"].encode("utf-8") + b" " + scope["path"].encode("utf-8") + b"?" + scope.get("query_string", b""))
+    digest.update(b"\n")
+    digest.update(body)
+    return digest.hexdigest()
+
+
+def redis_key(idempotency_key: str) -> str:
+    return "idempotency:" + hashlib.sha256(idempotency_key.encode("utf-8")).hexdigest()
+
+
+class IdempotencyMiddleware:
+    """Replay the stored response of POST requests under path_prefix that repeat an Idempotency-Key."""
+
+    def __init__(self, app: ASGIApp, ttl: int = 86400, pending_ttl: int = 300, path_prefix: str = "/share/", max_body_size: int = 0) -> None:
+        self.app = app
+        self.ttl = ttl
+        self.pending_ttl = pending_ttl
+        self.path_prefix = path_prefix
+        # The body is buffered to fingerprint it, chunked uploads have no Content-Length to check beforehand
+        self.max_body_size = max_body_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] != "POST" or not scope["path"].startswith(self.path_prefix):
+            await self.app(scope, receive, send)
+            return
+        idempotency_key = Headers(scope=scope).get("Idempotency-Key")
+        if idempotency_key is None:
+            await self.app(scope, receive, send)
+            return
+        if not idempotency_key or len(idempotency_key) > MAX_KEY_LENGTH:
+            response = JSONResponse({"detail": f"Idempotency-Key must be between 1 and {MAX_KEY_LENGTH} characters."}, status_code=400)
+            await response(scope, receive, send)
+            return
+
+        try:
+            body, disconnected = await self._read_body(receive)
+        except BodyTooLarge:
+            await JSONResponse({"detail": "Request body too large."}, status_code=413)(scope, receive, send)
+            return
+        if disconnected:
+            return
+        request_hash = fingerprint(scope, body)
+        key = redis_key(idempotency_key)
+
+        try:
+            redis = get_redis()
+            claimed = redis.set(key, json.dumps({"state": "pending", "fingerprint": request_hash}), nx=True, ex=self.pending_ttl)
+            stored = None if claimed else redis.get(key)
+        except Exception as e:
+            # Without Redis we can't deduplicate, but the submission itself may still go through
+            logger.warning("Idempotency check failed, processing the request anyway: %s", e)
+            await self.app(scope, self._replay_receive(body, receive), send)
+            return
+
+        if not claimed:
+            if stored is None:
+                # The previous attempt expired between SET and GET, treat this as a conflict and let the client retry
+                record: Dict[str, Any] = {"state": "pending", "fingerprint": request_hash}
+            else:
+                record = json.loads(stored)
+            await self._respond_with_record(record, request_hash, scope, receive, send)
+            return
+
+        try:
+            status, headers, chunks = await self._run_and_capture(scope, self._replay_receive(body, receive), send)
+        except Exception:
+            redis.delete(key)
+            raise
+        try:
+            if status is not None and status < 500:
+                redis.set(key, json.dumps({
+                    "state": "complete",
+                    "fingerprint": request_hash,
+                    "status": status,
+                    "headers": headers,
+                    "body": b"".join(chunks).decode("utf-8", errors="replace"),
+                }), ex=self.ttl)
+            else:
+                # Server side failures are not remembered, the client's retry should actually retry
+                redis.delete(key)
+        except Exception as e:
+            logger.warning("Could not store the idempotent response: %s", e)
+
+    async def _read_body(self, receive: Receive) -> Tuple[bytes, bool]:
+        body = bytearray()
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return b"", True
+            body += message.get("body", b"")
+            if self.max_body_size and len(body) > self.max_body_size:
+                raise BodyTooLarge()
+            more_body = message.get("more_body", False)
+        return bytes(body), False
+
+    def _replay_receive(self, body: bytes, receive: Receive) -> Receive:
+        body_sent = False
+
+        async def replay() -> Message:
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        return replay
+
+    async def _run_and_capture(self, scope: Scope, receive: Receive, send: Send) -> Tuple[Optional[int], List[List[str]], List[bytes]]:
+        status: Optional[int] = None
+        headers: List[List[str]] = []
+        chunks: List[bytes] = []
+
+        async def capture(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers.extend(
+                    [name.decode("latin-1"), value.decode("latin-1")]
+                    for name, value in message.get("headers", [])
+                    if name.decode("latin-1").lower() in REPLAYED_HEADERS
+                )
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+            await send(message)
+
+        await self.app(scope, receive, capture)
+        return status, headers, chunks
+
+    async def _respond_with_record(self, record: Dict[str, Any], request_hash: str, scope: Scope, receive: Receive, send: Send) -> None:
+        if record.get("fingerprint") != request_hash:
+            response: Response = JSONResponse({"detail": "Idempotency-Key was already used for a different request."}, status_code=422)
+        elif record.get("state") != "complete":
+            response = JSONResponse({"detail": "A request with this Idempotency-Key is still being processed."}, status_code=409)
+        else:
+            response = Response(
+                content=record["body"].encode("utf-8"),
+                status_code=record["status"],
+                headers={name: value for name, value in record["headers"]},
+            )
+            response.headers["Idempotent-Replayed"] = "true"
+        await response(scope, receive, send)
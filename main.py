@@ -1,8 +1,9 @@
-from fastapi import Request, FastAPI, Query, Body, HTTPException
+from fastapi import Request, FastAPI, Query, Body, Header, HTTPException
 from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pymisp import MISPEvent
-from typing import Optional, Literal
+from typing import Optional, Literal, Dict, Any
+from contextlib import asynccontextmanager
 from config.settings import misp_config, redis_config, draugnet_config, allowed_origins
 import logging
 import json
@@ -10,10 +11,19 @@ import os
 import ssl
 import uvicorn
 import httpx
-import csv
-import io
+import asyncio
 
 from utils import *
+from extractor import extract_indicators
+from parsers import load_json, parse_misp_submission, parse_csv_submission, parse_stix_submission
+from parsers import ConversionError, convert_stix_bundle, stix_converter_available
+from compression import CompressionMiddleware, DecompressionMiddleware
+from idempotency import IdempotencyMiddleware
+from updates import new_delta, add_enhanced_text, delta_summary, submit_update
+from modules.base import EventSummary
+from breaker import breaker_states, replay_queue_lengths
+from enhancement_batch import batching_enabled, run_enhancement_batcher
+from misp_events import listener_available, run_listener as run_misp_listener
 
 if draugnet_config.get("ssl_cert_path") and draugnet_config.get("ssl_key_path"):
     ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
@@ -22,21 +32,69 @@ if draugnet_config.get("port"):
     port = draugnet_config.get("port")
 else:
     port = 8999
-    
-app = FastAPI()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Runs once per worker process - each worker gets its own Redis, MISP and HTTP pools
+    open_pools()
+    await warm_up()
+    start_background_task(sharing_groups_cache.run_refresher())
+    start_background_task(health_cache.run_refresher())
+    if get_token_ttl() and draugnet_config.get("token_sweep_interval", 3600):
+        start_background_task(run_token_sweeper())
+    if batching_enabled():
+        start_background_task(run_enhancement_batcher())
+    if draugnet_config.get("replay_interval", 30):
+        start_background_task(run_replayer())
+    if draugnet_config.get("misp_zmq_url"):
+        if listener_available():
+            start_background_task(run_misp_listener())
+        else:
+            logger.warning("misp_zmq_url is set but pyzmq is not installed, not listening for MISP updates.")
+    yield
+    await stop_background_tasks()
+    await teardown_modules()
+    await close_pools()
+
+async def warm_up():
+    # Pay the cold-start costs here rather than on the first submission after a deploy
+    steps = [
+        ("redis", lambda: get_redis().ping()),
+        ("object templates", get_object_template_index),
+        ("MISP metadata", prefetch_misp_metadata),
+        # Probe before the first /readyz rather than a full interval later
+        ("readiness probes", lambda: health_cache.set(check_dependencies())),
+    ]
+    for name, step in steps:
+        try:
+            await asyncio.to_thread(step)
+        except Exception as e:
+            logger.warning("Warm-up of %s failed: %s", name, e)
+    await setup_modules()
+
+app = FastAPI(lifespan=lifespan)
 logger = logging.getLogger('uvicorn.error')
 logger.setLevel(logging.DEBUG)
 
 
+MAX_REQUEST_BODY = draugnet_config.get("max_request_body", 50 * 1024 * 1024)  # 50 MB
+
+# Retried submissions carrying the same Idempotency-Key get the original response, runs on the decompressed body
 app.add_middleware(
-    CORSMiddleware,
-    allow_origins=allowed_origins,  # Could also be ["*"] for all, but it's more secure to specify
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    IdempotencyMiddleware,
+    ttl=draugnet_config.get("idempotency_ttl", 86400),
+    pending_ttl=draugnet_config.get("idempotency_pending_ttl", 300),
+    max_body_size=MAX_REQUEST_BODY,
+)
+# The size check below only sees the Content-Length of the compressed body, decoding is bounded by the same limit
+app.add_middleware(DecompressionMiddleware, max_size=MAX_REQUEST_BODY)
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=draugnet_config.get("compression_min_size", 1024),
+    gzip_level=draugnet_config.get("gzip_level", 6),
+    zstd_level=draugnet_config.get("zstd_level", 3),
 )
-
-MAX_REQUEST_BODY = 50 * 1024 * 1024  # 50 MB
 
 @app.middleware("http")
 async def limit_body_size(request: Request, call_next):
@@ -49,6 +107,15 @@ async def limit_body_size(request: Request, call_next):
             pass
     return await call_next(request)
 
+# Added last so it is the outermost layer and the errors of the middlewares above carry CORS headers too
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=allowed_origins,  # Could also be ["*"] for all, but it's more secure to specify
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
 
 @app.get("/")
 async def root():
@@ -60,6 +127,8 @@ async def root():
             "submission_formats": "/share",
             "view_report":        "/view/{token}",
             "sharing_groups":     "/sharing_groups",
+            "health":             "/healthz",
+            "readiness":          "/readyz",
         },
     }
 
@@ -112,17 +181,8 @@ async def share_misp_event(
     if not is_authorised():
         raise HTTPException(status_code=403, detail="Not authorized.")
 
-    data = await request.body()
-    data = json.loads(data)
-    options = []
-    if data.get("optional"):
-        options = data["optional"]
-    event = MISPEvent()
-    if "event" in data:
-        data = data["event"]
-    if "Event" in data:
-        data = data["Event"]
-    event.from_dict(**data)
+    # Building a MISPEvent from a huge submission is CPU-bound, large bodies are parsed in the process pool
+    options, event = await parse_submission(parse_misp_submission, await request.body())
 
     if options:
         event = add_optional_form_data(event, options)
@@ -150,8 +210,10 @@ async def share_misp_event(
             raise HTTPException(status_code=500, detail="Could not store token.")
         
     context = 'misp'
-    enhanced_text = modules_enhance(action_type, context, data)
-    modules_update(context, action_type, event, token, [], enhanced_text)
+    # Summarise the saved event once, for the enhancement and reporting modules alike
+    summary = EventSummary.from_event(saved_event)
+    enhanced_text = await modules_enhance(action_type, context, summary, token=token)
+    modules_update(context, action_type, summary, token, [], enhanced_text)
     return {"token": token, "event_uuid": saved_event["Event"]["uuid"], "status": "ok"}
 
 @app.post("/share/raw")
@@ -166,8 +228,7 @@ async def post_raw(
     if not is_authorised():
         raise HTTPException(status_code=403, detail="Not authorized.")
     
-    data = await request.body()
-    data = json.loads(data)
+    data = await parse_submission(load_json, await request.body())
     context = 'freetext'
 
     if "text" not in data:
@@ -178,19 +239,38 @@ async def post_raw(
     if not raw_text_str:
         raise HTTPException(status_code=400, detail="Empty report body.")
 
+    local_extractor = draugnet_config.get("freetext_extractor", "misp") == "local"
+    if local_extractor:
+        # Extract the indicators in-process and send them along with the report in a single MISP call
+        indicators = await run_cpu_bound(extract_indicators, raw_text_str, size=len(raw_text_str))
+    else:
+        indicators = []
+
     if token:
         uuid = token_to_uuid(token)
         if not uuid:
             raise HTTPException(status_code=404, detail="Invalid token.")
-        event = pymisp.get_event(uuid, pythonify=True)
+        # Concurrent updates to the same token are merged into a single MISP update
+        enhanced_text = await modules_enhance('modify', context, raw_text_str, token=token)
+        report = {"name": "Raw freetext input", "content": raw_text_str, "extract": not local_extractor}
+        delta = new_delta(context, data.get("optional"), indicators, reports=[report], enhanced_text=enhanced_text)
+        await submit_update(token, uuid, delta)
+        return {"token": token, "event_uuid": uuid, "status": "ok"}
+
+    if local_extractor:
+        event = create_misp_event()
         if data.get("optional"):
             event = add_optional_form_data(event, data["optional"])
-            saved_event = pymisp.update_event(event, event_id=uuid, pythonify=True)
-        else:
-            saved_event = event
+        event.add_event_report("Raw freetext input", raw_text_str)
+        add_extracted_attributes(event, indicators)
+        saved_event = pymisp.add_event(event, pythonify=True)
         if isinstance(saved_event, dict) and "errors" in saved_event:
-            logger.error(f"Error getting event: {json.dumps(saved_event['errors'])}")
-            raise HTTPException(status_code=403, detail="Invalid MISP event or no access.")
+            logger.error(f"Error saving event: {json.dumps(saved_event['errors'])}")
+            raise HTTPException(status_code=500, detail="Could not save event to MISP.")
+        event = saved_event
+        event_uuid = saved_event.get("uuid")
+        # The report is already part of the saved event
+        reports = []
     else:
         event = create_misp_event()
         if data.get("optional"):
@@ -200,35 +280,34 @@ async def post_raw(
             logger.error(f"Error creating event: {json.dumps(saved_event['errors'])}")
             raise HTTPException(status_code=500, detail="Could not create MISP event.")
 
-    event_uuid = saved_event.get("uuid")
-    event_report = create_report(raw_text_str, event_uuid, "Raw freetext input")
-    try:
-        response = pymisp.add_event_report(event_uuid, event_report)
-        if isinstance(response, dict) and "errors" in response:
-            logger.error(f"Error adding event report: {json.dumps(response['errors'])}")
+        event_uuid = saved_event.get("uuid")
+        event_report = create_report(raw_text_str, event_uuid, "Raw freetext input")
+        try:
+            response = pymisp.add_event_report(event_uuid, event_report)
+            if isinstance(response, dict) and "errors" in response:
+                logger.error(f"Error adding event report: {json.dumps(response['errors'])}")
+                raise HTTPException(status_code=500, detail="Could not attach event report.")
+        except Exception as e:
+            logger.exception("Exception while adding event report.")
             raise HTTPException(status_code=500, detail="Could not attach event report.")
-    except Exception as e:
-        logger.exception("Exception while adding event report.")
-        raise HTTPException(status_code=500, detail="Could not attach event report.")
-    report_uuid = response["EventReport"]["uuid"]
-    try:
-        result = extract_report_entities(pymisp, report_uuid)
-        if isinstance(result, dict) and "errors" in result:
+        report_uuid = response["EventReport"]["uuid"]
+        try:
+            result = extract_report_entities(pymisp, report_uuid)
+            if isinstance(result, dict) and "errors" in result:
+                raise HTTPException(status_code=500, detail="Could not extract entities from report.")
+        except Exception as e:
+            logger.exception("Exception while extracting entities from report.")
             raise HTTPException(status_code=500, detail="Could not extract entities from report.")
-    except Exception as e:
-        logger.exception("Exception while extracting entities from report.")
-        raise HTTPException(status_code=500, detail="Could not extract entities from report.")
+        reports = [event_report]
+
     action_type = 'create'
-    if token:
-        action_type = 'modify'
-        touch_token(token)
-        event = pymisp.get_event(uuid, pythonify=True)
-    else:
-        token = generate_token()
-        if not store_token_to_uuid(token, event_uuid):
-            raise HTTPException(status_code=500, detail="Could not store token.")
-    enhanced_text = modules_enhance(action_type, context, raw_text_str)
-    modules_update(context, action_type, event, token, [event_report], enhanced_text)
+    token = generate_token()
+    if not store_token_to_uuid(token, event_uuid):
+        raise HTTPException(status_code=500, detail="Could not store token.")
+    # The summary carries the freetext as its report, for the enhancement and the reporting modules alike
+    summary = EventSummary.from_event(event, reports)
+    enhanced_text = await modules_enhance(action_type, context, summary, token=token)
+    modules_update(context, action_type, summary, token, [], enhanced_text)
     return {"token": token, "event_uuid": event_uuid, "status": "ok"}
 
 @app.post("/share/objects")
@@ -243,8 +322,7 @@ async def post_objects(
     if not is_authorised():
         raise HTTPException(status_code=403, detail="Not authorized.")
     
-    temp_data = await request.body()
-    temp_data = json.loads(temp_data)
+    temp_data = await parse_submission(load_json, await request.body())
     data = {}
     optional = {}
 
@@ -264,41 +342,35 @@ async def post_objects(
         if temp_data['data'][key] is not None and temp_data['data'][key] != "" and temp_data['data'][key] != [] and temp_data['data'][key] != 'undefined':
             data[key] = temp_data['data'][key]
 
+    misp_object = create_misp_object(pymisp, template_name, data)
     if token:
         uuid = token_to_uuid(token)
         if not uuid:
             raise HTTPException(status_code=404, detail="Invalid token.")
-        event = pymisp.get_event(uuid, pythonify=True)
-        if isinstance(event, dict) and "errors" in event:
-            logger.error(f"Error getting event: {json.dumps(event['errors'])}")
-            raise HTTPException(status_code=403, detail="Invalid MISP event or no access.")
-    else:
-        event = create_misp_event()
-        if optional:
-            event = add_optional_form_data(event, optional)
-    
-    misp_object = create_misp_object(pymisp, template_name, data)
+        # Concurrent updates to the same token are merged into a single MISP update
+        delta = new_delta(context, objects=[misp_object])
+        add_enhanced_text(delta, await modules_enhance('modify', context, delta_summary(delta), token=token))
+        await submit_update(token, uuid, delta)
+        return {"token": token, "event_uuid": uuid, "status": "ok"}
+
+    event = create_misp_event()
+    if optional:
+        event = add_optional_form_data(event, optional)
     event.add_object(misp_object)
-    if token:
-        saved_event = pymisp.update_event(event)
-    else:
-        saved_event = pymisp.add_event(event)
+    saved_event = pymisp.add_event(event)
 
     if isinstance(saved_event, dict) and "errors" in saved_event:
         logger.error(f"Error saving event: {json.dumps(saved_event['errors'])}")
         raise HTTPException(status_code=500, detail="Could not save event to MISP.")
 
     action_type = 'create'
-    if token:
-        action_type = 'modify'
-        touch_token(token)
-    else:
-        token = generate_token()
-        if not store_token_to_uuid(token, saved_event["Event"]["uuid"]):
-            raise HTTPException(status_code=500, detail="Could not store token.")
+    token = generate_token()
+    if not store_token_to_uuid(token, saved_event["Event"]["uuid"]):
+        raise HTTPException(status_code=500, detail="Could not store token.")
         
-    enhanced_text = modules_enhance(action_type, context, saved_event)
-    modules_update(context, action_type, event, token, [])
+    summary = EventSummary.from_event(saved_event)
+    enhanced_text = await modules_enhance(action_type, context, summary, token=token)
+    modules_update(context, action_type, summary, token, [], enhanced_text)
     
     return {"token": token, "event_uuid": saved_event["Event"]["uuid"], "status": "ok"}
 
@@ -314,40 +386,8 @@ async def share_csv(
     if not is_authorised():
         raise HTTPException(status_code=403, detail="Not authorized.")
 
-    body = await request.body()
-    body = json.loads(body)
-    options = body.get("optional", {})
-    csv_data = body.get("csv")
-
-    if not csv_data:
-        raise HTTPException(status_code=400, detail="Missing 'csv' field in request body.")
-
-    # Parse CSV — normalise header names to lowercase and strip surrounding whitespace
-    try:
-        reader = csv.DictReader(io.StringIO(csv_data.strip()))
-        if reader.fieldnames:
-            reader.fieldnames = [f.strip().lower() for f in reader.fieldnames]
-        rows = list(reader)
-    except Exception as e:
-        logger.warning("Failed to parse CSV: %s", e)
-        raise HTTPException(status_code=400, detail="Failed to parse CSV. Ensure the file is valid CSV with the required headers.")
-
-    if not rows:
-        raise HTTPException(status_code=400, detail="CSV contains no data rows.")
-
-    # Validate required fields and collect non-empty optional ones per row
-    attributes = []
-    for i, row in enumerate(rows, start=1):
-        attr_type  = row.get("type",  "").strip()
-        attr_value = row.get("value", "").strip()
-        if not attr_type or not attr_value:
-            raise HTTPException(status_code=400, detail=f"Row {i} is missing required field(s): 'type' and 'value' must both be set.")
-        attr = {"type": attr_type, "value": attr_value}
-        for field in ("category", "comment", "first_seen", "last_seen"):
-            v = row.get(field, "").strip()
-            if v:
-                attr[field] = v
-        attributes.append(attr)
+    # Parsing and validating every row is CPU-bound, large files are handled in the process pool
+    options, attributes = await parse_submission(parse_csv_submission, await request.body())
 
     context = 'csv'
 
@@ -355,42 +395,35 @@ async def share_csv(
         uuid = token_to_uuid(token)
         if not uuid:
             raise HTTPException(status_code=404, detail="Invalid token.")
-        event = pymisp.get_event(uuid, pythonify=True)
-        if isinstance(event, dict) and "errors" in event:
-            logger.error(f"Error fetching event: {json.dumps(event['errors'])}")
-            raise HTTPException(status_code=403, detail="Invalid MISP event or no access.")
-        if options:
-            event = add_optional_form_data(event, options)
-    else:
-        event = create_misp_event()
-        if options:
-            event = add_optional_form_data(event, options)
+        # Concurrent updates to the same token are merged into a single MISP update
+        delta = new_delta(context, options, attributes)
+        add_enhanced_text(delta, await modules_enhance('modify', context, delta_summary(delta), token=token))
+        await submit_update(token, uuid, delta)
+        return {"token": token, "event_uuid": uuid, "status": "ok"}
+
+    event = create_misp_event()
+    if options:
+        event = add_optional_form_data(event, options)
 
     for attr in attributes:
         attr_type  = attr.pop("type")
         attr_value = attr.pop("value")
         event.add_attribute(attr_type, attr_value, **attr)
 
-    if token:
-        saved_event = pymisp.update_event(event, event_id=uuid)
-    else:
-        saved_event = pymisp.add_event(event)
+    saved_event = pymisp.add_event(event)
 
     if isinstance(saved_event, dict) and "errors" in saved_event:
         logger.error(f"Error saving event: {json.dumps(saved_event['errors'])}")
         raise HTTPException(status_code=500, detail="Could not save event to MISP.")
 
     action_type = 'create'
-    if token:
-        action_type = 'modify'
-        touch_token(token)
-    else:
-        token = generate_token()
-        if not store_token_to_uuid(token, saved_event["Event"]["uuid"]):
-            raise HTTPException(status_code=500, detail="Could not store token.")
+    token = generate_token()
+    if not store_token_to_uuid(token, saved_event["Event"]["uuid"]):
+        raise HTTPException(status_code=500, detail="Could not store token.")
 
-    enhanced_text = modules_enhance(action_type, context, saved_event)
-    modules_update(context, action_type, event, token, [], enhanced_text)
+    summary = EventSummary.from_event(saved_event)
+    enhanced_text = await modules_enhance(action_type, context, summary, token=token)
+    modules_update(context, action_type, summary, token, [], enhanced_text)
     return {"token": token, "event_uuid": saved_event["Event"]["uuid"], "status": "ok"}
 
 
@@ -406,66 +439,57 @@ async def share_stix(
     if not is_authorised():
         raise HTTPException(status_code=403, detail="Not authorized.")
 
-    body = await request.body()
-    body = json.loads(body)
-    options = body.get("optional", {})
-    stix_data = body.get("stix")
-
-    if not stix_data:
-        raise HTTPException(status_code=400, detail="Missing 'stix' field in request body.")
-
-    # Normalise: keep both a parsed dict and a JSON string for the API call
-    if isinstance(stix_data, dict):
-        stix_str = json.dumps(stix_data)
-        stix_parsed = stix_data
-    else:
-        stix_str = stix_data
-        try:
-            stix_parsed = json.loads(stix_str)
-        except Exception:
-            raise HTTPException(status_code=400, detail="Invalid STIX JSON.")
-
-    # STIX 2.x bundles carry a 'bundle--{uuid}' id that MISP uses as the event UUID
-    bundle_id = stix_parsed.get("id", "")
-    if not bundle_id.startswith("bundle--"):
-        raise HTTPException(
-            status_code=400,
-            detail="Could not determine event UUID from STIX. Only STIX 2.0/2.1 bundles are supported."
-        )
-    event_uuid = bundle_id[len("bundle--"):]
+    # Bundles can reach tens of MB, decode and re-encode them in the process pool when they are large
+    options, stix_str, event_uuid = await parse_submission(parse_stix_submission, await request.body())
 
     if token:
         existing_uuid = token_to_uuid(token)
         if not existing_uuid:
             raise HTTPException(status_code=404, detail="Invalid token.")
 
-    # Import the STIX bundle into MISP via a direct HTTP call.
-    # PyMISP's upload_stix() and direct_call() both mangle the request in a way that
-    # triggers MISP's STIX 1 handler, so we call the endpoint ourselves with httpx.
-    # MISP may return an error for non-critical reasons (e.g. saving the original file as
-    # an attachment fails due to filesystem permissions) while still creating the event
-    # successfully. We therefore always attempt to fetch the event by its UUID and only
-    # treat a missing event as a hard failure.
-    stix_import_url = f"{misp_config['url']}/events/upload_stix/2"
-    stix_headers = {
-        "Authorization": misp_config["key"],
-        "Accept": "application/json",
-        "Content-Type": "application/json",
-    }
-    async with httpx.AsyncClient(verify=misp_config.get("verifycert", True)) as client:
-        stix_response = await client.post(stix_import_url, content=stix_str, headers=stix_headers)
-    if not stix_response.is_success:
-        logger.warning(f"STIX import returned non-success status {stix_response.status_code}: {stix_response.text[:200]}")
+    event = None
+    if draugnet_config.get("stix_converter", "misp") == "local" and stix_converter_available():
+        # Convert the bundle in-process and create the event with a single add_event, saving MISP the
+        # conversion work as well as the get_event/update_event round-trips of the import path below
+        try:
+            event = await run_cpu_bound(convert_stix_bundle, stix_str, event_uuid, size=len(stix_str))
+            if options:
+                event = add_optional_form_data(event, options)
+            saved_event = pymisp.add_event(event, pythonify=True)
+            if isinstance(saved_event, dict) and "errors" in saved_event:
+                raise ConversionError(f"Could not save converted event: {json.dumps(saved_event['errors'])}")
+            event = saved_event
+        except ConversionError as e:
+            logger.warning("Local STIX conversion failed, falling back to MISP's importer: %s", e)
+            event = None
+
+    if event is None:
+        # Import the STIX bundle into MISP via a direct HTTP call.
+        # PyMISP's upload_stix() and direct_call() both mangle the request in a way that
+        # triggers MISP's STIX 1 handler, so we call the endpoint ourselves with httpx.
+        # MISP may return an error for non-critical reasons (e.g. saving the original file as
+        # an attachment fails due to filesystem permissions) while still creating the event
+        # successfully. We therefore always attempt to fetch the event by its UUID and only
+        # treat a missing event as a hard failure.
+        stix_import_url = f"{misp_config['url']}/events/upload_stix/2"
+        stix_headers = {
+            "Authorization": misp_config["key"],
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+        }
+        stix_response = await get_http_client().post(stix_import_url, content=stix_str, headers=stix_headers)
+        if not stix_response.is_success:
+            logger.warning(f"STIX import returned non-success status {stix_response.status_code}: {stix_response.text[:200]}")
 
-    # Fetch the imported event so we can apply optional metadata
-    event = pymisp.get_event(event_uuid, pythonify=True)
-    if isinstance(event, dict) and "errors" in event:
-        logger.error(f"Could not fetch event after STIX import: {json.dumps(event.get('errors', {}))}")
-        raise HTTPException(status_code=500, detail="Could not import STIX data. Ensure the bundle is valid STIX 2.0 or 2.1.")
+        # Fetch the imported event so we can apply optional metadata
+        event = pymisp.get_event(event_uuid, pythonify=True)
+        if isinstance(event, dict) and "errors" in event:
+            logger.error(f"Could not fetch event after STIX import: {json.dumps(event.get('errors', {}))}")
+            raise HTTPException(status_code=500, detail="Could not import STIX data. Ensure the bundle is valid STIX 2.0 or 2.1.")
 
-    if options:
-        event = add_optional_form_data(event, options)
-        pymisp.update_event(event, event_id=event_uuid)
+        if options:
+            event = add_optional_form_data(event, options)
+            pymisp.update_event(event, event_id=event_uuid)
 
     context = 'stix'
     action_type = 'create'
@@ -477,32 +501,105 @@ async def share_stix(
         if not store_token_to_uuid(token, event_uuid):
             raise HTTPException(status_code=500, detail="Could not store token.")
 
-    enhanced_text = modules_enhance(action_type, context, stix_str)
-    modules_update(context, action_type, event, token, [], enhanced_text)
+    summary = EventSummary.from_event(event)
+    enhanced_text = await modules_enhance(action_type, context, summary, token=token)
+    modules_update(context, action_type, summary, token, [], enhanced_text)
     return {"token": token, "event_uuid": event_uuid, "status": "ok"}
 
 
+@app.get("/sharing_groups")
+async def get_sharing_groups():
+    try:
+        return await sharing_groups_cache.get()
+    except Exception as e:
+        logger.error("Failed to fetch sharing groups: %s", e)
+        raise HTTPException(status_code=500, detail="Could not fetch sharing groups.")
+
+
+@app.post("/webhooks/misp")
+async def misp_webhook(request: Request):
+    # Called by MISP (e.g. a workflow's webhook module) when an event changes on the MISP side,
+    # so that submitters polling /timestamp pick up analyst comments and new attributes
+    if not draugnet_config.get("webhook_secret"):
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not is_valid_webhook_secret(request.headers.get("Authorization")):
+        raise HTTPException(status_code=403, detail="Invalid webhook secret.")
+    payload = await parse_submission(load_json, await request.body())
+    event_uuid = get_webhook_event_uuid(payload)
+    if not event_uuid:
+        raise HTTPException(status_code=400, detail="Could not determine the event UUID.")
+    touched = await asyncio.to_thread(touch_event_tokens, event_uuid)
+    return {"event_uuid": event_uuid, "tokens_updated": touched}
+
+
+@app.get("/metrics")
+async def get_metrics():
+    if not is_authorised():
+        raise HTTPException(status_code=403, detail="Not authorised.")
+    try:
+        token_keyspace = await token_keyspace_cache.get()
+    except Exception as e:
+        logger.error("Failed to report on the token keyspace: %s", e)
+        raise HTTPException(status_code=500, detail="Could not collect metrics.")
+    return {
+        "token_keyspace": token_keyspace,
+        "circuit_breakers": breaker_states(),
+        "replay_queues": await asyncio.to_thread(replay_queue_lengths, get_redis()),
+    }
+
+
+@app.get("/healthz")
+async def healthz():
+    # Liveness: the worker answers, dependencies are /readyz's business
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    # Served from the periodically refreshed probe results, so load balancer polling never reaches MISP or Redis
+    health = health_cache.peek()
+    if health is None:
+        return JSONResponse({"status": "unknown", "detail": "Dependencies have not been checked recently."}, status_code=503)
+    return JSONResponse(
+        {"status": "ready" if health["ready"] else "not ready", "probe_age": round(health_cache.age(), 1), **health},
+        status_code=200 if health["ready"] else 503
+    )
+
+
 # GET version (token in path, format in query)
 @app.get("/retrieve")
 async def retrieve_event_get(
     token: str = Query(None, description="Token for retrieving the event"),
-    format: Literal["json", "csv", "suricata", "text", "stix", "stix2"] = Query("json")
+    format: Literal["json", "csv", "suricata", "text", "stix", "stix2"] = Query("json"),
+    since: Optional[int] = Query(None, ge=0, description="Only return data modified at or after this unix timestamp, typically the last value returned by /timestamp"),
+    if_none_match: Optional[str] = Header(None)
 ):
-    return await retrieve_event_by_token(token, format)
+    return await retrieve_event_by_token(token, format, since, if_none_match)
 
 
 # POST version (token and format in request body)
 @app.post("/retrieve")
 async def retrieve_event_post(
-    body: dict = Body(..., example={"token": "abc123", "format": "json"})
+    body: dict = Body(..., example={"token": "abc123", "format": "json", "since": 1700000000}),
+    if_none_match: Optional[str] = Header(None)
 ):
     token = body.get("token")
     format = body.get("format", "json")
+    since = body.get("since")
 
     if not token:
         raise HTTPException(status_code=400, detail="Missing token in request body.")
-    
-    return await retrieve_event_by_token(token, format)
+    if not isinstance(format, str) or format not in RETRIEVE_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="Invalid 'format', use one of: " + ", ".join(RETRIEVE_MEDIA_TYPES) + ".")
+    if since is not None:
+        try:
+            since = int(since)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid 'since' timestamp.")
+        if since < 0:
+            raise HTTPException(status_code=400, detail="Invalid 'since' timestamp.")
+
+    return await retrieve_event_by_token(token, format, since, if_none_match)
     
 @app.get("/timestamp")
 async def retrieve_last_update_timestamp(
@@ -545,24 +642,32 @@ async def get_object_template(
 
     # If no template is provided, list available templates
     try:
-        templates = [
-            name for name in os.listdir(OBJECTS_DIR)
-            if os.path.isdir(os.path.join(OBJECTS_DIR, name))
-               and os.path.isfile(os.path.join(OBJECTS_DIR, name, "definition.json"))
-        ]
-        template_whitelist = get_misp_object_template_whitelist()
-        if template_whitelist:
-            templates = [t for t in templates if t in template_whitelist]
-        return templates
+        return get_object_template_index()
     except Exception as e:
         logger.error("Failed to list templates: %s", e)
         raise HTTPException(status_code=500, detail="Failed to list templates.")
 
-if __name__ == "__main__":
+def get_server_settings() -> Dict[str, Any]:
+    # Build the uvicorn settings for the production launcher from draugnet_config
+    workers = int(draugnet_config.get("workers", 1) or 0)
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    settings = {
+        "host": draugnet_config.get("host", "0.0.0.0"),
+        "port": port,
+        "workers": workers,
+        "loop": draugnet_config.get("loop", "auto"),
+        "http": draugnet_config.get("http", "auto"),
+        "timeout_keep_alive": draugnet_config.get("timeout_keep_alive", 5),
+        "backlog": draugnet_config.get("backlog", 2048),
+        "limit_concurrency": draugnet_config.get("limit_concurrency"),
+        "timeout_graceful_shutdown": draugnet_config.get("timeout_graceful_shutdown", 30),
+        "proxy_headers": draugnet_config.get("proxy_headers", True),
+    }
     if draugnet_config.get("ssl_cert_path") and draugnet_config.get("ssl_key_path"):
-        ssl_key_path = draugnet_config.get("ssl_key_path")
-        ssl_certfile = draugnet_config.get("ssl_cert_path")
-    try:
-        uvicorn.run("main:app", host="0.0.0.0", port=port, ssl_keyfile=ssl_key_path, ssl_certfile=ssl_certfile)
-    except NameError:
-        uvicorn.run("main:app", host="0.0.0.0", port=port)
\ No newline at end of file
+        settings["ssl_certfile"] = draugnet_config.get("ssl_cert_path")
+        settings["ssl_keyfile"] = draugnet_config.get("ssl_key_path")
+    return settings
+
+if __name__ == "__main__":
+    uvicorn.run("main:app", **get_server_settings())
@@ -0,0 +1,108 @@
+"""
+Listener for MISP's ZeroMQ event feed.
+
+Analyst edits made directly in MISP don't go through Draugnet, so without this /timestamp wouldn't change
+until the submitter next submits something. When misp_zmq_url is configured, one worker (elected through a
+Redis lock) subscribes to MISP's event, attribute and object notifications and flags every token of the
+changed event as updated, which also invalidates the ETags handed out by /retrieve.
+Requires the optional pyzmq package, /webhooks/misp covers setups without ZMQ.
+"""
+from __future__ import annotations
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Dict, List, Optional
+
+from config.settings import draugnet_config
+from utils import get_redis, get_webhook_event_uuid, release_lock, renew_lock, touch_event_tokens
+
+try:
+    import zmq
+    import zmq.asyncio
+except ImportError:
+    zmq = None
+
+logger = logging.getLogger('uvicorn.error')
+
+LOCK_KEY = "misp_zmq_listener:lock"
+LOCK_TTL = 30
+DEFAULT_TOPICS = ["misp_json_event", "misp_json_attribute", "misp_json_object"]
+
+
+def listener_available() -> bool:
+    return zmq is not None and bool(draugnet_config.get("misp_zmq_url"))
+
+
+def parse_message(message: str) -> Optional[Dict[str, Any]]:
+    # MISP publishes "<topic> <json>" as a single frame
+    _, _, data = message.partition(" ")
+    try:
+        payload = json.loads(data)
+    except ValueError:
+        return None
+    return payload if isinstance(payload, dict) else None
+
+
+def handle_message(message: str) -> int:
+    payload = parse_message(message)
+    if not payload:
+        return 0
+    event_uuid = get_webhook_event_uuid(payload)
+    if not event_uuid:
+        return 0
+    return touch_event_tokens(event_uuid)
+
+
+def _acquire_lock(lock_id: str) -> bool:
+    redis = get_redis()
+    if redis.set(LOCK_KEY, lock_id, nx=True, ex=LOCK_TTL):
+        return True
+    # Renew the lock if we already hold it
+    return renew_lock(redis, LOCK_KEY, lock_id, LOCK_TTL)
+
+
+def _release_lock(lock_id: str) -> None:
+    release_lock(get_redis(), LOCK_KEY, lock_id)
+
+
+async def _listen(url: str, topics: List[str], lock_id: str) -> None:
+    context = zmq.asyncio.Context.instance()
+    socket = context.socket(zmq.SUB)
+    try:
+        socket.connect(url)
+        for topic in topics:
+            socket.setsockopt_string(zmq.SUBSCRIBE, topic)
+        logger.info("Listening for MISP updates on %s", url)
+        while True:
+            # Wake up regularly to renew the lock, and stop listening if another worker took over
+            if await socket.poll(timeout=LOCK_TTL * 1000 // 3):
+                message = await socket.recv_string()
+                touched = await asyncio.to_thread(handle_message, message)
+                if touched:
+                    logger.debug("MISP update flagged %d token(s) as updated", touched)
+            if not await asyncio.to_thread(_acquire_lock, lock_id):
+                return
+    finally:
+        socket.close(linger=0)
+
+
+async def run_listener() -> None:
+    url = draugnet_config.get("misp_zmq_url")
+    topics = draugnet_config.get("misp_zmq_topics") or DEFAULT_TOPICS
+    lock_id = f"{os.getpid()}:{id(asyncio.current_task())}"
+    try:
+        while True:
+            try:
+                if await asyncio.to_thread(_acquire_lock, lock_id):
+                    await _listen(url, topics, lock_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("MISP ZMQ listener failed: %s", e)
+            await asyncio.sleep(LOCK_TTL // 2)
+    finally:
+        try:
+            _release_lock(lock_id)
+        except Exception:
+            pass
@@ -1,22 +1,268 @@
 # modules/base.py
 from __future__ import annotations
+import asyncio
+import contextlib
+import inspect
+import time
 from abc import ABC, abstractmethod
-from typing import Any, Optional, Dict, List
+from collections import Counter
+from typing import Any, AsyncIterator, Callable, Optional, Dict, List, Tuple
 from redis import Redis
 
 
-class ReportingModule(ABC):
-    """Common interface for reporting-type modules (e.g., RTIR)."""
+class BaseModule:
+    """Common base of the reporting and enhancement modules.
+
+    The core schedules every call through call(): at most max_concurrency calls run at once (0 for no limit)
+    and each is cancelled after timeout seconds (None for no limit). Both can be declared by the module class
+    and overridden per module in its config ("max_concurrency", "call_timeout").
+    setup() and teardown() are awaited once per worker on startup and shutdown, e.g. to open and close pools.
+    """
+
+    max_concurrency: int = 0
+    timeout: Optional[float] = None
 
     def __init__(self, config: Dict[str, Any]) -> None:
-        self.config = config or {}
+        self.cfg = config or {}
+        self.max_concurrency = int(self.cfg.get("max_concurrency", self.max_concurrency))
+        self.timeout = self.cfg.get("call_timeout", self.timeout)
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def setup(self) -> None:
+        pass
+
+    async def teardown(self) -> None:
+        pass
+
+    async def call(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Await fn(*args) within the module's limits, blocking functions run in a worker thread."""
+        if self.max_concurrency and self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore or contextlib.nullcontext():
+            result = fn(*args) if inspect.iscoroutinefunction(fn) else asyncio.to_thread(fn, *args)
+            if self.timeout:
+                return await asyncio.wait_for(result, float(self.timeout))
+            return await result
+
+
+class ExternalIdPending(Exception):
+    """An update arrived before the record it belongs to was created in the external system."""
+
+    def __init__(self, name: str) -> None:
+        super().__init__(f"No {name} record for this submission yet")
+        self.name = name
+
+
+class RateLimiter:
+    """Token bucket allowing rate calls per second on average, in bursts of up to burst (rate 0 = no limit)."""
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def acquire(self) -> None:
+        if not self.rate:
+            return
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class ReportingModule(BaseModule, ABC):
+    """Common interface for reporting-type modules (e.g., RTIR).
+
+    HTTP calls to the external system should be made within request_slot(), which keeps at most
+    max_parallel_requests in flight and applies the system's rate_limit (requests per second).
+    """
+
+    def __init__(self, config: Dict[str, Any]) -> None:
+        super().__init__(config)
+        self.rate_limiter = RateLimiter(float(self.cfg.get("rate_limit", 0)), int(self.cfg.get("rate_burst", 1)))
+        self.max_parallel_requests = max(int(self.cfg.get("max_parallel_requests", 8)), 1)
+        self._request_slots: Optional[asyncio.Semaphore] = None
+
+    @contextlib.asynccontextmanager
+    async def request_slot(self) -> AsyncIterator[None]:
+        if self._request_slots is None:
+            self._request_slots = asyncio.Semaphore(self.max_parallel_requests)
+        async with self._request_slots:
+            await self.rate_limiter.acquire()
+            yield
 
     @abstractmethod
-    async def create_item(self, *, context: str, redis: Redis, external_id: str, event: Any, reports: List[Dict[str, Any]], enhanced_text: Optional[str] = None) -> Dict[str, Any]:
+    async def create_item(self, context: str, redis: Redis, token: str, event: EventSummary, reports: List[Dict[str, Any]], enhanced_text: Optional[str] = None) -> Any:
         """Create a new report/ticket/record in the external system."""
         ...
 
     @abstractmethod
-    async def update_item(self, *,  context: str, redis: Redis, token:str, event: Any, reports: List[Dict[str, Any]], enhanced_text: Optional[str] = None) -> Dict[str, Any]:
+    async def update_item(self, context: str, redis: Redis, external_id: bytes, event: EventSummary, reports: List[Dict[str, Any]], enhanced_text: Optional[str] = None) -> Any:
         """Append content / update an existing record in the external system."""
         ...
+
+    async def create_items(self, context: str, redis: Redis, items: List[Tuple[str, EventSummary, Optional[str]]]) -> List[Any]:
+        """Create records for several (token, event, enhanced_text) submissions at once.
+
+        Returns a result or exception per item. Override when the external system has a bulk endpoint,
+        by default this calls create_item for each concurrently, bounded by request_slot().
+        """
+        return await asyncio.gather(
+            *(self.create_item(context, redis, token, event, [], enhanced_text) for token, event, enhanced_text in items),
+            return_exceptions=True
+        )
+
+
+class EnhancementModule(BaseModule, ABC):
+    """Common interface for enhancement-type modules (e.g., Ollama)."""
+
+    @abstractmethod
+    def run(self, action_type: str, context: str, content: Any, **kwargs) -> Any:
+        """Return the enhanced content, blocking."""
+        ...
+
+    async def run_async(self, action_type: str, context: str, content: Any) -> Any:
+        """Non-blocking run(), override for natively async implementations."""
+        return await asyncio.to_thread(self.run, action_type, context, content)
+
+    def run_batch(self, items: List[Tuple[str, str, Any]]) -> List[Any]:
+        """Enhance several (action_type, context, content) items, override to handle them in one go."""
+        return [self.run(action_type, context, content) for action_type, context, content in items]
+
+
+def _field(item: Any, key: str, default: Any = None) -> Any:
+    # PyMISP objects and plain MISP JSON dicts both support .get()
+    value = item.get(key, default) if hasattr(item, "get") else getattr(item, key, default)
+    return default if value is None else value
+
+
+class EventSummary:
+    """The parts of a MISP event the modules use, extracted once per submission.
+
+    Modules receive this instead of the event itself, so background tasks don't keep large events alive
+    and every module doesn't scan the tags and join the reports again.
+    """
+
+    __slots__ = ("uuid", "info", "tags", "submitter", "reports", "galaxy_clusters", "object_names", "attribute_types", "_rendered")
+
+    def __init__(
+        self,
+        uuid: str = "",
+        info: str = "",
+        tags: Optional[List[str]] = None,
+        submitter: str = "unknown",
+        reports: Optional[List[Tuple[str, str]]] = None,
+        galaxy_clusters: Optional[List[str]] = None,
+        object_names: Optional[Counter] = None,
+        attribute_types: Optional[Counter] = None
+    ) -> None:
+        self.uuid = uuid
+        self.info = info
+        self.tags = tags or []
+        self.submitter = submitter
+        self.reports = reports or []
+        self.galaxy_clusters = galaxy_clusters or []
+        self.object_names = object_names or Counter()
+        self.attribute_types = attribute_types or Counter()
+        self._rendered: Dict[Any, Any] = {}
+
+    @classmethod
+    def from_event(cls, event: Any, reports: Optional[List[Any]] = None) -> EventSummary:
+        """Build a summary from a MISPEvent or MISP JSON ({"Event": {...}} or the bare event), plus any
+        newly submitted reports that may not be part of the event yet."""
+        if isinstance(event, EventSummary):
+            return event
+        if isinstance(event, dict) and isinstance(event.get("Event"), dict):
+            event = event["Event"]
+        event = event or {}
+
+        tags = []
+        submitter = "unknown"
+        for tag in _field(event, "Tag", []):
+            name = _field(tag, "name", "")
+            if name.startswith("submitter:"):
+                submitter = name.split("submitter:")[-1]
+            elif name:
+                tags.append(name)
+
+        summary_reports = []
+        seen = set()
+        for report in list(reports or []) + list(_field(event, "EventReport", [])):
+            # Reports submitted with this request may already be part of the saved event
+            key = _field(report, "uuid", "") or (_field(report, "name", ""), _field(report, "content", ""))
+            if key in seen:
+                continue
+            seen.add(key)
+            summary_reports.append((_field(report, "name", ""), _field(report, "content", "")))
+
+        galaxy_clusters = [_field(cluster, "value", "") for cluster in _field(event, "GalaxyCluster", [])]
+        for galaxy in _field(event, "Galaxy", []):
+            galaxy_clusters.extend(_field(cluster, "value", "") for cluster in _field(galaxy, "GalaxyCluster", []))
+
+        return cls(
+            uuid=_field(event, "uuid", ""),
+            info=_field(event, "info", ""),
+            tags=tags,
+            submitter=submitter,
+            reports=summary_reports,
+            galaxy_clusters=[cluster for cluster in galaxy_clusters if cluster],
+            object_names=Counter(_field(obj, "name", "") for obj in _field(event, "Object", []) if _field(obj, "name", "")),
+            attribute_types=Counter(_field(attribute, "type", "") for attribute in _field(event, "Attribute", []))
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        # JSON friendly form, e.g. for queueing in Redis
+        return {key: getattr(self, key) for key in self.__slots__ if not key.startswith("_")}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> EventSummary:
+        return cls(
+            uuid=data.get("uuid", ""),
+            info=data.get("info", ""),
+            tags=data.get("tags"),
+            submitter=data.get("submitter", "unknown"),
+            reports=[tuple(report) for report in data.get("reports", [])],
+            galaxy_clusters=data.get("galaxy_clusters"),
+            object_names=Counter(data.get("object_names", {})),
+            attribute_types=Counter(data.get("attribute_types", {}))
+        )
+
+    def tags_with_prefix(self, *prefixes: str) -> List[str]:
+        return [tag for tag in self.tags if tag.split(":", 1)[0] in prefixes]
+
+    def cached(self, key: Any, factory: Callable[[], Any]) -> Any:
+        # Values derived from the summary, computed once however many modules ask for them
+        if key not in self._rendered:
+            self._rendered[key] = factory()
+        return self._rendered[key]
+
+    def render_reports(self, template: str, separator: str, max_chars: int = 0, link: str = "", max_total: int = 0) -> str:
+        """Format every report with template ({name} and {content}) and join them, computed once per format.
+
+        Reports longer than max_chars are cut off with a pointer to link, and once the rendered reports reach
+        max_total characters the remaining ones are only counted (0 disables either limit).
+        """
+        return self.cached((template, separator, max_chars, link, max_total), lambda: self._render_reports(template, separator, max_chars, link, max_total))
+
+    def _render_reports(self, template: str, separator: str, max_chars: int, link: str, max_total: int) -> str:
+        parts: List[str] = []
+        total = 0
+        for i, (name, content) in enumerate(self.reports):
+            if max_chars and len(content) > max_chars:
+                content = f"{content[:max_chars]}\n\n[... {len(content) - max_chars} more characters, see the full report in MISP: {link}]"
+            part = template.format(name=name, content=content)
+            if max_total and parts and total + len(part) > max_total:
+                parts.append(f"[... {len(self.reports) - i} more report(s), see MISP: {link}]")
+                break
+            parts.append(part)
+            total += len(part)
+        return separator.join(parts)
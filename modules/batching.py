@@ -0,0 +1,117 @@
+"""
+Batching of reporting module calls.
+
+With reporting_batch_window set, every worker keeps a ReportBatcher per reporting module. Tickets to create
+are collected for the window and handed to the module's create_items hook together, and all updates of
+the same submission within the window become a single update_item call (one comment or note) instead of
+one per update. Creates are sent before updates, so an update can follow up on a ticket created in the
+same batch.
+"""
+from __future__ import annotations
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+from redis import Redis
+
+from modules.base import EventSummary, ExternalIdPending, ReportingModule
+
+logger = logging.getLogger('uvicorn.error')
+
+# (context, event, enhanced_text) of a single update
+Update = Tuple[str, EventSummary, Optional[str]]
+
+
+def merge_updates(updates: List[Update]) -> Update:
+    """Combine several updates of one submission into one, based on the most recent event."""
+    contexts = list(dict.fromkeys(context for context, _, _ in updates))
+    latest = updates[-1][1]
+    event = EventSummary(
+        uuid=latest.uuid,
+        info=latest.info,
+        tags=list(dict.fromkeys(tag for _, event, _ in updates for tag in event.tags)),
+        submitter=latest.submitter,
+        reports=list(dict.fromkeys(report for _, event, _ in updates for report in event.reports)),
+        galaxy_clusters=latest.galaxy_clusters,
+        object_names=latest.object_names,
+        attribute_types=latest.attribute_types
+    )
+    texts = [text for _, _, text in updates if text]
+    return ", ".join(contexts), event, "\n\n".join(texts) or None
+
+
+class ReportBatcher:
+    def __init__(self, name: str, module: ReportingModule, window: float) -> None:
+        self.name = name
+        self.module = module
+        self.window = window
+        self.loop = asyncio.get_running_loop()
+        self.redis: Optional[Redis] = None
+        self.creates: List[Tuple[str, str, EventSummary, Optional[str], asyncio.Future]] = []
+        self.updates: Dict[str, List[Tuple[Update, asyncio.Future]]] = defaultdict(list)
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def create(self, context: str, redis: Redis, token: str, event: EventSummary, enhanced_text: Optional[str] = None) -> Any:
+        future = self.loop.create_future()
+        self.creates.append((context, token, event, enhanced_text, future))
+        self._schedule(redis)
+        return await future
+
+    async def update(self, context: str, redis: Redis, token: str, event: EventSummary, enhanced_text: Optional[str] = None) -> Any:
+        future = self.loop.create_future()
+        self.updates[token].append(((context, event, enhanced_text), future))
+        self._schedule(redis)
+        return await future
+
+    def _schedule(self, redis: Redis) -> None:
+        self.redis = redis
+        if self._flush_task is None:
+            self._flush_task = self.loop.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.window)
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        creates, self.creates = self.creates, []
+        updates, self.updates = self.updates, defaultdict(list)
+        if not creates and not updates:
+            return
+
+        by_context: Dict[str, List[Tuple[str, EventSummary, Optional[str], asyncio.Future]]] = defaultdict(list)
+        for context, token, event, enhanced_text, future in creates:
+            by_context[context].append((token, event, enhanced_text, future))
+        for context, items in by_context.items():
+            try:
+                results = await self.module.call(self.module.create_items, context, self.redis, [item[:3] for item in items])
+            except Exception as e:
+                results = [e] * len(items)
+            for (*_, future), result in zip(items, results):
+                _resolve(future, result)
+
+        await asyncio.gather(*(self._send_update(token, entries) for token, entries in updates.items()))
+        if len(creates) > 1 or sum(len(entries) for entries in updates.values()) > len(updates):
+            logger.info("%s: sent %d creates and %d merged updates in one batch", self.name, len(creates), len(updates))
+
+    async def _send_update(self, token: str, entries: List[Tuple[Update, asyncio.Future]]) -> None:
+        context, event, enhanced_text = merge_updates([update for update, _ in entries])
+        try:
+            external_id = self.redis.get(f"modules:{self.name}:token:{token}")
+            if not external_id:
+                raise ExternalIdPending(self.name)
+            result = await self.module.call(self.module.update_item, context, self.redis, external_id, event, [], enhanced_text)
+        except Exception as e:
+            result = e
+        for _, future in entries:
+            _resolve(future, result)
+
+
+def _resolve(future: asyncio.Future, result: Any) -> None:
+    if future.done():
+        return
+    if isinstance(result, BaseException):
+        future.set_exception(result)
+    else:
+        future.set_result(result)
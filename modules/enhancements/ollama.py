@@ -1,6 +1,6 @@
-# modules/reporting/flowintel.py
+# modules/enhancements/ollama.py
 from __future__ import annotations
-from typing import Any, Dict, Optional, List
+from typing import Any, Dict, Optional, List, Tuple
 import httpx
 import json
 from redis import Redis
@@ -10,7 +10,12 @@ from datetime import datetime
 import asyncio
 import os
 import re
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from config.settings import modules_config # type: ignore
+from modules.base import EnhancementModule, EventSummary
+from modules.routing import BackendRouter, EnhancementSkipped
 
 logger = logging.getLogger('uvicorn.error')
 logger.setLevel(logging.DEBUG)
@@ -35,9 +40,136 @@ DEFAULT_MISP_PROMPT = '''
         "
         '''
 
-class Module:
+# Rough size of a token for prompt budgeting, close enough for English text and MISP type names
+CHARS_PER_TOKEN = 4
+DEFAULT_PROMPT_TOKEN_BUDGET = 3000
+DEFAULT_CHUNK_TOKENS = 2000
+MAX_REDUCE_ROUNDS = 3
+MIN_BATCH_ITEM_CHARS = 1000
+
+MAP_PROMPT = '''
+        Summarise the following part of an incident report in a few bullet points. Keep every indicator, victim, actor, date and technique that is mentioned.
+
+
+        --- INPUT START ---
+        {input}
+        --- INPUT END ---
+        '''
+
+
+BATCH_PROMPT = '''
+        Produce a clear, concise executive summary of each of the following incident reports received via an anonymous reporting form of a CERT. Summarise every report on its own.
+        Answer with a JSON object of the form {"summaries": [{"id": <report id>, "summary": "<summary>"}]} containing one entry per report.
+
+
+        --- INPUT START ---
+        {input}
+        --- INPUT END ---
+        '''
+
+
+def counted(counter: Counter) -> List[str]:
+    # "ip-dst ×4200" instead of the same type repeated 4200 times, most frequent first
+    return [f"{name} ×{count}" if count > 1 else name for name, count in counter.most_common()]
+
+
+def truncate(text: str, limit: int) -> str:
+    if len(text) <= limit:
+        return text
+    # Cut at the last word boundary, a prefix without whitespace is cut as is
+    words = text[:max(limit, 0)].rsplit(None, 1)
+    return (words[0] if words else "") + " …"
+
+
+def freetext(context: str, content: Any) -> Any:
+    # For freetext submissions the text itself is worth summarising, not the counts of what was extracted
+    if context == "freetext" and isinstance(content, EventSummary) and content.reports:
+        return "\n\n".join(text for _, text in content.reports)
+    return content
+
+
+def budget_join(prefix: str, items: List[str], separator: str, limit: int) -> str:
+    """Join as many items as fit in limit characters, noting how many were left out."""
+    items = [item for item in items if item]
+    if not items or limit <= len(prefix):
+        return ""
+    line = prefix
+    for i, item in enumerate(items):
+        addition = (separator if i else "") + item
+        more = f"{separator}… and {len(items) - i} more"
+        if len(line) + len(addition) + (len(more) if i < len(items) - 1 else 0) > limit:
+            return line + (more if i else truncate(item, limit - len(prefix)))
+        line += addition
+    return line
+
+
+def chunk_text(text: str, size: int) -> List[str]:
+    """Split text into chunks of at most size characters, preferring paragraph and then word boundaries."""
+    chunks: List[str] = []
+    current = ""
+    for paragraph in re.split(r"\n\s*\n", text):
+        while len(paragraph) > size:
+            cut = paragraph.rfind(" ", 0, size)
+            cut = cut if cut > 0 else size
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(paragraph[:cut])
+            paragraph = paragraph[cut:].lstrip()
+        if current and len(current) + len(paragraph) + 2 > size:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class ThinkStripper:
+    """Drops <think>...</think> segments from a streamed completion as the chunks arrive."""
+
+    OPEN = "<think>"
+    CLOSE = "</think>"
+
+    def __init__(self) -> None:
+        self.in_think = False
+        self.pending = ""
+
+    @staticmethod
+    def _partial_tag(text: str, tag: str) -> int:
+        # Length of the longest prefix of tag the text ends with, i.e. a tag split across two chunks
+        for length in range(min(len(tag) - 1, len(text)), 0, -1):
+            if text.endswith(tag[:length]):
+                return length
+        return 0
+
+    def feed(self, chunk: str) -> str:
+        text = self.pending + chunk
+        self.pending = ""
+        output = []
+        while text:
+            tag = self.CLOSE if self.in_think else self.OPEN
+            index = text.lower().find(tag)
+            if index == -1:
+                keep = self._partial_tag(text.lower(), tag)
+                if not self.in_think:
+                    output.append(text[:len(text) - keep])
+                self.pending = text[len(text) - keep:]
+                break
+            if not self.in_think:
+                output.append(text[:index])
+            text = text[index + len(tag):]
+            self.in_think = not self.in_think
+        return "".join(output)
+
+    def flush(self) -> str:
+        text, self.pending = self.pending, ""
+        return "" if self.in_think else text
+
+
+class Module(EnhancementModule):
     def __init__(self, config: Dict[str, Any]) -> None:
-        self.cfg = config or {}
+        super().__init__(config)
         self.base_url = (self.cfg.get("url") or "").rstrip("/")
         self.verify = bool(self.cfg.get("verifycert", True))
         self.headers = {
@@ -45,89 +177,236 @@ class Module:
             "Content-Type": "application/json"
         }
         self.misp_url = misp_config.get("url", "").rstrip("/")
+        self.client: Optional[httpx.Client] = None
+        self.router: Optional[BackendRouter] = None
+        self._health_task: Optional[asyncio.Task] = None
+
+    async def setup(self) -> None:
+        self._get_client()
+        if self.cfg.get("backends"):
+            self._health_task = asyncio.create_task(self._get_router(self.cfg).run_health_checks())
 
+    async def teardown(self) -> None:
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+    def _get_client(self) -> httpx.Client:
+        # Keep the connection to Ollama alive between submissions
+        if self.client is None or self.client.is_closed:
+            self.client = httpx.Client()
+        return self.client
 
     def _post_ollama_chat(self, endpoint: str, payload: Dict[str, Any], timeout: int = 120) -> Dict[str, Any]:
         url = endpoint.rstrip("/") + "/api/generate"
-        with httpx.Client(timeout=timeout) as client:
-            logger.info(f"Posting to Ollama at {url} with payload: {json.dumps(payload)}")
-            r = client.post(url, json=payload)
+        client = self._get_client()
+        logger.info(f"Posting to Ollama at {url} with payload: {json.dumps(payload)}")
+        r = client.post(url, json=payload, timeout=timeout)
+        r.raise_for_status()
+        return r.json()
+
+    def _stream_ollama_generate(self, endpoint: str, payload: Dict[str, Any], timeout: int = 120, max_chars: int = 0, time_budget: float = 0) -> str:
+        """Consume Ollama's NDJSON stream, dropping think segments as they arrive.
+
+        Stops reading (which makes Ollama stop generating) once max_chars characters of answer were
+        produced or time_budget seconds have passed, 0 disables either limit.
+        """
+        url = endpoint.rstrip("/") + "/api/generate"
+        client = self._get_client()
+        logger.info(f"Streaming from Ollama at {url} with model {payload.get('model')}")
+        stripper = ThinkStripper()
+        output = []
+        length = 0
+        started = time.monotonic()
+        with client.stream("POST", url, json={**payload, "stream": True}, timeout=timeout) as r:
             r.raise_for_status()
-            return r.json()
+            for line in r.iter_lines():
+                if not line.strip():
+                    continue
+                chunk = json.loads(line)
+                if chunk.get("error"):
+                    raise RuntimeError(f"Ollama error: {chunk['error']}")
+                # /generate streams "response", /chat streams "message"; a separate "thinking" field is ignored
+                text = chunk.get("response", "")
+                if isinstance(chunk.get("message"), dict):
+                    text = chunk["message"].get("content", "")
+                text = stripper.feed(text)
+                output.append(text)
+                length += len(text)
+                if chunk.get("done"):
+                    output.append(stripper.flush())
+                    break
+                if max_chars and length >= max_chars:
+                    logger.info("Ollama output reached %d characters, stopping early.", max_chars)
+                    break
+                if time_budget and time.monotonic() - started > time_budget:
+                    logger.warning("Ollama generation exceeded %ss, stopping early.", time_budget)
+                    break
+        message = "".join(output).strip()
+        if max_chars and len(message) > max_chars:
+            message = truncate(message, max_chars)
+        return message
         
+    def _get_router(self, cfg: Dict[str, Any]) -> BackendRouter:
+        if self.router is None:
+            self.router = BackendRouter(cfg, health_check=lambda backend: BackendRouter.check_ollama(backend, self._get_client()))
+        return self.router
+
+    def _generate(self, cfg: Dict[str, Any], prompt: str, max_tokens: Optional[int] = None, format: Optional[str] = None) -> str:
+        timeout: int = int(cfg.get("timeout", 120))
+
+        payload: Dict[str, Any] = {
+            "prompt": prompt,
+            "stream": False,
+        }
+        options: Dict[str, Any] = {}
+        if cfg.get("temperature") is not None:
+            options["temperature"] = float(cfg["temperature"])
+        max_tokens = max_tokens or cfg.get("max_tokens")
+        if max_tokens:
+            options["num_predict"] = int(max_tokens)
+        if options:
+            payload["options"] = options
+        if cfg.get("think") is not None:
+            # Ollama 0.9+ can switch reasoning off entirely for thinking models
+            payload["think"] = bool(cfg["think"])
+        if format:
+            payload["format"] = format
+
+        def generate(endpoint: str, model: str) -> str:
+            if cfg.get("stream", True):
+                return self._stream_ollama_generate(
+                    endpoint, {**payload, "model": model}, timeout,
+                    max_chars=int(cfg.get("max_chars", 0)),
+                    time_budget=float(cfg.get("time_budget", 0))
+                )
+
+            resp = self._post_ollama_chat(endpoint, {**payload, "model": model}, timeout)
+
+            # handle both /generate and /chat style responses
+            message = resp.get("response", "")
+            if isinstance(resp.get("message"), dict):
+                message = resp["message"].get("content", "")
+
+            return self._strip_think(message)
+
+        return self._get_router(cfg).call(generate)
+
     def run(self, action_type: str, context: str, content: Any, **kwargs) -> str:
         from config.settings import modules_config
 
         cfg = modules_config.get("enhancements", {}).get("ollama", {})
-
-        endpoint: str = cfg.get("url", "http://127.0.0.1:11434")
-        model: str = cfg.get("model", "qwen3:30b")
         prompt_template: str = cfg.get("prompt", DEFAULT_PROMPT)
-        timeout: int = int(cfg.get("timeout", 120))
 
         if not cfg.get("enabled", False):
             logger.error("Ollama module is disabled in config.")
             return str(content)
 
         logger.info(f"Context: {context}")
-        content = self.context_massage(context, content)
+        content = freetext(context, content)
+        budget = int(cfg.get("prompt_token_budget", DEFAULT_PROMPT_TOKEN_BUDGET)) * CHARS_PER_TOKEN
+        if isinstance(content, str) and context != "misp" and len(content) > budget:
+            # Too long for one prompt: summarise chunks in parallel, then summarise the summaries
+            content = self.map_reduce(cfg, content, budget)
+        else:
+            content = self.context_massage(context, content, budget)
         prompt = prompt_template.replace("{input}", content)
+        try:
+            return self._generate(cfg, prompt)
+        except EnhancementSkipped as e:
+            logger.warning(f"Skipping Ollama enhancement: {e}")
+            return ""
 
-        payload: Dict[str, Any] = {
-            "model": model,
-            "prompt": prompt,
-            "stream": False,
-        }
+    def run_batch(self, items: List[Tuple[str, str, Any]]) -> List[str]:
+        """Summarise several (action_type, context, content) submissions with a single completion.
 
-        resp = self._post_ollama_chat(endpoint, payload, timeout)
+        Submissions missing from the model's answer are summarised on their own.
+        """
+        from config.settings import modules_config
 
-        # handle both /generate and /chat style responses
-        message = resp.get("response", "")
-        if isinstance(resp.get("message"), dict):
-            message = resp["message"].get("content", "")
+        cfg = modules_config.get("enhancements", {}).get("ollama", {})
+        if len(items) == 1 or not cfg.get("enabled", False):
+            return [self.run(action_type, context, content) for action_type, context, content in items]
 
-        message = self._strip_think(message)
-        return message
-        
-    def context_massage(self, context:str, content:str):
-        tags = []
-        object_types = []
-        attribute_types = []
-        event_reports = []
-        galaxy_clusters = []
-        result = ""
-        # loop through each child element and compile a summary. The order matters as ollama will truncate when we reach the context size, so let's get the important things on top
-        if context == "misp":
-            result = f"Submission info: {content["info"]}\n"
-            for tag in content.get('Tag', []):
-                tags.append(tag["name"])
-            if tags:
-                result += f"Tags: {', '.join(tags)}\n"
-            for galaxy_cluster in content.get('GalaxyCluster', []):
-                galaxy_clusters.append(galaxy_cluster["value"])
-            if galaxy_clusters:
-                result += f"Clusters: {', '.join(galaxy_clusters)}\n"
-            for event_report in content.get('EventReport', []):
-                if event_report.get("name"):
-                    event_reports.append(event_report["name"])
-                if event_report.get("description"):
-                    event_reports.append(event_report["description"])
-            if event_reports:
-                result += f"Reports: {'; '.join(event_reports)}\n"
-            for obj in content.get('Object', []):
-                if obj.get("name"):
-                    object_types.append(obj["name"])
-            if object_types:
-                result += f"Objects: {', '.join(object_types)}\n"
-            for attributes in content.get('Attribute', []):
-                attribute_types.append(attributes["type"])
-            if attribute_types:
-                result += f"Attributes: {', '.join(attribute_types)}\n"
-            return result
-        elif context == "freetext":
-            return content
-        else:
-            return content
+        # Every submission gets its share of the prompt, long freetext is condensed first
+        budget = int(cfg.get("prompt_token_budget", DEFAULT_PROMPT_TOKEN_BUDGET)) * CHARS_PER_TOKEN
+        share = max(budget // len(items), MIN_BATCH_ITEM_CHARS)
+        sections = []
+        for i, (_, context, content) in enumerate(items, start=1):
+            content = freetext(context, content)
+            if isinstance(content, str) and context != "misp" and len(content) > share:
+                content = self.map_reduce(cfg, content, share)
+            else:
+                content = self.context_massage(context, content, share)
+            sections.append(f"### Report {i} ({context})\n{content.strip()}")
+
+        prompt = cfg.get("batch_prompt", BATCH_PROMPT).replace("{input}", "\n\n".join(sections))
+        max_tokens = int(cfg.get("max_tokens", 0)) * len(items) or None
+        summaries: Dict[int, str] = {}
+        try:
+            answer = self._generate({**cfg, "max_chars": 0}, prompt, max_tokens, format="json")
+            for entry in json.loads(answer).get("summaries", []):
+                if isinstance(entry, dict) and isinstance(entry.get("summary"), str):
+                    summaries[int(entry.get("id", 0))] = entry["summary"].strip()
+        except EnhancementSkipped as e:
+            logger.warning(f"Skipping Ollama enhancement of {len(items)} submissions: {e}")
+            return [""] * len(items)
+        except (ValueError, TypeError, AttributeError) as e:
+            logger.warning(f"Could not parse the batched Ollama answer, summarising one by one: {e}")
+        logger.info(f"Ollama summarised {len(summaries)} of {len(items)} batched submissions")
+
+        results = []
+        for i, (action_type, context, content) in enumerate(items, start=1):
+            summary = summaries.get(i)
+            if summary is None:
+                summary = self.run(action_type, context, content)
+            results.append(truncate(summary, int(cfg["max_chars"])) if cfg.get("max_chars") else summary)
+        return results
+
+    def map_reduce(self, cfg: Dict[str, Any], text: str, budget: int) -> str:
+        chunk_chars = int(cfg.get("chunk_token_size", DEFAULT_CHUNK_TOKENS)) * CHARS_PER_TOKEN
+        map_prompt: str = cfg.get("map_prompt", MAP_PROMPT)
+        map_tokens = int(cfg.get("map_max_tokens", 300))
+        workers = max(int(cfg.get("map_concurrency", 4)), 1)
+        rounds = 0
+        while len(text) > budget and rounds < MAX_REDUCE_ROUNDS:
+            chunks = chunk_text(text, chunk_chars)
+            logger.info(f"Summarising {len(chunks)} chunks of {len(text)} characters")
+            with ThreadPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+                summaries = list(executor.map(lambda chunk: self._generate(cfg, map_prompt.replace("{input}", chunk), map_tokens), chunks))
+            text = "\n\n".join(f"Part {i}:\n{summary}" for i, summary in enumerate(summaries, start=1))
+            rounds += 1
+        return truncate(text, budget)
+
+    def context_massage(self, context: str, content: Any, budget: int = DEFAULT_PROMPT_TOKEN_BUDGET * CHARS_PER_TOKEN) -> str:
+        if context == "misp" and not isinstance(content, EventSummary):
+            content = EventSummary.from_event(content)
+        if not isinstance(content, EventSummary):
+            return truncate(str(content), budget)
+        # Compile a summary of the event, most important first. Repeated types are counted rather than listed
+        # and every section is cut off once the prompt budget is used up, so Ollama never truncates silently.
+        sections = [
+            ("Submission info", [content.info], " "),
+            ("Tags", content.tags, ", "),
+            ("Clusters", content.galaxy_clusters, ", "),
+            ("Reports", [name for name, _ in content.reports if name], "; "),
+            ("Objects", counted(content.object_names), ", "),
+            ("Attributes", counted(content.attribute_types), ", "),
+        ]
+        lines = []
+        remaining = budget
+        for title, items, separator in sections:
+            line = budget_join(f"{title}: ", items, separator, remaining)
+            if not line:
+                continue
+            lines.append(line)
+            remaining -= len(line) + 1
+            if remaining <= 0:
+                break
+        return "\n".join(lines) + "\n"
         
     def _strip_think(self, text: str) -> str:
         return re.sub(r"<think>.*?</think>\s*", "", text, flags=re.DOTALL | re.IGNORECASE)
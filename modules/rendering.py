@@ -0,0 +1,92 @@
+"""
+Shared rendering of ticket texts for the reporting modules.
+
+Ticket templates are parsed once, when the module is imported, and filled from fields that are computed once
+per submission and cached on its EventSummary, so RTIR and Flowintel share the joined tags, the MISP link and
+the rendered reports instead of rebuilding them for every create and update. Reports longer than
+max_report_chars are cut off with a link back to the event in MISP, and once max_reports_chars characters of
+reports have been rendered the remaining ones are only counted, which keeps huge freetext submissions from
+turning into multi-megabyte ticket payloads.
+"""
+from __future__ import annotations
+import string
+from typing import Any, Dict, List, Optional, Tuple
+
+from config.settings import misp_config
+from modules.base import EventSummary
+
+DEFAULT_MAX_REPORT_CHARS = 20000
+DEFAULT_MAX_REPORTS_CHARS = 100000
+
+# Fields that don't depend on the module or the call, computed once per submission
+SHARED_FIELDS = ("info", "uuid", "submitter", "tags", "event_url")
+
+
+def render_options(cfg: Dict[str, Any]) -> Dict[str, Any]:
+    """Rendering settings of a reporting module, from its config."""
+    return {
+        "misp_url": misp_config.get("url", "").rstrip("/"),
+        "max_report_chars": int(cfg.get("max_report_chars", DEFAULT_MAX_REPORT_CHARS)),
+        "max_reports_chars": int(cfg.get("max_reports_chars", DEFAULT_MAX_REPORTS_CHARS)),
+    }
+
+
+def event_url(misp_url: str, uuid: str) -> str:
+    return f"{misp_url}/events/view/{uuid}"
+
+
+def shared_fields(event: EventSummary, misp_url: str) -> Dict[str, str]:
+    return event.cached(("fields", misp_url), lambda: {
+        "info": event.info or "Draugnet Report",
+        "uuid": event.uuid,
+        "submitter": event.submitter,
+        "tags": ", ".join(event.tags) if event.tags else "None",
+        "event_url": event_url(misp_url, event.uuid),
+    })
+
+
+def render_reports(
+    event: EventSummary,
+    template: str,
+    separator: str,
+    misp_url: str = "",
+    max_report_chars: int = DEFAULT_MAX_REPORT_CHARS,
+    max_reports_chars: int = DEFAULT_MAX_REPORTS_CHARS
+) -> str:
+    return event.render_reports(template, separator, max_report_chars, event_url(misp_url, event.uuid), max_reports_chars)
+
+
+class TicketTemplate:
+    """A ticket text with {field} placeholders, parsed once and rendered per submission.
+
+    Available fields: context, enhanced_text (wrapped in blank lines, empty if there is none), reports
+    (rendered with report_template and report_separator, "None" if there are none) and the shared
+    info, uuid, submitter, tags and event_url.
+    """
+
+    def __init__(self, template: str, report_template: str = "{name}\n\n{content}", report_separator: str = "\n\n") -> None:
+        self.parts: List[Tuple[str, Optional[str]]] = [(literal, field) for literal, field, _, _ in string.Formatter().parse(template)]
+        self.fields = {field for _, field in self.parts if field}
+        unknown = self.fields - {"context", "enhanced_text", "reports", *SHARED_FIELDS}
+        if unknown:
+            raise ValueError(f"Unknown ticket template field(s): {', '.join(sorted(unknown))}")
+        self.report_template = report_template
+        self.report_separator = report_separator
+
+    def render(
+        self,
+        event: EventSummary,
+        context: str,
+        enhanced_text: Optional[str] = None,
+        misp_url: str = "",
+        max_report_chars: int = DEFAULT_MAX_REPORT_CHARS,
+        max_reports_chars: int = DEFAULT_MAX_REPORTS_CHARS
+    ) -> str:
+        fields: Dict[str, str] = {"context": context, "enhanced_text": f"\n{enhanced_text}\n" if enhanced_text else ""}
+        if self.fields & set(SHARED_FIELDS):
+            fields.update(shared_fields(event, misp_url))
+        if "reports" in self.fields:
+            fields["reports"] = render_reports(
+                event, self.report_template, self.report_separator, misp_url, max_report_chars, max_reports_chars
+            ) or "None"
+        return "".join(literal + (fields.get(field, "") if field else "") for literal, field in self.parts)
@@ -4,121 +4,117 @@ from typing import Any, Dict, Optional, List
 import httpx
 from redis import Redis
 import logging
-from config.settings import misp_config
+from modules.base import ReportingModule, EventSummary
+from modules.rendering import TicketTemplate, render_options
 
 logger = logging.getLogger('uvicorn.error')
 logger.setLevel(logging.DEBUG)
 
-class Module:
-    def __init__(self, config: Dict[str, Any]) -> None:
-        self.cfg = config or {}
-        self.base_url = (self.cfg.get("url") or "").rstrip("/")
-        self.verify = bool(self.cfg.get("verifycert", True))
-        self.queue = self.cfg.get("queue", '')
-        self.headers = {
-            "Content-Type": "application/json",
-            #"Authorization": f"token {self.cfg.get("auth_key", '')}",
-        }
-        self.misp_url = misp_config.get("url", "").rstrip("/")
-
-    async def create_item(self, context: str, redis: Redis, token, event: str, reports: List[Dict[str, Any]], enhanced_text: Optional[str] = None) -> Dict[str, Any]:
-        submitter = "unknown"
-        tags = []
-        for tag in event.get("Tag", []):
-            if tag.get("name", "").startswith("submitter:"):
-                submitter = tag.get("name", "").split("submitter:")[-1]
-            else:
-                tags.append(tag.get("name", ""))
-        event_reports = []
-        for report in reports:
-            event_reports.append(f"{report.get('name', '')}\n-------------------------------------------------\n\n{report.get('content', '')}")
-        for report in event.get("EventReport", []):
-            event_reports.append(f"{report.get('name', '')}\n-------------------------------------------------\n\n{report.get('content', '')}")
-        
-        logger.info(f"Creating RTIR ticket for event {event.get('uuid', '')}")
-        url = f"{self.base_url}/REST/2.0/ticket?token={self.cfg.get("auth_key", '')}"
-        subject = f"[{self.cfg.get("name", "Draugnet")}] {event.get("info", "Draugnet Report")}"
-        if enhanced_text:
-            enhanced_text = f"\n{enhanced_text}\n"
-        else:
-            enhanced_text = ""
-        content = f'''A new Draugnet report has been posted. Please check the MISP instance for more details.
+REPORT_TEMPLATE = "{name}\n-------------------------------------------------\n\n{content}"
+REPORT_SEPARATOR = "\n\n=================================================\n\n "
+
+CREATE_TEMPLATE = TicketTemplate('''A new Draugnet report has been posted. Please check the MISP instance for more details.
         
         Submission type: {context}
 
         Submitted by: {submitter}
 
-        MISP Event UUID: {event.get("uuid", "")}
+        MISP Event UUID: {uuid}
         
-        MISP URL: {self.misp_url}/events/view/{event.get("uuid", "")}
+        MISP URL: {event_url}
 
-        Tags: {", ".join(tags) if tags else "None"}
+        Tags: {tags}
         {enhanced_text}
         Reports: 
 
         =================================================
-        {"\n\n=================================================\n\n ".join(event_reports) if tags else "None"}
+        {reports}
 
         =================================================
 
 
-        '''
+        ''', REPORT_TEMPLATE, REPORT_SEPARATOR)
 
-        payload: Dict[str, Any] = {'Queue': self.queue, 'Subject': subject, 'Content': content}
-    
-        async with httpx.AsyncClient(verify=self.verify, timeout=30) as client:
-            resp = await client.post(url, headers=self.headers, json=payload)
-            resp.raise_for_status()
-            data = resp.json()
-            ticketId = str(data.get("id") or data.get("TicketId") or "")
-            redis.set("modules:rtir:token:" + token, ticketId)
-            redis.set("modules:rtir:external_id:" + ticketId, token)
-            return True
-
-    async def update_item(self, context: str, redis: Redis, external_id: str, event, reports: List[Dict[str, Any]], enhanced_text: Optional[str] = None) -> Dict[str, Any]:
-        if not external_id:
-            return {"ok": False, "error": "Missing external_id"}
-        url = f"{self.base_url}/REST/2.0/ticket/{str(external_id, 'utf-8')}/comment?token={self.cfg.get("auth_key", '')}"
-        submitter = "unknown"
-        tags = []
-        for tag in event.get("Tag", []):
-            if tag.get("name", "").startswith("submitter:"):
-                submitter = tag.get("name", "").split("submitter:")[-1]
-            else:
-                tags.append(tag.get("name", ""))
-        event_reports = []
-        for report in reports:
-            event_reports.append(f"{report.get('name', '')}\n-------------------------------------------------\n\n{report.get('content', '')}")
-        for report in event.get("EventReport", []):
-            event_reports.append(f"{report.get('name', '')}\n-------------------------------------------------\n\n{report.get('content', '')}")
-        
-        content = f'''The report has been updated via Draugnet:
+UPDATE_TEMPLATE = TicketTemplate('''The report has been updated via Draugnet:
 
         Submission type: {context}
         
         Submitted by: {submitter}
 
-        MISP Event UUID: {event.get("uuid", "")}
+        MISP Event UUID: {uuid}
         
-        MISP URL: {self.misp_url}/events/view/{event.get("uuid", "")}
-
-        Tags: {", ".join(tags) if tags else "None"}
+        MISP URL: {event_url}
 
+        Tags: {tags}
+        {enhanced_text}
         Reports: 
 
         =================================================
-        {"\n\n=================================================\n\n ".join(event_reports) if tags else "None"}
+        {reports}
 
         =================================================
 
-        '''
+        ''', REPORT_TEMPLATE, REPORT_SEPARATOR)
+
+class Module(ReportingModule):
+    def __init__(self, config: Dict[str, Any]) -> None:
+        super().__init__(config)
+        self.base_url = (self.cfg.get("url") or "").rstrip("/")
+        self.verify = bool(self.cfg.get("verifycert", True))
+        self.queue = self.cfg.get("queue", '')
+        self.headers = {
+            "Content-Type": "application/json",
+            #"Authorization": f"token {self.cfg.get("auth_key", '')}",
+        }
+        self.render_options = render_options(self.cfg)
+        self.client: Optional[httpx.AsyncClient] = None
+
+    async def setup(self) -> None:
+        self._get_client()
+
+    async def teardown(self) -> None:
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # One pooled client per module instance, reused across submissions
+        if self.client is None or self.client.is_closed:
+            limits = httpx.Limits(max_connections=self.max_parallel_requests, max_keepalive_connections=self.max_parallel_requests)
+            self.client = httpx.AsyncClient(verify=self.verify, timeout=30, limits=limits)
+        return self.client
+
+    async def create_item(self, context: str, redis: Redis, token, event: EventSummary, reports: List[Dict[str, Any]], enhanced_text: Optional[str] = None) -> Dict[str, Any]:
+        logger.info(f"Creating RTIR ticket for event {event.uuid}")
+        url = f"{self.base_url}/REST/2.0/ticket?token={self.cfg.get("auth_key", '')}"
+        subject = f"[{self.cfg.get("name", "Draugnet")}] {event.info or "Draugnet Report"}"
+        content = CREATE_TEMPLATE.render(event, context, enhanced_text, **self.render_options)
+
+        payload: Dict[str, Any] = {'Queue': self.queue, 'Subject': subject, 'Content': content}
+    
+        client = self._get_client()
+        async with self.request_slot():
+            resp = await client.post(url, headers=self.headers, json=payload)
+        resp.raise_for_status()
+        data = resp.json()
+        ticketId = str(data.get("id") or data.get("TicketId") or "")
+        redis.set("modules:rtir:token:" + token, ticketId)
+        redis.set("modules:rtir:external_id:" + ticketId, token)
+        return True
+
+    async def update_item(self, context: str, redis: Redis, external_id: str, event: EventSummary, reports: List[Dict[str, Any]], enhanced_text: Optional[str] = None) -> Dict[str, Any]:
+        if not external_id:
+            return {"ok": False, "error": "Missing external_id"}
+        url = f"{self.base_url}/REST/2.0/ticket/{str(external_id, 'utf-8')}/comment?token={self.cfg.get("auth_key", '')}"
+        content = UPDATE_TEMPLATE.render(event, context, enhanced_text, **self.render_options)
         payload: Dict[str, Any] = {"Content": content, "ContentType": "text/plain"}
 
-        async with httpx.AsyncClient(verify=self.verify, timeout=30) as client:
+        client = self._get_client()
+        async with self.request_slot():
             resp = await client.post(url, headers=self.headers, json=payload)
-            resp.raise_for_status()
-            data = resp.json()
-            return {"ok": True, "external_id": external_id, "raw": data}
+        resp.raise_for_status()
+        data = resp.json()
+        return {"ok": True, "external_id": external_id, "raw": data}
 
 
 # ---- Optional function-based fallback (supported by the loader) ----
@@ -0,0 +1,169 @@
+"""
+Routing of enhancement requests over several backends.
+
+An enhancement module configured with a list of "backends" sends each request to the healthy backend with
+the fewest requests in flight (relative to its weight), preferring the one that answered fastest recently.
+Backends that can't be reached, time out or answer with a 5xx are taken out of rotation until their next
+health check succeeds, and the request is retried on the next best one. Health checks run in the background
+(run_health_checks), never on the request path. Once a backend is busy enough its smaller "fallback_model" is used instead,
+and when every backend is saturated for longer than "max_queue_wait" seconds the enhancement is skipped.
+Load is tracked per worker process.
+"""
+from __future__ import annotations
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+
+logger = logging.getLogger('uvicorn.error')
+
+# Weight of the latest call in the moving average of a backend's latency
+LATENCY_SMOOTHING = 0.3
+
+
+class EnhancementSkipped(Exception):
+    """No backend could take the request within the queueing budget."""
+
+
+class NoBackendAvailable(Exception):
+    pass
+
+
+class Backend:
+    def __init__(self, cfg: Dict[str, Any], defaults: Dict[str, Any]) -> None:
+        self.url: str = (cfg.get("url") or defaults.get("url") or "http://127.0.0.1:11434").rstrip("/")
+        self.model: str = cfg.get("model") or defaults.get("model", "qwen3:30b")
+        self.fallback_model: Optional[str] = cfg.get("fallback_model", defaults.get("fallback_model"))
+        self.max_concurrent = max(int(cfg.get("max_concurrent", defaults.get("max_concurrent", 2))), 1)
+        # Requests arriving while this many are already in flight use the fallback model
+        self.fallback_at = int(cfg.get("fallback_at", defaults.get("fallback_at", max(self.max_concurrent - 1, 1))))
+        self.weight = float(cfg.get("weight", 1.0)) or 1.0
+        self.in_flight = 0
+        self.latency: Optional[float] = None
+        self.healthy = True
+
+    def load(self) -> float:
+        return self.in_flight / self.weight
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "model": self.model,
+            "healthy": self.healthy,
+            "in_flight": self.in_flight,
+            "latency": round(self.latency, 3) if self.latency is not None else None,
+        }
+
+
+def is_backend_failure(error: Exception) -> bool:
+    """Whether an error says something about the backend (unreachable, timed out, 5xx) rather than the request."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+class BackendRouter:
+    """Pick a backend for each call and keep track of load, latency and health."""
+
+    def __init__(self, cfg: Dict[str, Any], health_check: Optional[Callable[[Backend], bool]] = None) -> None:
+        backends = cfg.get("backends") or [{}]
+        self.backends: List[Backend] = [Backend(backend, cfg) for backend in backends]
+        self.health_check_interval = float(cfg.get("health_check_interval", 30))
+        self.max_queue_wait = float(cfg.get("max_queue_wait", 30))
+        self.health_check = health_check or self.check_ollama
+        self._condition = threading.Condition()
+
+    @staticmethod
+    def check_ollama(backend: Backend, client: Optional[httpx.Client] = None) -> bool:
+        # /api/tags is cheap and also tells us whether the model has been pulled
+        r = (client or httpx).get(backend.url + "/api/tags", timeout=5)
+        r.raise_for_status()
+        models = {model.get("name") for model in r.json().get("models", [])}
+        wanted = {backend.model, f"{backend.model}:latest"}
+        return not models or bool(models & wanted)
+
+    def refresh_health(self) -> None:
+        for backend in self.backends:
+            try:
+                healthy = self.health_check(backend)
+            except Exception as e:
+                logger.warning("Enhancement backend %s failed its health check: %s", backend.url, e)
+                healthy = False
+            if healthy != backend.healthy:
+                logger.info("Enhancement backend %s is now %s", backend.url, "healthy" if healthy else "unhealthy")
+            backend.healthy = healthy
+
+    async def run_health_checks(self) -> None:
+        while True:
+            await asyncio.to_thread(self.refresh_health)
+            await asyncio.sleep(self.health_check_interval)
+
+    def _candidates(self, exclude: List[Backend]) -> List[Backend]:
+        backends = [backend for backend in self.backends if backend not in exclude]
+        healthy = [backend for backend in backends if backend.healthy]
+        # If everything looks down, try anyway rather than never enhancing again
+        return healthy or backends
+
+    def _acquire(self, exclude: List[Backend]) -> Optional[Backend]:
+        deadline = time.monotonic() + self.max_queue_wait
+        with self._condition:
+            while True:
+                candidates = self._candidates(exclude)
+                if not candidates:
+                    return None
+                free = [backend for backend in candidates if backend.in_flight < backend.max_concurrent]
+                if free:
+                    backend = min(free, key=lambda b: (b.load(), b.latency if b.latency is not None else 0.0))
+                    backend.in_flight += 1
+                    return backend
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise EnhancementSkipped(f"All enhancement backends busy for more than {self.max_queue_wait}s")
+                self._condition.wait(remaining)
+
+    def _release(self, backend: Backend, latency: Optional[float], failed: bool = False) -> None:
+        with self._condition:
+            backend.in_flight -= 1
+            if latency is not None:
+                if backend.latency is None:
+                    backend.latency = latency
+                else:
+                    backend.latency += LATENCY_SMOOTHING * (latency - backend.latency)
+            if failed:
+                # Out of rotation until the next health check says otherwise
+                backend.healthy = False
+            self._condition.notify()
+
+    def call(self, fn: Callable[[str, str], Any]) -> Any:
+        """Run fn(url, model) on the best backend, failing over to the others if the backend fails."""
+        tried: List[Backend] = []
+        last_error: Optional[Exception] = None
+        while True:
+            backend = self._acquire(tried)
+            if backend is None:
+                raise NoBackendAvailable("No enhancement backend could handle the request") from last_error
+            tried.append(backend)
+            model = backend.model
+            if backend.fallback_model and backend.in_flight > backend.fallback_at:
+                model = backend.fallback_model
+                logger.info("Enhancement backend %s is busy, using %s", backend.url, model)
+            started = time.monotonic()
+            try:
+                result = fn(backend.url, model)
+            except Exception as e:
+                if not is_backend_failure(e):
+                    # Caused by the request itself (a 4xx, unusable output), another backend wouldn't do better
+                    self._release(backend, None)
+                    raise
+                logger.warning("Enhancement backend %s failed: %s", backend.url, e)
+                self._release(backend, None, failed=True)
+                last_error = e
+                continue
+            self._release(backend, time.monotonic() - started)
+            return result
+
+    def describe(self) -> List[Dict[str, Any]]:
+        return [backend.describe() for backend in self.backends]
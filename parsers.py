@@ -0,0 +1,151 @@
+"""
+Parsing of submission bodies for the /share endpoints.
+
+Large STIX bundles, CSV files and MISP events are expensive to decode and validate, so these functions are
+written to run in the process pool (see utils.run_cpu_bound). They only depend on the standard library and
+PyMISP, and report invalid input by raising SubmissionError, which the endpoints turn into a 400.
+"""
+from __future__ import annotations
+import csv
+import importlib.util
+import io
+import json
+from typing import Any, Dict, List, Tuple
+from pymisp import MISPEvent
+
+
+class SubmissionError(ValueError):
+    """The submitted body is malformed, the message is safe to return to the client."""
+
+
+class ConversionError(Exception):
+    """The local STIX converter could not handle the bundle, callers fall back to MISP's importer."""
+
+
+def load_json(raw: bytes) -> Any:
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        raise SubmissionError("Invalid JSON in request body.")
+    if not isinstance(data, dict):
+        raise SubmissionError("Request body must be a JSON object.")
+    return data
+
+
+def parse_misp_submission(raw: bytes) -> Tuple[Dict[str, Any], MISPEvent]:
+    data = load_json(raw)
+    options = data.pop("optional", None) or {}
+    if "event" in data:
+        data = data["event"]
+    if "Event" in data:
+        data = data["Event"]
+    event = MISPEvent()
+    try:
+        event.from_dict(**data)
+    except Exception as e:
+        raise SubmissionError(f"Invalid MISP event: {e}")
+    return options, event
+
+
+def parse_csv_rows(csv_data: str) -> List[Dict[str, Any]]:
+    # Parse CSV — normalise header names to lowercase and strip surrounding whitespace
+    try:
+        reader = csv.DictReader(io.StringIO(csv_data.strip()))
+        if reader.fieldnames:
+            reader.fieldnames = [f.strip().lower() for f in reader.fieldnames]
+        rows = list(reader)
+    except Exception:
+        raise SubmissionError("Failed to parse CSV. Ensure the file is valid CSV with the required headers.")
+
+    if not rows:
+        raise SubmissionError("CSV contains no data rows.")
+
+    # Validate required fields and collect non-empty optional ones per row
+    attributes = []
+    for i, row in enumerate(rows, start=1):
+        attr_type  = (row.get("type") or "").strip()
+        attr_value = (row.get("value") or "").strip()
+        if not attr_type or not attr_value:
+            raise SubmissionError(f"Row {i} is missing required field(s): 'type' and 'value' must both be set.")
+        attr = {"type": attr_type, "value": attr_value}
+        for field in ("category", "comment", "first_seen", "last_seen"):
+            v = (row.get(field) or "").strip()
+            if v:
+                attr[field] = v
+        attributes.append(attr)
+    return attributes
+
+
+def parse_csv_submission(raw: bytes) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    body = load_json(raw)
+    options = body.get("optional") or {}
+    csv_data = body.get("csv")
+    if not csv_data:
+        raise SubmissionError("Missing 'csv' field in request body.")
+    return options, parse_csv_rows(csv_data)
+
+
+def parse_stix_submission(raw: bytes) -> Tuple[Dict[str, Any], str, str]:
+    """Returns the optional form data, the bundle as a JSON string and the event UUID derived from it."""
+    body = load_json(raw)
+    options = body.get("optional") or {}
+    stix_data = body.get("stix")
+
+    if not stix_data:
+        raise SubmissionError("Missing 'stix' field in request body.")
+
+    # Normalise: keep both a parsed dict and a JSON string for the API call
+    if isinstance(stix_data, dict):
+        stix_str = json.dumps(stix_data)
+        stix_parsed = stix_data
+    else:
+        stix_str = stix_data
+        try:
+            stix_parsed = json.loads(stix_str)
+        except Exception:
+            raise SubmissionError("Invalid STIX JSON.")
+
+    # STIX 2.x bundles carry a 'bundle--{uuid}' id that MISP uses as the event UUID
+    bundle_id = stix_parsed.get("id", "") if isinstance(stix_parsed, dict) else ""
+    if not isinstance(bundle_id, str) or not bundle_id.startswith("bundle--"):
+        raise SubmissionError("Could not determine event UUID from STIX. Only STIX 2.0/2.1 bundles are supported.")
+    return options, stix_str, bundle_id[len("bundle--"):]
+
+
+def stix_converter_available() -> bool:
+    # misp-stix is an optional dependency, only needed for the local STIX conversion path
+    return importlib.util.find_spec("misp_stix_converter") is not None
+
+
+def convert_stix_bundle(stix_str: str, event_uuid: str) -> MISPEvent:
+    """Convert a STIX 2.0/2.1 bundle into a single MISPEvent using misp-stix, the same library MISP's own
+    /events/upload_stix/2 endpoint runs server side."""
+    try:
+        from misp_stix_converter import MISP_org_uuid
+        from misp_stix_converter.tools import load_stix2_content, get_stix2_parser, is_stix2_from_misp
+    except ImportError as e:
+        raise ConversionError(f"misp-stix is not installed: {e}")
+    try:
+        bundle = load_stix2_content(stix_str)
+        parser_class, args = get_stix2_parser(
+            from_misp=is_stix2_from_misp(getattr(bundle, "objects", [])),
+            distribution=0,
+            sharing_group_id=None,
+            title=None,
+            producer=None,
+            force_contextual_data=False,
+            galaxies_as_tags=False,
+            single_event=True,
+            organisation_uuid=MISP_org_uuid,
+            cluster_distribution=0,
+            cluster_sharing_group_id=None
+        )
+        parser = parser_class()
+        parser.load_stix_bundle(bundle)
+        parser.parse_stix_bundle(**args)
+        event = parser.misp_event
+    except Exception as e:
+        raise ConversionError(f"Could not convert STIX bundle: {e}")
+    # Keep the bundle UUID as the event UUID, as MISP's importer does
+    event.uuid = event_uuid
+    return event
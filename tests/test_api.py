@@ -20,6 +20,8 @@ import os
 import uuid
 import json
 import time
+import gzip
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 import httpx
@@ -229,6 +231,18 @@ class TestShareCSV:
         assert r.status_code == 200
         assert r.json()["status"] == "ok"
 
+    def test_concurrent_updates(self, csv_token):
+        # Simultaneous updates to one token are merged, but every caller still gets its own response
+        def update(i):
+            with client() as c:
+                return c.post(f"/share/csv?token={csv_token}", json={
+                    "csv": minimal_csv([{"type": "domain", "value": f"concurrent{i}.example.com"}])
+                })
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            responses = list(executor.map(update, range(5)))
+        assert [r.status_code for r in responses] == [200] * 5
+        assert all(r.json()["token"] == csv_token for r in responses)
+
     def test_invalid_token_returns_404(self, http):
         r = http.post("/share/csv?token=nonexistent-token-xyz", json={"csv": minimal_csv()})
         assert r.status_code == 404
@@ -466,6 +480,29 @@ class TestRetrieveGET:
         r = http.get(f"/retrieve?token={csv_token}&format=xml")
         assert r.status_code == 422
 
+    def test_since_timestamp(self, http, csv_token):
+        ts = int(http.get(f"/timestamp?token={csv_token}").text.strip())
+        r = http.get(f"/retrieve?token={csv_token}&since={ts}")
+        assert r.status_code == 200
+
+    def test_since_in_future_returns_no_changes(self, http, csv_token):
+        r = http.get(f"/retrieve?token={csv_token}&since={int(time.time()) + 3600}")
+        assert r.status_code == 200
+        assert not r.json().get("response")
+
+    def test_invalid_since_returns_422(self, http, csv_token):
+        r = http.get(f"/retrieve?token={csv_token}&since=yesterday")
+        assert r.status_code == 422
+
+    def test_unchanged_event_returns_304(self, http, csv_token):
+        # ETags are only handed out once the second of the last update has passed
+        time.sleep(1.1)
+        etag = http.get(f"/retrieve?token={csv_token}").headers.get("ETag")
+        if not etag:
+            pytest.skip("ETags need the MISP webhook or ZMQ listener to be configured")
+        r = http.get(f"/retrieve?token={csv_token}", headers={"If-None-Match": etag})
+        assert r.status_code == 304
+
 
 # ---------------------------------------------------------------------------
 # POST /retrieve  (body version)
@@ -489,6 +526,10 @@ class TestRetrievePOST:
         assert r.status_code == 200
         assert r.json() is not None
 
+    def test_invalid_since_in_body(self, http, csv_token):
+        r = http.post("/retrieve", json={"token": csv_token, "since": "yesterday"})
+        assert r.status_code == 400
+
 
 # ---------------------------------------------------------------------------
 # GET /timestamp
@@ -537,6 +578,40 @@ class TestBodySizeLimit:
         assert r.status_code == 413
 
 
+# ---------------------------------------------------------------------------
+# Compression
+# ---------------------------------------------------------------------------
+
+class TestCompression:
+    def test_gzip_request_body(self, http):
+        r = http.post(
+            "/share/csv",
+            content=gzip.compress(json.dumps({"csv": minimal_csv()}).encode()),
+            headers={"Content-Type": "application/json", "Content-Encoding": "gzip"},
+        )
+        assert r.status_code == 200
+        assert r.json()["status"] == "ok"
+
+    def test_gzip_bomb_returns_413(self, http):
+        bomb = gzip.compress(b" " * (51 * 1024 * 1024))
+        r = http.post(
+            "/share/raw",
+            content=bomb,
+            headers={"Content-Type": "application/json", "Content-Encoding": "gzip"},
+        )
+        assert r.status_code == 413
+
+    def test_unsupported_encoding_returns_415(self, http):
+        r = http.post("/share/raw", content=b"x", headers={"Content-Encoding": "compress"})
+        assert r.status_code == 415
+
+    def test_gzip_response(self, http, csv_token):
+        r = http.get(f"/retrieve?token={csv_token}", headers={"Accept-Encoding": "gzip"})
+        assert r.status_code == 200
+        if len(r.content) >= 1024:
+            assert r.headers.get("content-encoding") == "gzip"
+
+
 # ---------------------------------------------------------------------------
 # Optional metadata fields  (shared across submission types)
 # ---------------------------------------------------------------------------
@@ -569,3 +644,81 @@ class TestOptionalMetadata:
         payload["optional"] = self.OPTIONAL
         r = http.post("/share/misp", json=payload)
         assert r.status_code == 200
+
+
+# ---------------------------------------------------------------------------
+# GET /sharing_groups
+# ---------------------------------------------------------------------------
+
+class TestSharingGroups:
+    def test_returns_200(self, http):
+        assert http.get("/sharing_groups").status_code == 200
+
+    def test_returns_list(self, http):
+        sharing_groups = http.get("/sharing_groups").json()
+        assert isinstance(sharing_groups, list)
+        for sg in sharing_groups:
+            assert "id" in sg
+            assert "name" in sg
+
+    def test_unknown_sharing_group_rejected(self, http):
+        known = {sg["id"] for sg in http.get("/sharing_groups").json()}
+        unknown_id = str(max([int(i) for i in known] + [0]) + 1000)
+        r = http.post("/share/csv", json={
+            "csv": minimal_csv(),
+            "optional": {"distribution": 4, "sharing_group_id": unknown_id},
+        })
+        assert r.status_code == 400
+
+
+# ---------------------------------------------------------------------------
+# /metrics
+# ---------------------------------------------------------------------------
+
+class TestMetrics:
+    def test_token_keyspace_report(self, http, csv_token):
+        report = http.get("/metrics").json()["token_keyspace"]
+        for name in ("tokens", "tokens_update", "module_tokens", "module_external_ids"):
+            assert report[name]["keys"] >= 0
+        assert report["tokens"]["keys"] >= 1
+        assert report["total_estimated_bytes"] >= 0
+
+
+# ---------------------------------------------------------------------------
+# /healthz and /readyz
+# ---------------------------------------------------------------------------
+
+class TestHealth:
+    def test_liveness(self, http):
+        r = http.get("/healthz")
+        assert r.status_code == 200
+        assert r.json()["status"] == "ok"
+
+    def test_readiness(self, http):
+        r = http.get("/readyz")
+        assert r.status_code == 200
+        body = r.json()
+        assert body["status"] == "ready"
+        assert body["checks"]["redis"]["ok"] and body["checks"]["misp"]["ok"]
+
+
+# ---------------------------------------------------------------------------
+# Idempotency-Key
+# ---------------------------------------------------------------------------
+
+class TestIdempotency:
+    def test_retry_returns_original_token(self, http):
+        headers = {"Idempotency-Key": str(uuid.uuid4())}
+        body = {"csv": minimal_csv()}
+        first = http.post("/share/csv", json=body, headers=headers)
+        retry = http.post("/share/csv", json=body, headers=headers)
+        assert first.status_code == 200
+        assert retry.status_code == 200
+        assert retry.json()["token"] == first.json()["token"]
+        assert retry.headers.get("Idempotent-Replayed") == "true"
+
+    def test_key_reused_with_different_body_returns_422(self, http):
+        headers = {"Idempotency-Key": str(uuid.uuid4())}
+        assert http.post("/share/csv", json={"csv": minimal_csv()}, headers=headers).status_code == 200
+        r = http.post("/share/csv", json={"csv": minimal_csv([{"type": "domain", "value": "other.example"}])}, headers=headers)
+        assert r.status_code == 422
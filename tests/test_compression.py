@@ -0,0 +1,51 @@
+"""
+Tests for the Accept-Encoding negotiation of the compression middleware.
+
+These run without a Draugnet, MISP or Redis instance:
+    pytest tests/test_compression.py -v
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from compression import THREAD_MINIMUM_SIZE, CompressionMiddleware, negotiate_encoding, parse_accept_encoding, zstandard
+
+
+class TestAcceptEncoding:
+    def test_q_values(self):
+        assert parse_accept_encoding("gzip;q=0.5, zstd, br;q=0") == {"gzip": 0.5, "zstd": 1.0, "br": 0.0}
+
+    def test_refused_encoding_is_not_used(self):
+        assert negotiate_encoding("zstd;q=0, gzip") == "gzip"
+        assert negotiate_encoding("gzip;q=0") is None
+
+    def test_tokens_are_matched_exactly(self):
+        assert negotiate_encoding("xzstd, gzipped") is None
+
+    def test_client_preference_wins(self):
+        assert negotiate_encoding("gzip;q=1, zstd;q=0.5") == "gzip"
+
+    @pytest.mark.skipif(zstandard is None, reason="zstandard is not installed")
+    def test_zstd_on_a_tie(self):
+        assert negotiate_encoding("gzip, zstd") == "zstd"
+        assert negotiate_encoding("*") == "zstd"
+
+
+@pytest.mark.skipif(zstandard is None, reason="zstandard is not installed")
+class TestZstdResponse:
+    def test_large_body_round_trip(self):
+        body = "203.0.113.1,evil.example\n" * (THREAD_MINIMUM_SIZE // 10)
+        app = Starlette(routes=[Route("/", lambda request: PlainTextResponse(body))])
+        app.add_middleware(CompressionMiddleware)
+        response = TestClient(app).get("/", headers={"Accept-Encoding": "zstd"})
+        assert response.headers["Content-Encoding"] == "zstd"
+        # httpx decodes zstd itself
+        assert response.text == body
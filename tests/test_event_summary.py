@@ -0,0 +1,69 @@
+"""
+Tests for the EventSummary projection handed to the modules.
+
+These run without a Draugnet, MISP or Redis instance:
+    pytest tests/test_event_summary.py -v
+"""
+
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from pymisp import MISPEvent
+
+from modules.base import EventSummary
+
+
+def sample_event() -> MISPEvent:
+    event = MISPEvent()
+    event.info = "Phishing campaign"
+    event.add_tag("tlp:green")
+    event.add_tag("submitter:alice")
+    event.add_tag("PAP:AMBER")
+    event.add_attribute("ip-dst", "203.0.113.1")
+    event.add_attribute("ip-dst", "203.0.113.2")
+    event.add_attribute("domain", "evil.example")
+    return event
+
+
+class TestEventSummary:
+    def test_from_misp_event(self):
+        event = sample_event()
+        summary = EventSummary.from_event(event)
+        assert summary.uuid == event.uuid
+        assert summary.info == "Phishing campaign"
+        assert summary.submitter == "alice"
+        assert summary.tags == ["tlp:green", "PAP:AMBER"]
+        assert summary.attribute_types == {"ip-dst": 2, "domain": 1}
+
+    def test_from_misp_json(self):
+        event = sample_event()
+        summary = EventSummary.from_event({"Event": event.to_dict()})
+        assert summary.submitter == "alice"
+        assert summary.tags_with_prefix("tlp") == ["tlp:green"]
+
+    def test_new_reports_are_not_duplicated(self):
+        event = sample_event()
+        report = event.add_event_report("Raw freetext input", "Seen 203.0.113.1")
+        summary = EventSummary.from_event(event, [report, {"name": "Extra", "content": "more"}])
+        assert summary.reports == [("Raw freetext input", "Seen 203.0.113.1"), ("Extra", "more")]
+        assert summary.render_reports("{name}: {content}", "\n") == "Raw freetext input: Seen 203.0.113.1\nExtra: more"
+
+    def test_has_no_instance_dict(self):
+        assert not hasattr(EventSummary(), "__dict__")
+
+    def test_json_round_trip(self):
+        summary = EventSummary.from_event(sample_event(), [{"name": "Extra", "content": "more"}])
+        restored = EventSummary.from_dict(json.loads(json.dumps(summary.to_dict())))
+        assert restored.to_dict() == summary.to_dict()
+        assert restored.reports == [("Extra", "more")]
+        assert restored.attribute_types == {"ip-dst": 2, "domain": 1}
+
+    def test_long_reports_are_truncated(self):
+        summary = EventSummary(reports=[("A", "x" * 50), ("B", "y" * 10), ("C", "z")])
+        rendered = summary.render_reports("{name}: {content}", "\n", max_chars=20, link="https://misp/events/view/1", max_total=40)
+        assert rendered.startswith("A: " + "x" * 20 + "\n\n[... 30 more characters, see the full report in MISP: https://misp/events/view/1]")
+        assert rendered.endswith("[... 2 more report(s), see MISP: https://misp/events/view/1]")
+        assert summary.render_reports("{name}: {content}", "\n") == "A: " + "x" * 50 + "\nB: " + "y" * 10 + "\nC: z"
@@ -0,0 +1,85 @@
+"""
+Tests for the local freetext indicator extractor.
+
+These run without a Draugnet, MISP or Redis instance:
+    pytest tests/test_extractor.py -v
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from extractor import extract_indicators, refang
+
+
+def values(text: str, attr_type: str) -> list[str]:
+    return [i["value"] for i in extract_indicators(text) if i["type"] == attr_type]
+
+
+class TestRefang:
+    def test_brackets(self):
+        assert refang("evil[.]example[.]com") == "evil.example.com"
+
+    def test_hxxp(self):
+        assert refang("hxxps[:]//evil[.]com/x") == "https://evil.com/x"
+
+    def test_at(self):
+        assert refang("bad[at]evil(.)com") == "bad@evil.com"
+
+
+class TestExtraction:
+    def test_ipv4(self):
+        assert values("C2 at 203.0.113.5, nothing else.", "ip-dst") == ["203.0.113.5"]
+
+    def test_version_numbers_are_not_ips(self):
+        assert values("Upgrade to 1.2.3.4.5 now", "ip-dst") == []
+
+    def test_ipv6(self):
+        assert values("Seen from 2001:db8::1 at 12:30:45", "ip-dst") == ["2001:db8::1"]
+
+    def test_url_is_not_also_a_hostname(self):
+        indicators = extract_indicators("Download from hxxp://cdn.evil[.]com/a.exe.")
+        assert indicators[0]["type"] == "url"
+        assert indicators[0]["value"] == "http://cdn.evil.com/a.exe"
+        assert len(indicators) == 1
+
+    def test_domain_and_hostname(self):
+        text = "Resolves example.org and mail.example.org"
+        assert values(text, "domain") == ["example.org"]
+        assert values(text, "hostname") == ["mail.example.org"]
+
+    def test_multi_label_public_suffixes(self):
+        text = "Seen on example.co.uk, mail.example.co.uk and www.ck, but co.uk alone is not a domain"
+        assert values(text, "domain") == ["example.co.uk", "www.ck"]
+        assert values(text, "hostname") == ["mail.example.co.uk"]
+
+    def test_file_names_are_not_domains(self):
+        assert extract_indicators("Opened invoice.pdf which dropped payload.exe") == []
+
+    def test_unknown_tlds_are_not_domains(self):
+        text = "See readme.md and config.json, call obj.method() and ask Mr.Smith"
+        assert values(text, "domain") == []
+        assert values(text, "hostname") == []
+
+    def test_colons_alone_are_not_ipv6(self):
+        assert values("Namespaces like std::vector or a :: separator", "ip-dst") == []
+
+    def test_email(self):
+        assert values("Sent by Bad.Actor@evil[.]com", "email") == ["bad.actor@evil.com"]
+
+    def test_hashes(self):
+        text = (
+            "d41d8cd98f00b204e9800998ecf8427e "
+            "da39a3ee5e6b4b0d3255bfef95601890afd80709 "
+            "E3B0C44298FC1C149AFBF4C8996FB92427AE41E4649B934CA495991B7852B855"
+        )
+        types = [i["type"] for i in extract_indicators(text)]
+        assert types == ["md5", "sha1", "sha256"]
+
+    def test_cve(self):
+        indicators = extract_indicators("Exploits cve-2021-44228")
+        assert indicators == [{"type": "vulnerability", "value": "CVE-2021-44228", "category": "External analysis", "to_ids": False}]
+
+    def test_deduplicated_in_order(self):
+        assert values("198.51.100.1 then 198.51.100.2 then 198.51.100.1", "ip-dst") == ["198.51.100.1", "198.51.100.2"]
@@ -0,0 +1,36 @@
+"""
+Tests for the ticket texts rendered for the reporting modules.
+
+These run without a Draugnet, MISP or Redis instance:
+    pytest tests/test_rendering.py -v
+"""
+
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import utils
+from modules.base import EventSummary
+from modules.reporting.rtir import CREATE_TEMPLATE
+
+
+def summary() -> EventSummary:
+    return EventSummary(uuid="u1", info="Phishing", tags=["tlp:green"], submitter="alice", reports=[("Raw freetext input", "Seen 203.0.113.1")])
+
+
+class TestTicketTemplate:
+    def test_create_without_enhancement_modules(self, monkeypatch):
+        monkeypatch.setattr(utils, "enabled_enhancement_modules", lambda: [])
+        event = summary()
+        enhanced_text = asyncio.run(utils.modules_enhance("create", "freetext", event, token="t1"))
+        assert enhanced_text is None
+        text = CREATE_TEMPLATE.render(event, "freetext", enhanced_text, misp_url="https://misp")
+        assert "EventSummary" not in text
+        assert "MISP URL: https://misp/events/view/u1" in text
+        assert "Seen 203.0.113.1" in text
+
+    def test_enhanced_text_is_included(self):
+        text = CREATE_TEMPLATE.render(summary(), "freetext", "Likely phishing infrastructure.")
+        assert "\nLikely phishing infrastructure.\n" in text
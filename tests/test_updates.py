@@ -0,0 +1,127 @@
+"""
+Tests for applying token updates to MISP.
+
+These run without a Draugnet, MISP or Redis instance, MISP is replaced by a recorder:
+    pytest tests/test_updates.py -v
+"""
+
+import copy
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import pytest
+
+from fastapi import HTTPException
+from pymisp import MISPEvent, MISPEventReport
+
+import updates
+from updates import apply_delta, new_delta
+
+# events/restSearch with metadata: 1, as returned by MISP 2.5
+EVENT_METADATA = {
+    "Event": {
+        "id": "12",
+        "uuid": "5e1d6e84-2c5a-4a8e-9a5f-3c2b1d0e9f10",
+        "info": "Draugnet report: phishing",
+        "date": "2024-05-02",
+        "threat_level_id": "1",
+        "analysis": "2",
+        "published": True,
+        "distribution": "1",
+        "sharing_group_id": "0",
+        "timestamp": "1714650000",
+        "Tag": [{"name": "tlp:green"}, {"name": "submitter:alice"}],
+    }
+}
+
+
+class RecordingMISP:
+    """Answers like PyMISP for the calls apply_delta makes, and records them."""
+
+    def __init__(self, attributes=None):
+        self.attributes = list(attributes or [])
+        self.calls = []
+
+    def search(self, controller="events", **kwargs):
+        self.calls.append(("search", controller, kwargs))
+        if controller == "events":
+            event = MISPEvent()
+            event.load(copy.deepcopy(EVENT_METADATA))
+            return [event]
+        values = set(kwargs.get("value") or [])
+        return {"Attribute": [a for a in self.attributes if not values or a["value"] in values]}
+
+    def add_attribute(self, event_uuid, attributes):
+        self.calls.append(("add_attribute", event_uuid, attributes))
+        new = [a for a in attributes if (a.type, a.value) not in {(e["type"], e["value"]) for e in self.attributes}]
+        if not new:
+            # MISP refuses a bulk add in which every attribute already exists
+            return {"errors": (403, {"saved": False, "message": "Could not add Attributes"})}
+        self.attributes.extend({"type": a.type, "value": a.value} for a in new)
+        return {"attributes": new}
+
+    def get_event_reports(self, event_id, pythonify=False):
+        self.calls.append(("get_event_reports", event_id))
+        reports = []
+        for name, deleted in (("Raw freetext input", False), ("Withdrawn", True)):
+            report = MISPEventReport()
+            report.from_dict(name=name, content=f"{name} content", deleted=deleted)
+            reports.append(report)
+        return reports
+
+    def update_event(self, event, event_id=None, metadata=False):
+        self.calls.append(("update_event", event_id, event.to_dict()))
+        return {"Event": event.to_dict()}
+
+
+@pytest.fixture
+def misp(monkeypatch):
+    recorder = RecordingMISP([{"type": "ip-dst", "value": "203.0.113.1"}])
+    monkeypatch.setattr(updates, "get_misp", lambda: recorder)
+    return recorder
+
+
+def added(misp):
+    return [[(a.type, a.value) for a in call[2]] for call in misp.calls if call[0] == "add_attribute"]
+
+
+class TestApplyDelta:
+    def test_only_new_attributes_are_sent(self, misp):
+        delta = new_delta("csv", attributes=[
+            {"type": "ip-dst", "value": "203.0.113.1"},
+            {"type": "domain", "value": "evil.example"},
+            {"type": "domain", "value": "evil.example"},
+        ])
+        apply_delta("event-uuid", delta, fetch_summary=False)
+        assert added(misp) == [[("domain", "evil.example")]]
+
+    def test_resubmitting_the_same_indicators_succeeds(self, misp):
+        delta = new_delta("csv", attributes=[{"type": "domain", "value": "evil.example"}])
+        apply_delta("event-uuid", delta, fetch_summary=False)
+        apply_delta("event-uuid", delta, fetch_summary=False)
+        assert added(misp) == [[("domain", "evil.example")]]
+
+    def test_metadata_edit_keeps_the_other_fields(self, misp):
+        apply_delta("event-uuid", new_delta("csv", options={"title": "renamed"}), fetch_summary=False)
+        sent = [call[2] for call in misp.calls if call[0] == "update_event"][0]
+        assert sent["info"] == "Draugnet report: renamed"
+        assert sent["date"] == "2024-05-02"
+        assert (str(sent["threat_level_id"]), str(sent["analysis"]), sent["published"]) == ("1", "2", True)
+        assert "Tag" not in sent and "timestamp" not in sent
+
+    def test_unavailable_misp_is_reported(self, monkeypatch):
+        monkeypatch.setattr(updates, "get_misp", lambda: None)
+        with pytest.raises(HTTPException) as e:
+            apply_delta("event-uuid", new_delta("csv"), fetch_summary=False)
+        assert e.value.status_code == 503
+
+    def test_summary_comes_from_metadata_and_reports(self, misp):
+        delta = new_delta("csv", attributes=[{"type": "domain", "value": "evil.example"}])
+        summary = apply_delta("event-uuid", delta)
+        assert summary.info == "Draugnet report: phishing"
+        assert (summary.tags, summary.submitter) == (["tlp:green"], "alice")
+        assert summary.reports == [("Raw freetext input", "Raw freetext input content")]
+        assert dict(summary.attribute_types) == {"domain": 1}
+        assert [call[1] for call in misp.calls if call[0] == "get_event_reports"] == [12]
@@ -0,0 +1,314 @@
+"""
+Coalescing of concurrent updates to the same token.
+
+Updates submitted with ?token= to /share/raw, /share/objects and /share/csv are described as a delta (the
+attributes, objects and reports to add and the optional form data to apply) and queued in Redis per token.
+Whichever request holds the token's lock waits for a short batching window, merges every queued delta into a
+single MISP update and a single reporting module update, and hands each queued request its own result.
+Only the additions are sent to MISP, through its attribute, object, event report and tag endpoints.
+The queue and lock live in Redis, so updates arriving at different workers are merged as well.
+"""
+from __future__ import annotations
+import asyncio
+import json
+import logging
+import secrets
+import time
+import uuid as uuid_lib
+from collections import Counter
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from fastapi import HTTPException
+from pymisp import MISPAttribute, MISPEvent, MISPObject
+
+from config.settings import draugnet_config
+from modules.base import EventSummary
+from utils import add_optional_form_data, create_report, extract_report_entities, get_misp, get_redis, modules_update, release_lock, reporting_modules_enabled, touch_token
+
+logger = logging.getLogger('uvicorn.error')
+
+POLL_INTERVAL = 0.05
+RESULT_TTL = 300
+# Event fields an edit sends along unchanged
+METADATA_FIELDS = ("info", "date", "threat_level_id", "analysis", "published", "distribution", "sharing_group_id", "disable_correlation", "extends_uuid")
+
+
+def new_delta(
+    context: str,
+    options: Optional[Dict[str, Any]] = None,
+    attributes: Optional[List[Dict[str, Any]]] = None,
+    objects: Optional[List[MISPObject]] = None,
+    reports: Optional[List[Dict[str, Any]]] = None,
+    enhanced_text: Optional[str] = None
+) -> Dict[str, Any]:
+    """Describe an update as JSON so that it can be queued and merged by another worker.
+
+    attributes are dicts of add_attribute() arguments (type, value, category, ...), reports are dicts with a
+    name, content and whether to run MISP's freetext extraction on them ("extract").
+    """
+    delta = {
+        "contexts": [context],
+        "options": options or {},
+        "attributes": attributes or [],
+        "objects": [json.loads(misp_object.to_json()) for misp_object in objects or []],
+        "reports": [dict(report, uuid=report.get("uuid") or str(uuid_lib.uuid4())) for report in reports or []],
+        "enhanced_texts": [],
+    }
+    add_enhanced_text(delta, enhanced_text)
+    return delta
+
+
+def add_enhanced_text(delta: Dict[str, Any], enhanced_text: Any) -> None:
+    # Without enhancement modules modules_enhance hands back its input, only keep actual text
+    if isinstance(enhanced_text, str) and enhanced_text:
+        delta["enhanced_texts"].append(enhanced_text)
+
+
+def merge_deltas(deltas: List[Dict[str, Any]]) -> Dict[str, Any]:
+    merged = new_delta("")
+    merged["contexts"] = []
+    for delta in deltas:
+        for context in delta["contexts"]:
+            if context not in merged["contexts"]:
+                merged["contexts"].append(context)
+        # Optional form data is applied in submission order, later submissions win
+        merged["options"].update(delta["options"])
+        for key in ("attributes", "objects", "reports", "enhanced_texts"):
+            merged[key].extend(delta[key])
+    return merged
+
+
+def delta_summary(delta: Dict[str, Any]) -> EventSummary:
+    # The submitted additions on their own, e.g. for the enhancement modules
+    return EventSummary(
+        info="Draugnet update",
+        reports=[(report["name"], report["content"]) for report in delta["reports"]],
+        object_names=Counter(misp_object["name"] for misp_object in delta["objects"]),
+        attribute_types=Counter(attribute["type"] for attribute in delta["attributes"])
+    )
+
+
+def _check_response(response: Any, action: str) -> None:
+    # PyMISP reports HTTP level failures as {"errors": (status, body)}. Per item validation errors from bulk
+    # calls (e.g. an attribute that already exists) come back as a dict next to what was saved and are not fatal.
+    if isinstance(response, dict) and isinstance(response.get("errors"), (list, tuple)):
+        logger.error(f"Error {action}: {json.dumps(response['errors'], default=str)}")
+        raise HTTPException(status_code=500, detail="Could not save event to MISP.")
+    if isinstance(response, dict) and response.get("errors"):
+        logger.debug(f"Skipped while {action}: {json.dumps(response['errors'], default=str)}")
+
+
+def existing_attributes(pymisp: Any, event_uuid: str, values: List[str]) -> Set[Tuple[str, str]]:
+    """The (type, value) pairs among values that the event already has."""
+    response = pymisp.search(controller="attributes", eventid=event_uuid, value=values, pythonify=False)
+    if not isinstance(response, dict) or "errors" in response:
+        # Not fatal, MISP still skips duplicates as long as one attribute in the request is new
+        logger.warning(f"Could not look up the event's attributes: {json.dumps(response, default=str)[:200]}")
+        return set()
+    return {(attribute.get("type"), attribute.get("value")) for attribute in response.get("Attribute", [])}
+
+
+def event_metadata(pymisp: Any, event_uuid: str) -> MISPEvent:
+    """The event without its attributes and objects."""
+    events = pymisp.search(controller="events", uuid=event_uuid, metadata=True, pythonify=True)
+    if not isinstance(events, list) or not events:
+        logger.error(f"Error getting event metadata: {json.dumps(events, default=str)[:200]}")
+        raise HTTPException(status_code=403, detail="Invalid MISP event or no access.")
+    return events[0]
+
+
+def update_metadata(pymisp: Any, event_uuid: str, metadata: Dict[str, Any]) -> None:
+    """Change some of the event's metadata, keeping the rest as it is in MISP."""
+    # MISP's edit endpoint may reset fields missing from the request (date, threat level, analysis, published),
+    # so the current values are sent along, without the tags and attributes
+    current = event_metadata(pymisp, event_uuid)
+    edit = MISPEvent()
+    edit.uuid = event_uuid
+    for key in METADATA_FIELDS:
+        if key in current:
+            setattr(edit, key, current[key])
+    for key, value in metadata.items():
+        setattr(edit, key, value)
+    response = pymisp.update_event(edit, event_id=event_uuid, metadata=True)
+    if isinstance(response, dict) and "errors" in response:
+        logger.error(f"Error updating event metadata: {json.dumps(response['errors'], default=str)}")
+        raise HTTPException(status_code=403, detail="Invalid MISP event or no access.")
+
+
+def updated_summary(pymisp: Any, event_uuid: str, delta: Dict[str, Any]) -> EventSummary:
+    """Summary of the event after an update, without downloading its attributes and objects."""
+    event = event_metadata(pymisp, event_uuid)
+    reports = pymisp.get_event_reports(event.id, pythonify=True)
+    if isinstance(reports, dict) and "errors" in reports:
+        logger.error(f"Error getting event reports: {json.dumps(reports['errors'], default=str)}")
+        raise HTTPException(status_code=403, detail="Invalid MISP event or no access.")
+    summary = EventSummary.from_event(event, [report for report in reports if not report.get("deleted")])
+    # What the update added, the rest of the event is in MISP
+    added = delta_summary(delta)
+    summary.object_names = added.object_names
+    summary.attribute_types = added.attribute_types
+    return summary
+
+
+def apply_delta(event_uuid: str, delta: Dict[str, Any], fetch_summary: bool = True) -> Optional[EventSummary]:
+    """Apply a (merged) delta to the event, only sending MISP what was added.
+
+    The updated event's summary is only fetched afterwards if fetch_summary is set, i.e. when a reporting module needs it.
+    """
+    pymisp = get_misp()
+    if not pymisp:
+        # Unreachable, or known to be down (circuit open)
+        raise HTTPException(status_code=503, detail="MISP is unavailable.")
+
+    # Collect the optional form data on an empty event to see what it changes
+    changes = MISPEvent()
+    if delta["options"]:
+        changes = add_optional_form_data(changes, delta["options"])
+    metadata = {key: changes[key] for key in ("info", "distribution", "sharing_group_id") if key in changes}
+    if metadata:
+        update_metadata(pymisp, event_uuid, metadata)
+    for tag in changes.tags:
+        _check_response(pymisp.tag(event_uuid, tag.name), "attaching tag")
+
+    if delta["attributes"]:
+        # De-duplicate within the batch and against the event, MISP rejects the whole request if nothing is new
+        attributes = {}
+        for attribute in delta["attributes"]:
+            attributes.setdefault((attribute["type"], attribute["value"]), attribute)
+        for key in existing_attributes(pymisp, event_uuid, [value for _, value in attributes]):
+            attributes.pop(key, None)
+        misp_attributes = []
+        for attribute in attributes.values():
+            misp_attribute = MISPAttribute()
+            misp_attribute.from_dict(**attribute)
+            misp_attributes.append(misp_attribute)
+        if misp_attributes:
+            _check_response(pymisp.add_attribute(event_uuid, misp_attributes), "adding attributes")
+
+    for object_dict in delta["objects"]:
+        misp_object = MISPObject(name=object_dict["name"], strict=False)
+        misp_object.from_dict(**object_dict)
+        _check_response(pymisp.add_object(event_uuid, misp_object), "adding object")
+
+    reports = [(report["name"], report["content"], report["uuid"]) for report in delta["reports"]]
+    reports += [(report.name, report.content, None) for report in changes.event_reports]
+    for name, content, report_uuid in reports:
+        event_report = create_report(content, event_uuid, name)
+        if report_uuid:
+            event_report.uuid = report_uuid
+        _check_response(pymisp.add_event_report(event_uuid, event_report), "adding event report")
+
+    for report in delta["reports"]:
+        if not report.get("extract"):
+            continue
+        result = extract_report_entities(pymisp, report["uuid"])
+        if isinstance(result, dict) and "errors" in result:
+            logger.error(f"Error extracting entities from report: {json.dumps(result['errors'], default=str)}")
+            raise HTTPException(status_code=500, detail="Could not extract entities from report.")
+
+    if not fetch_summary:
+        return None
+    return updated_summary(pymisp, event_uuid, delta)
+
+
+def _take_pending(redis, token: str) -> List[Dict[str, Any]]:
+    # Read and clear the queue atomically so that nothing pushed in between is lost
+    key = f"updates:{token}:pending"
+    pipe = redis.pipeline(transaction=True)
+    pipe.lrange(key, 0, -1)
+    pipe.delete(key)
+    items, _ = pipe.execute()
+    return [json.loads(item) for item in items]
+
+
+async def _apply_items(token: str, items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    delta = merge_deltas([item["delta"] for item in items])
+    # Only the reporting modules look at the updated event
+    needs_summary = reporting_modules_enabled()
+    try:
+        summary = await asyncio.to_thread(apply_delta, items[0]["event_uuid"], delta, needs_summary)
+    except HTTPException as e:
+        return {"ok": False, "status": e.status_code, "detail": e.detail}
+    except Exception:
+        logger.exception(f"Could not apply {len(items)} update(s) for a token.")
+        return {"ok": False, "status": 500, "detail": "Could not save event to MISP."}
+    touch_token(token)
+    if len(items) > 1:
+        logger.info(f"Coalesced {len(items)} updates into a single MISP update.")
+    if needs_summary:
+        modules_update(", ".join(delta["contexts"]), "modify", summary, token, delta["reports"], "\n\n".join(delta["enhanced_texts"]) or None)
+    return {"ok": True}
+
+
+async def _process_pending(token: str) -> None:
+    redis = get_redis()
+    while True:
+        items = await asyncio.to_thread(_take_pending, redis, token)
+        if not items:
+            return
+        result = await _apply_items(token, items)
+        results = [result] * len(items)
+        if not result["ok"] and result["status"] < 500 and len(items) > 1:
+            # One invalid submission (e.g. an unknown sharing group) shouldn't fail the others. These are rejected
+            # before anything is written, so the rest can safely be retried one by one
+            results = [await _apply_items(token, [item]) for item in items]
+
+        pipe = redis.pipeline(transaction=False)
+        for item, item_result in zip(items, results):
+            pipe.set(f"updates:result:{item['id']}", json.dumps(item_result), ex=RESULT_TTL)
+        await asyncio.to_thread(pipe.execute)
+
+
+def _queue_item(redis, token: str, item: Dict[str, Any], ttl: int) -> None:
+    key = f"updates:{token}:pending"
+    pipe = redis.pipeline(transaction=True)
+    pipe.rpush(key, json.dumps(item))
+    pipe.expire(key, ttl)
+    pipe.execute()
+
+
+def _poll(redis, token: str, item_id: str, lock_ttl: int) -> Tuple[Optional[Dict[str, Any]], bool]:
+    # The request's result if it is in, otherwise whether it got the token's lock
+    result_key = f"updates:result:{item_id}"
+    pipe = redis.pipeline(transaction=True)
+    pipe.get(result_key)
+    pipe.delete(result_key)
+    result, _ = pipe.execute()
+    if result:
+        return json.loads(result), False
+    return None, bool(redis.set(f"updates:{token}:lock", item_id, nx=True, ex=lock_ttl))
+
+
+async def submit_update(token: str, event_uuid: str, delta: Dict[str, Any]) -> Dict[str, Any]:
+    """Queue an update for the token's event and wait until it has been applied, possibly merged with others.
+
+    Raises HTTPException if the update failed.
+    """
+    redis = get_redis()
+    window = draugnet_config.get("update_batch_window", 0.2)
+    lock_ttl = draugnet_config.get("update_lock_ttl", 120)
+    item_id = secrets.token_hex(16)
+    item = {"id": item_id, "event_uuid": event_uuid, "delta": delta}
+    # The Redis calls are blocking, keep them off the event loop
+    await asyncio.to_thread(_queue_item, redis, token, item, lock_ttl * 2)
+
+    deadline = time.monotonic() + lock_ttl + window
+    while True:
+        # Whoever gets the lock applies everything queued so far, including updates queued by other requests
+        result, locked = await asyncio.to_thread(_poll, redis, token, item_id, lock_ttl)
+        if result:
+            if not result["ok"]:
+                raise HTTPException(status_code=result["status"], detail=result["detail"])
+            return result
+        if locked:
+            try:
+                if window:
+                    await asyncio.sleep(window)
+                await _process_pending(token)
+            finally:
+                await asyncio.to_thread(release_lock, redis, f"updates:{token}:lock", item_id)
+            continue
+        if time.monotonic() > deadline:
+            logger.error("Timed out waiting for a queued update to be applied.")
+            raise HTTPException(status_code=500, detail="Timed out waiting for the update to be saved.")
+        await asyncio.sleep(POLL_INTERVAL)
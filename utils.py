@@ -1,19 +1,27 @@
 from __future__ import annotations
-from redis import Redis
-from fastapi.responses import JSONResponse, PlainTextResponse
+from redis import Redis, ConnectionPool
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from pymisp import PyMISP, MISPEvent, MISPEventReport, MISPObject
 from fastapi import HTTPException
 from config.settings import misp_config, redis_config, draugnet_config, modules_config
+from modules.base import BaseModule, EventSummary, ExternalIdPending, ReportingModule
+from modules.batching import ReportBatcher
+from breaker import BreakerAdapter, REPLAY_KEY, get_breaker, queue_replay, replay_queue_lengths
 import secrets
 import re
 import os
 import time
 import json
+import hashlib
 import logging
 from typing import Optional
 import importlib
-from typing import Any, Dict, Optional, Callable, Awaitable, List
+from typing import Any, AsyncIterator, Dict, Optional, Callable, Awaitable, List, Tuple
 import asyncio
+import inspect
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import httpx
 
 logger = logging.getLogger('uvicorn.error')
 logger.setLevel(logging.DEBUG)
@@ -22,27 +30,212 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 OBJECTS_DIR = os.path.join(BASE_DIR, "misp-objects", "objects")
 
 _module_cache: dict[tuple[str, str], Any] = {}
+_report_batchers: Dict[str, ReportBatcher] = {}
+
+# Per-worker connection pools, opened by the application lifespan (or lazily on first use)
+_redis_pool: Optional[ConnectionPool] = None
+_http_client: Optional[httpx.AsyncClient] = None
+_misp: Optional[PyMISP] = None
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+# Warm caches, filled on startup by the application lifespan
+_template_index: Optional[List[str]] = None
+
+# Long running per-worker tasks started by the application lifespan
+_background_tasks: List[asyncio.Task] = []
+
+
+class CachedValue:
+    """In-process cache for a value produced by a blocking loader.
+
+    Fresh values are served for `ttl` seconds. For a further `stale_ttl` seconds the
+    old value keeps being served while a refresh runs in the background.
+    """
+
+    def __init__(self, loader: Callable[[], Any], ttl: int, stale_ttl: int = 0) -> None:
+        self.loader = loader
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.value: Any = None
+        self.loaded_at: float = 0.0
+        self._lock = asyncio.Lock()
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    def set(self, value: Any) -> None:
+        self.value = value
+        self.loaded_at = time.monotonic()
+
+    def age(self) -> Optional[float]:
+        if not self.loaded_at:
+            return None
+        return time.monotonic() - self.loaded_at
+
+    def peek(self) -> Any:
+        # Current value (possibly stale) without ever triggering a load, None if never loaded
+        if not self.loaded_at:
+            return None
+        if time.monotonic() - self.loaded_at > self.ttl + self.stale_ttl:
+            return None
+        return self.value
+
+    async def get(self) -> Any:
+        age = self.age()
+        if age is not None and age < self.ttl:
+            return self.value
+        if age is not None and age < self.ttl + self.stale_ttl:
+            self.refresh_in_background()
+            return self.value
+        return await self.refresh()
+
+    async def refresh(self, force: bool = False) -> Any:
+        async with self._lock:
+            age = self.age()
+            # Another coroutine may have refreshed while we were waiting for the lock
+            if not force and age is not None and age < self.ttl:
+                return self.value
+            value = await asyncio.to_thread(self.loader)
+            self.set(value)
+            return value
+
+    def refresh_in_background(self) -> None:
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._safe_refresh())
+
+    async def _safe_refresh(self, force: bool = False) -> None:
+        try:
+            await self.refresh(force)
+        except Exception as e:
+            logger.warning("Background refresh of %s failed: %s", getattr(self.loader, "__name__", "cache"), e)
+
+    async def run_refresher(self) -> None:
+        # Keep the value fresh so requests never wait on the loader
+        while True:
+            await asyncio.sleep(max(self.ttl * 0.8, 1))
+            await self._safe_refresh(force=True)
 
 def is_valid_template_name(name: str) -> bool:
     """Allow only alphanumeric characters and dashes."""
     return re.match(r'^[a-zA-Z0-9\-]+$', name) is not None
 
+def get_redis_pool() -> ConnectionPool:
+    global _redis_pool
+    if _redis_pool is None:
+        _redis_pool = ConnectionPool(
+            host=redis_config['host'],
+            port=redis_config['port'],
+            db=redis_config['db'],
+            max_connections=redis_config.get('max_connections')
+        )
+    return _redis_pool
+
 def get_redis():
     try:
-        redis = Redis(host=redis_config['host'], port=redis_config['port'], db=redis_config['db'])
+        redis = Redis(connection_pool=get_redis_pool())
         return redis
     except:
         print("Could not connect to redis.")
         return None
 
+# Compare-and-delete/expire, so a worker whose lock expired can't drop or extend the next holder's lock
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+RENEW_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("expire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+def release_lock(redis: Redis, key: str, lock_id: str) -> bool:
+    """Delete the lock at key if lock_id still holds it."""
+    return bool(redis.register_script(RELEASE_LOCK_SCRIPT)(keys=[key], args=[lock_id]))
+
+def renew_lock(redis: Redis, key: str, lock_id: str, ttl: int) -> bool:
+    """Extend the lock at key by ttl seconds if lock_id still holds it."""
+    return bool(redis.register_script(RENEW_LOCK_SCRIPT)(keys=[key], args=[lock_id, ttl]))
+
 def get_misp():
+    # PyMISP talks to MISP on instantiation, so keep one instance per worker
+    global _misp
+    # Fail fast while MISP is known to be down instead of waiting for another timeout
+    breaker = get_breaker("misp")
+    if breaker.is_open():
+        return None
+    if _misp is not None:
+        return _misp
     try:
-        pymisp = PyMISP(misp_config['url'], misp_config['key'], misp_config['verifycert'])
-        return pymisp
+        adapter = BreakerAdapter(breaker)
+        _misp = PyMISP(misp_config['url'], misp_config['key'], misp_config['verifycert'], https_adapter=adapter)
+        # PyMISP only mounts the adapter for https://, plain http MISP instances need the breaker too
+        _misp._PyMISP__session.mount("http://", adapter)
+        return _misp
     except:
         print("Could not connect to MISP.")
         return None
-    
+
+def get_http_client() -> httpx.AsyncClient:
+    # Shared async client for direct MISP calls, keeps connections alive between requests
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            verify=misp_config.get("verifycert", True),
+            timeout=draugnet_config.get("misp_timeout", 60),
+            limits=httpx.Limits(
+                max_connections=draugnet_config.get("http_max_connections", 100),
+                max_keepalive_connections=draugnet_config.get("http_max_keepalive", 20)
+            )
+        )
+    return _http_client
+
+def get_process_pool() -> Optional[ProcessPoolExecutor]:
+    # CPU-heavy work is shipped here so that it doesn't block the event loop of the worker
+    global _process_pool
+    workers = int(draugnet_config.get("process_pool_workers", 2) or 0)
+    if workers <= 0:
+        return None
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    return _process_pool
+
+async def run_cpu_bound(fn: Callable[..., Any], *args: Any, size: int = 0) -> Any:
+    # Small inputs are cheaper to handle inline than to pickle across to the process pool
+    threshold = draugnet_config.get("process_pool_threshold", 256 * 1024)
+    pool = get_process_pool() if size >= threshold else None
+    if pool is None:
+        return fn(*args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(pool, fn, *args)
+
+async def parse_submission(fn: Callable[[bytes], Any], raw: bytes) -> Any:
+    # Run one of the parsers.py functions on a request body, routed to the process pool by size
+    from parsers import SubmissionError
+    try:
+        return await run_cpu_bound(fn, raw, size=len(raw))
+    except SubmissionError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def open_pools():
+    # Called once per worker process on startup
+    get_redis_pool()
+    get_http_client()
+    get_process_pool()
+
+async def close_pools():
+    global _redis_pool, _http_client, _misp, _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+    _misp = None
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+    if _redis_pool is not None:
+        _redis_pool.disconnect()
+        _redis_pool = None
 
 
 def get_module_config(module_type: str, module_name: str) -> Dict[str, Any]:
@@ -103,10 +296,164 @@ def get_module(module_type: str, module_name: str):
     logger.error("%s does not export a 'Module' class.", package)
     return None
 
+def load_enabled_modules() -> List[Any]:
+    # Import and instantiate every enabled module up front instead of on the first submission
+    loaded = []
+    for module_type in ("reporting", "enhancements"):
+        for module_name in (modules_config.get(module_type) or {}).keys():
+            if not is_module_enabled(module_type, module_name):
+                continue
+            mod = get_module(module_type, module_name)
+            if mod:
+                loaded.append(mod)
+    return loaded
+
+async def _call_module_hook(mod: Any, hook: str):
+    fn = getattr(mod, hook, None)
+    if fn is None:
+        return
+    try:
+        result = fn()
+        if inspect.isawaitable(result):
+            await result
+    except Exception as e:
+        logger.exception("Module %s hook %s failed: %s", type(mod).__module__, hook, e)
+
+async def call_module(mod: Any, method: str, *args: Any) -> Any:
+    """Call a module method under the module's declared concurrency limit and timeout."""
+    fn = getattr(mod, method)
+    if isinstance(mod, BaseModule):
+        return await mod.call(fn, *args)
+    # Modules that don't extend the base classes get no limits, but blocking calls still leave the event loop
+    if inspect.iscoroutinefunction(fn):
+        return await fn(*args)
+    return await asyncio.to_thread(fn, *args)
+
+async def setup_modules():
+    for mod in load_enabled_modules():
+        await _call_module_hook(mod, "setup")
+
+def get_report_batcher(mod_name: str, mod: ReportingModule) -> ReportBatcher:
+    batcher = _report_batchers.get(mod_name)
+    # Batchers belong to the event loop they were created on (modules_update may run outside the app's loop)
+    if batcher is None or batcher.module is not mod or batcher.loop is not asyncio.get_running_loop():
+        batcher = ReportBatcher(mod_name, mod, float(draugnet_config.get("reporting_batch_window", 0)))
+        _report_batchers[mod_name] = batcher
+    return batcher
+
+async def teardown_modules():
+    # Send whatever is still waiting for its batch before the modules close their clients
+    for batcher in list(_report_batchers.values()):
+        if batcher.loop is asyncio.get_running_loop():
+            await batcher.flush()
+    _report_batchers.clear()
+    for mod in list(_module_cache.values()):
+        await _call_module_hook(mod, "teardown")
+    _module_cache.clear()
+
+def prefetch_misp_metadata() -> bool:
+    # Fetch rarely changing MISP metadata once so request handlers don't have to
+    pymisp = get_misp()
+    if not pymisp:
+        return False
+    sharing_groups_cache.set(load_sharing_groups())
+    return True
+
+def load_sharing_groups() -> List[Dict[str, Any]]:
+    # Only expose what a submitter needs to pick a sharing group
+    pymisp = get_misp()
+    if not pymisp:
+        raise RuntimeError("Could not connect to MISP.")
+    response = pymisp.sharing_groups()
+    if isinstance(response, dict) and "errors" in response:
+        raise RuntimeError(f"Could not fetch sharing groups: {json.dumps(response['errors'])}")
+    sharing_groups = []
+    for entry in response:
+        sharing_group = entry.get("SharingGroup", entry)
+        if not sharing_group.get("active", True):
+            continue
+        sharing_groups.append({
+            "id": str(sharing_group.get("id")),
+            "uuid": sharing_group.get("uuid"),
+            "name": sharing_group.get("name"),
+            "description": sharing_group.get("description", ""),
+            "releasability": sharing_group.get("releasability", ""),
+        })
+    return sorted(sharing_groups, key=lambda sg: (sg["name"] or "").lower())
+
+sharing_groups_cache = CachedValue(
+    load_sharing_groups,
+    ttl=draugnet_config.get("sharing_groups_ttl", 300),
+    stale_ttl=draugnet_config.get("sharing_groups_stale_ttl", 3600)
+)
+
+def get_cached_sharing_group_ids() -> Optional[set]:
+    # Sharing group IDs known to this worker, None if they have not been loaded yet
+    sharing_groups = sharing_groups_cache.peek()
+    if sharing_groups is None:
+        return None
+    return {sg["id"] for sg in sharing_groups}
+
+def get_sharing_group_ids() -> Optional[set]:
+    # Cached IDs, loaded from MISP if the cache is cold (e.g. MISP was down on startup). None if MISP can't tell.
+    known_ids = get_cached_sharing_group_ids()
+    if known_ids is not None:
+        return known_ids
+    try:
+        sharing_groups_cache.set(load_sharing_groups())
+    except Exception as e:
+        logger.warning("Could not load the sharing groups to validate a submission: %s", e)
+        return None
+    return get_cached_sharing_group_ids()
+
+def start_background_task(coro: Awaitable[Any]) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.append(task)
+    return task
+
+async def stop_background_tasks():
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+
+def get_object_template_index(refresh: bool = False) -> List[str]:
+    # List the installed MISP object templates, cached after the first directory scan
+    global _template_index
+    if _template_index is None or refresh:
+        _template_index = sorted(
+            name for name in os.listdir(OBJECTS_DIR)
+            if os.path.isdir(os.path.join(OBJECTS_DIR, name))
+               and os.path.isfile(os.path.join(OBJECTS_DIR, name, "definition.json"))
+        )
+    templates = _template_index
+    template_whitelist = get_misp_object_template_whitelist()
+    if template_whitelist:
+        templates = [t for t in templates if t in template_whitelist]
+    return templates
+
 def is_authorised():
     # Implement your authorization logic here
     return True
 
+def is_valid_webhook_secret(secret: Optional[str]) -> bool:
+    expected = draugnet_config.get("webhook_secret")
+    if not expected or not secret:
+        return False
+    return secrets.compare_digest(secret.encode("utf-8"), expected.encode("utf-8"))
+
+def get_webhook_event_uuid(payload: Dict[str, Any]) -> Optional[str]:
+    # Accept MISP's own event/attribute/object JSON as sent by a workflow webhook, or a bare {"event_uuid": ...}
+    if payload.get("event_uuid"):
+        return payload["event_uuid"]
+    for key in ("Event", "event"):
+        if isinstance(payload.get(key), dict) and payload[key].get("uuid"):
+            return payload[key]["uuid"]
+    for key in ("Attribute", "Object", "EventReport"):
+        if isinstance(payload.get(key), dict) and payload[key].get("event_uuid"):
+            return payload[key]["event_uuid"]
+    return None
+
 def generate_token():
     return secrets.token_urlsafe(32)
 
@@ -115,8 +462,13 @@ def store_token_to_uuid(token: str, uuid: str):
     redis = get_redis()
     if not redis:
         return None
-    redis.set("tokens:" + token, uuid)
-    touch_token(token)
+    # The token, its reverse index entry and its timestamp are written atomically
+    pipe = redis.pipeline(transaction=True)
+    pipe.set("tokens:" + token, uuid, ex=get_token_ttl())
+    pipe.sadd("event_tokens:" + uuid, token)
+    pipe.set("tokens_update:" + token, int(time.time()))
+    refresh_token_ttl(token, pipe)
+    pipe.execute()
     return True
 
 def token_to_uuid(token: str):
@@ -128,14 +480,69 @@ def token_to_uuid(token: str):
         return None
     return uuid.decode('utf-8')
 
+def get_token_ttl() -> Optional[int]:
+    # Seconds a token is kept after its last use, None keeps tokens forever
+    ttl = draugnet_config.get("token_ttl")
+    return int(ttl) if ttl else None
+
+def get_reporting_module_names() -> List[str]:
+    return list((modules_config.get("reporting") or {}).keys())
+
+def reporting_modules_enabled() -> bool:
+    return any(is_module_enabled("reporting", mod_name) for mod_name in get_reporting_module_names())
+
+def refresh_token_ttl(token: str, pipe=None):
+    # Slide the expiry of a token and of the module mappings that hang off it
+    ttl = get_token_ttl()
+    if not ttl:
+        return None
+    execute = pipe is None
+    if pipe is None:
+        redis = get_redis()
+        if not redis:
+            return None
+        pipe = redis.pipeline(transaction=False)
+    pipe.expire("tokens:" + token, ttl)
+    pipe.expire("tokens_update:" + token, ttl)
+    for mod_name in get_reporting_module_names():
+        pipe.expire("modules:" + mod_name + ":token:" + token, ttl)
+    if execute:
+        pipe.execute()
+    return True
+
 def touch_token(token: str):
     redis = get_redis()
     if not redis:
         return None
     timestamp = int(time.time())
-    redis.set("tokens_update:" + token, timestamp)
+    pipe = redis.pipeline(transaction=False)
+    pipe.set("tokens_update:" + token, timestamp)
+    refresh_token_ttl(token, pipe)
+    pipe.execute()
     return True
 
+def event_uuid_to_tokens(event_uuid: str) -> List[str]:
+    redis = get_redis()
+    if not redis:
+        return []
+    return sorted(token.decode('utf-8') for token in redis.smembers("event_tokens:" + event_uuid))
+
+def touch_event_tokens(event_uuid: str) -> int:
+    # Flag every token of an event as updated, e.g. after an analyst changed the event in MISP
+    redis = get_redis()
+    if not redis:
+        return 0
+    tokens = event_uuid_to_tokens(event_uuid)
+    if not tokens:
+        return 0
+    timestamp = int(time.time())
+    pipe = redis.pipeline(transaction=False)
+    for token in tokens:
+        pipe.set("tokens_update:" + token, timestamp)
+        refresh_token_ttl(token, pipe)
+    pipe.execute()
+    return len(tokens)
+
 def get_token_timestamp(token: str):
     redis = get_redis()
     if not redis:
@@ -145,6 +552,183 @@ def get_token_timestamp(token: str):
         return None
     return int(timestamp.decode('utf-8'))
 
+TOKEN_KEY_PATTERNS = {
+    "tokens": "tokens:*",
+    "tokens_update": "tokens_update:*",
+    "module_tokens": "modules:*:token:*",
+    "module_external_ids": "modules:*:external_id:*",
+    "event_tokens": "event_tokens:*",
+}
+
+def _token_key_for(name: str, key: bytes, value: Optional[bytes]) -> Optional[str]:
+    # tokens_update:<token> and modules:<name>:token:<token> carry the token in the key,
+    # modules:<name>:external_id:<id> stores it as the value
+    if name == "tokens_update":
+        return "tokens:" + key.decode("utf-8").split(":", 1)[1]
+    if name == "module_tokens":
+        return "tokens:" + key.decode("utf-8").split(":", 3)[3]
+    return "tokens:" + value.decode("utf-8") if value else None
+
+def _sweep_batch(redis, name: str, keys: List[bytes]) -> int:
+    values = redis.mget(keys) if name == "module_external_ids" else [None] * len(keys)
+    owned = [(key, _token_key_for(name, key, value)) for key, value in zip(keys, values)]
+    # Keys that vanished between SCAN and MGET have nothing left to clean up
+    owned = [(key, token_key) for key, token_key in owned if token_key]
+    pipe = redis.pipeline(transaction=False)
+    for _, token_key in owned:
+        pipe.exists(token_key)
+    orphans = [key for (key, _), exists in zip(owned, pipe.execute()) if not exists]
+    if orphans:
+        redis.delete(*orphans)
+    return len(orphans)
+
+def _sweep_event_tokens(redis, key: bytes) -> int:
+    # Drop expired tokens from an event's reverse index, Redis deletes the set once it is empty
+    tokens = list(redis.smembers(key))
+    if not tokens:
+        return 0
+    pipe = redis.pipeline(transaction=False)
+    for token in tokens:
+        pipe.exists(b"tokens:" + token)
+    expired = [token for token, exists in zip(tokens, pipe.execute()) if not exists]
+    if expired:
+        redis.srem(key, *expired)
+    return len(expired)
+
+def sweep_token_keyspace(batch_size: int = 500) -> Dict[str, int]:
+    """Remove timestamps, module mappings and event index entries left behind by expired tokens.
+
+    The reverse external_id mappings written by the reporting modules and the event_tokens sets can't be
+    found from the token alone, so they are cleaned up here rather than expired together with it.
+    """
+    redis = get_redis()
+    removed = {}
+    for name in ("tokens_update", "module_tokens", "module_external_ids"):
+        removed[name] = 0
+        keys: List[bytes] = []
+        for key in redis.scan_iter(match=TOKEN_KEY_PATTERNS[name], count=batch_size):
+            keys.append(key)
+            if len(keys) >= batch_size:
+                removed[name] += _sweep_batch(redis, name, keys)
+                keys = []
+        if keys:
+            removed[name] += _sweep_batch(redis, name, keys)
+    removed["event_tokens"] = sum(
+        _sweep_event_tokens(redis, key)
+        for key in redis.scan_iter(match=TOKEN_KEY_PATTERNS["event_tokens"], count=batch_size)
+    )
+    return removed
+
+async def run_token_sweeper():
+    # Only one worker sweeps per interval, the others find the lock taken and skip their turn
+    interval = draugnet_config.get("token_sweep_interval", 3600)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            redis = get_redis()
+            if not redis.set("token_sweeper:lock", os.getpid(), nx=True, ex=max(int(interval * 0.9), 1)):
+                continue
+            removed = await asyncio.to_thread(sweep_token_keyspace)
+            logger.info("Token sweeper removed %s", removed)
+        except Exception as e:
+            logger.warning("Token sweep failed: %s", e)
+
+def token_keyspace_report(sample_size: int = 200) -> Dict[str, Any]:
+    """Count the keys of each token related keyspace and estimate their memory use from a sample."""
+    redis = get_redis()
+    report: Dict[str, Any] = {}
+    for name, pattern in TOKEN_KEY_PATTERNS.items():
+        count = 0
+        sample: List[bytes] = []
+        for key in redis.scan_iter(match=pattern, count=1000):
+            count += 1
+            if len(sample) < sample_size:
+                sample.append(key)
+        sampled_bytes = 0
+        without_ttl = 0
+        if sample:
+            pipe = redis.pipeline(transaction=False)
+            for key in sample:
+                pipe.memory_usage(key)
+                pipe.ttl(key)
+            results = pipe.execute()
+            sampled_bytes = sum(usage or 0 for usage in results[0::2])
+            without_ttl = sum(1 for ttl in results[1::2] if ttl == -1)
+        average = sampled_bytes / len(sample) if sample else 0
+        report[name] = {
+            "keys": count,
+            "average_bytes": round(average),
+            "estimated_bytes": round(average * count),
+            "sampled_without_ttl": without_ttl,
+            "sample_size": len(sample),
+        }
+    report["total_estimated_bytes"] = sum(entry["estimated_bytes"] for entry in report.values())
+    return report
+
+token_keyspace_cache = CachedValue(
+    token_keyspace_report,
+    ttl=draugnet_config.get("token_report_ttl", 300)
+)
+
+def _probe(check: Callable[[], Any]) -> Dict[str, Any]:
+    started = time.monotonic()
+    try:
+        result = {"ok": bool(check())}
+    except Exception as e:
+        logger.warning("Readiness probe %s failed: %s", getattr(check, "__name__", "check"), e)
+        result = {"ok": False, "error": type(e).__name__}
+    result["latency"] = round(time.monotonic() - started, 3)
+    return result
+
+def _probe_misp() -> bool:
+    pymisp = get_misp()
+    if not pymisp:
+        return False
+    version = pymisp.misp_instance_version
+    return isinstance(version, dict) and "version" in version
+
+def queue_depths(redis: Redis) -> Dict[str, int]:
+    from enhancement_batch import PENDING_KEY  # local import to avoid circulars
+    depths = {"enhancements": redis.llen(PENDING_KEY)}
+    depths.update({f"replay:{name}": length for name, length in replay_queue_lengths(redis).items()})
+    return depths
+
+def check_dependencies() -> Dict[str, Any]:
+    """Probe Redis, MISP and the enabled modules once, for /readyz to serve from the cache."""
+    checks = {
+        "redis": _probe(lambda: get_redis().ping()),
+        "misp": _probe(_probe_misp),
+    }
+    # Module outages don't make the worker unready, their calls are queued and replayed
+    modules = {
+        f"{module_type}:{mod_name}": {"ok": not get_breaker(mod_name).is_open()}
+        for module_type in ("reporting", "enhancements")
+        for mod_name in (modules_config.get(module_type) or {}).keys()
+        if is_module_enabled(module_type, mod_name)
+    }
+    depths: Dict[str, int] = {}
+    if checks["redis"]["ok"]:
+        try:
+            depths = queue_depths(get_redis())
+        except Exception as e:
+            logger.warning("Could not read the queue depths: %s", e)
+    max_depth = draugnet_config.get("readiness_max_queue_depth", 0)
+    queued = sum(depths.values())
+    checks["queues"] = {"ok": not max_depth or queued <= max_depth, "queued": queued}
+    return {
+        "ready": all(check["ok"] for check in checks.values()),
+        "checks": checks,
+        "modules": modules,
+        "queues": depths,
+    }
+
+health_cache = CachedValue(
+    check_dependencies,
+    ttl=draugnet_config.get("health_check_interval", 10),
+    # A probe stuck on a hanging dependency makes the worker unready rather than serving an old result forever
+    stale_ttl=draugnet_config.get("health_check_interval", 10) * 2
+)
+
 def create_report(raw_text_str: str, event_uuid: Optional[str] = None, event_report_name: Optional[str] = "Draugnet Report submission") -> MISPEventReport:
     # Create and attach a MISP Event Report object
     event_report = MISPEventReport()
@@ -159,6 +743,18 @@ def extract_report_entities(pymisp: PyMISP, report_uuid: str):
     result = pymisp.direct_call(f"eventReports/extractAllFromReport/{report_uuid}", data="{}")
     return result
 
+def add_extracted_attributes(event: MISPEvent, indicators: List[Dict[str, Any]]) -> int:
+    # Add locally extracted indicators to the event, skipping values that are already present
+    existing = {(attribute.type, attribute.value) for attribute in event.attributes}
+    added = 0
+    for indicator in indicators:
+        if (indicator["type"], indicator["value"]) in existing:
+            continue
+        event.add_attribute(indicator["type"], indicator["value"], category=indicator["category"], to_ids=indicator["to_ids"])
+        existing.add((indicator["type"], indicator["value"]))
+        added += 1
+    return added
+
 def create_misp_event():
     # Create a basic MISP event
     event = MISPEvent()
@@ -207,6 +803,14 @@ def add_optional_form_data(event: MISPEvent, options: dict):
         if event.distribution == "4" or event.distribution == 4:
             if "sharing_group_id" not in options:
                 event.distribution = 0
+            else:
+                sharing_group_id = str(options["sharing_group_id"]).strip()
+                # Validate against the cached sharing groups, MISP is only asked if the cache is cold. If MISP
+                # can't be asked either the ID is passed on and MISP rejects unknown groups when saving.
+                known_ids = get_sharing_group_ids()
+                if not sharing_group_id.isdigit() or (known_ids is not None and sharing_group_id not in known_ids):
+                    raise HTTPException(status_code=400, detail="Invalid sharing group.")
+                event.sharing_group_id = int(sharing_group_id)
 
     if "tlp" in options.keys() and options["tlp"] in tlp_values:
         event.add_tag(options['tlp'])
@@ -241,30 +845,114 @@ def create_misp_object(pymisp: PyMISP, template: str, data: dict):
         logger.error(f"Error creating MISP object at '{current_stage}': {str(e)}")
         raise HTTPException(status_code=500, detail="Object creation failed.")
     
-async def retrieve_event_by_token(token: str, format: str = "json"):
+# Content types of the restSearch export formats we allow clients to request
+RETRIEVE_MEDIA_TYPES = {
+    "json": "application/json",
+    "stix2": "application/json",
+    "csv": "text/csv; charset=utf-8",
+    "suricata": "text/plain; charset=utf-8",
+    "text": "text/plain; charset=utf-8",
+    "stix": "text/plain; charset=utf-8",
+}
+
+def misp_change_feed_enabled() -> bool:
+    return bool(draugnet_config.get("misp_zmq_url") or draugnet_config.get("webhook_secret"))
+
+def retrieval_etag(token: str, format: str, since: Optional[int]) -> Optional[str]:
+    # tokens_update changes with every update made through Draugnet. Edits made in MISP only bump it when
+    # the ZMQ listener or the webhook is set up, without either an ETag could hide them, so none is sent.
+    if not misp_change_feed_enabled():
+        return None
+    timestamp = get_token_timestamp(token)
+    # Timestamps have a one second resolution, another update within the same second would not change the tag
+    if timestamp is None or timestamp >= int(time.time()):
+        return None
+    digest = hashlib.sha256(f"{token}:{timestamp}:{format}:{since}".encode("utf-8")).hexdigest()[:32]
+    return f'W/"{digest}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [value.strip() for value in if_none_match.split(",")]
+    # Weak comparison, compression may strip or add the W/ prefix along the way
+    return "*" in candidates or etag.removeprefix("W/") in [c.removeprefix("W/") for c in candidates]
+
+async def retrieve_event_by_token(token: str, format: str = "json", since: Optional[int] = None, if_none_match: Optional[str] = None):
     uuid = token_to_uuid(token)
     if not uuid:
         raise HTTPException(status_code=404, detail="Could not retrieve the token.")
 
-    pymisp = get_misp()
-    r = pymisp.search(
-        controller='events',
-        eventid=uuid,
-        return_format=format,
-        includeAnalystData=True,
-        published=[True, False],
-        includeServerCorrelations=False,
-        includeFeedCorrelations=False,
-        includeEventCorrelations=False,
-        includeGranularCorrelations=False
-    )
+    etag = retrieval_etag(token, format, since)
+    if etag and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
 
-    if format in ["json", "stix2"]:
-        return JSONResponse(content=r)
+    # Stream MISP's restSearch export straight through to the client instead of holding the whole
+    # (possibly huge) export in memory, as PyMISP's search() would
+    query = {
+        "returnFormat": format,
+        "eventid": uuid,
+        "includeAnalystData": True,
+        "published": [True, False],
+        "includeServerCorrelations": False,
+        "includeFeedCorrelations": False,
+        "includeEventCorrelations": False,
+        "includeGranularCorrelations": False
+    }
+    if since is not None:
+        # Delta retrieval: MISP only returns the attributes, objects and reports modified since then
+        query["timestamp"] = since
+    breaker = get_breaker("misp")
+    if not breaker.allow():
+        raise HTTPException(status_code=503, detail="MISP is unavailable.")
+    client = get_http_client()
+    request = client.build_request(
+        "POST",
+        f"{misp_config['url'].rstrip('/')}/events/restSearch",
+        json=query,
+        headers={
+            "Authorization": misp_config["key"],
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+        }
+    )
+    try:
+        response = await client.send(request, stream=True)
+    except httpx.HTTPError as e:
+        breaker.record_failure()
+        logger.error(f"Could not reach MISP for retrieval: {str(e)}")
+        raise HTTPException(status_code=500, detail="Could not retrieve the event.")
+    if response.status_code >= 500:
+        breaker.record_failure()
     else:
-        return PlainTextResponse(content=r)
-    
+        breaker.record_success()
+    if response.status_code >= 400:
+        error = await response.aread()
+        await response.aclose()
+        logger.error(f"Error retrieving event {uuid}: {response.status_code} {error[:200]}")
+        raise HTTPException(status_code=500, detail="Could not retrieve the event.")
+
+    return StreamingResponse(
+        stream_and_close(response),
+        media_type=RETRIEVE_MEDIA_TYPES.get(format, "text/plain; charset=utf-8"),
+        headers={"ETag": etag, "Cache-Control": "private, no-cache"} if etag else None
+    )
+
+async def stream_and_close(response: httpx.Response) -> AsyncIterator[bytes]:
+    # Background tasks don't run when the client disconnects mid-stream, the pooled MISP connection
+    # has to be released here
+    try:
+        async for chunk in response.aiter_bytes():
+            yield chunk
+    finally:
+        await response.aclose()
+
 def modules_update(context: str, action_type: str, event: Any, token: Optional[str], reports: List[Dict[str, Any]], enhanced_text: Optional[str] = None):
+    if not reporting_modules_enabled():
+        return None
+    # The background task only keeps the summary alive, not the (possibly huge) event.
+    # New reports end up in the summary too, so the modules get no separate list.
+    event = EventSummary.from_event(event, reports)
+    reports = []
     try:
         loop = asyncio.get_running_loop()
         return loop.create_task(modules_update_async(context, action_type, event, token, reports, enhanced_text))
@@ -278,7 +966,44 @@ async def modules_update_async(context: str, action_type: str, event: Any, token
     reporting_cfg: Dict[str, Dict[str, Any]] = (modules_config.get("reporting") or {})
 
     results: List[Dict[str, Any]] = []
+    batch = bool(draugnet_config.get("reporting_batch_window")) and bool(token)
 
+    async def report(mod_name: str, mod: Any) -> Any:
+        breaker = get_breaker(mod_name)
+        if not breaker.allow():
+            logger.warning("Reporting module %s is unavailable, queueing the update for later", mod_name)
+            queue_report_replay(mod_name, context, action_type, token, event, enhanced_text)
+            return None
+        try:
+            result = await send_report(mod_name, mod)
+            breaker.record_success()
+            return result
+        except ExternalIdPending:
+            # E.g. a batched enhancement finishing before the ticket was created, not a failure of the system
+            logger.info("No %s record for the submission yet, queueing the update for later", mod_name)
+            queue_report_replay(mod_name, context, action_type, token, event, enhanced_text)
+            return None
+        except Exception as e:
+            breaker.record_failure()
+            logger.exception("Reporting module %s failed", mod_name)
+            queue_report_replay(mod_name, context, action_type, token, event, enhanced_text)
+            return None
+
+    async def send_report(mod_name: str, mod: Any) -> Any:
+        if batch and isinstance(mod, ReportingModule):
+            # Reports are part of the summary (see modules_update), the batcher only passes on the event
+            batcher = get_report_batcher(mod_name, mod)
+            if action_type == "modify":
+                return await batcher.update(context, redis, token, EventSummary.from_event(event), enhanced_text)
+            return await batcher.create(context, redis, token, EventSummary.from_event(event), enhanced_text)
+        if action_type == "modify" and token:
+            external_id = redis.get("modules:" + mod_name + ":token:" + token)
+            if not external_id:
+                raise ExternalIdPending(mod_name)
+            return await call_module(mod, "update_item", context, redis, external_id, event, reports, enhanced_text)
+        return await call_module(mod, "create_item", context, redis, token, event, reports, enhanced_text)
+
+    modules = []
     for mod_name in reporting_cfg.keys():
         logger.debug(f"Processing module: {mod_name}")
         if not is_module_enabled("reporting", mod_name):
@@ -288,28 +1013,27 @@ async def modules_update_async(context: str, action_type: str, event: Any, token
         if not mod:
             results.append({mod_name: {"ok": False, "error": "module load failed"}})
             continue
+        modules.append((mod_name, mod))
 
-        if action_type == "modify" and token:
-            external_id = redis.get("modules:" + mod_name + ":token:" + token)
-            mod_result = await mod.update_item(context, redis, external_id, event, reports, enhanced_text)
-        else:
-            mod_result = await mod.create_item(context, redis, token, event, reports, enhanced_text)
-
+    # The modules talk to different systems, so they don't have to wait for each other
+    outcomes = await asyncio.gather(*(report(mod_name, mod) for mod_name, mod in modules))
+    for (mod_name, _), mod_result in zip(modules, outcomes):
         if mod_result:
             results.append({mod_name: {"ok": True}})
         else:
             results.append({mod_name: {"ok": False, "error": "module save failed"}})
 
+    if token:
+        # Newly created module mappings should expire together with the token
+        refresh_token_ttl(token)
     return results
 
 
-def modules_enhance(action_type: str, context: str, data: Any) -> List[Dict[str, Any]]:
+def enabled_enhancement_modules() -> List[Tuple[str, Any]]:
     from config.settings import modules_config  # local import to avoid circulars
 
-    _ = get_redis()  # reserved for future use; no interpretation here
     enh_cfg: Dict[str, Dict[str, Any]] = (modules_config.get("enhancements") or {})
-    results: List[Dict[str, Any]] = []
-
+    modules: List[Tuple[str, Any]] = []
     for mod_name in enh_cfg.keys():
         logger.info("Processing enhancement module: %s", mod_name)
         if not is_module_enabled("enhancements", mod_name):
@@ -320,14 +1044,150 @@ def modules_enhance(action_type: str, context: str, data: Any) -> List[Dict[str,
             logger.error("{mod_name}: module load failed")
             continue
 
-        run_fn = getattr(mod, "run", None)
-        if run_fn is None:
+        if getattr(mod, "run", None) is None:
             logger.error("{mod_name}: module has no run()")
             continue
+        modules.append((mod_name, mod))
+    return modules
+
+
+async def modules_enhance(action_type: str, context: str, data: Any, token: Optional[str] = None) -> Optional[str]:
+    """Run the enhancement modules over data, returning the enhanced text (None if no module produced any)."""
+    from enhancement_batch import batching_enabled, queue_enhancement  # local import to avoid circulars
+
+    modules = enabled_enhancement_modules()
+    if modules and token and batching_enabled():
+        # The text is added to the submission's tickets once its batch has been enhanced
+        queue_enhancement(action_type, context, data, token)
+        return None
 
+    enhanced = None
+    for mod_name, mod in modules:
+        breaker = get_breaker(mod_name)
+        if not breaker.allow():
+            logger.warning("Enhancement module %s is unavailable, skipping it", mod_name)
+            queue_enhancement_replay(mod_name, action_type, context, data, token)
+            continue
         try:
-            data = run_fn(action_type, context, data)
+            method = "run_async" if hasattr(mod, "run_async") else "run"
+            output = await call_module(mod, method, action_type, context, data)
+            breaker.record_success()
         except Exception as e:
+            breaker.record_failure()
             logger.exception("Enhancement module %s failed", mod_name)
+            queue_enhancement_replay(mod_name, action_type, context, data, token)
+            continue
+        # Each module works on the output of the previous one, but only text is ever handed to the tickets
+        data = output
+        if isinstance(output, str) and output:
+            enhanced = output
+    return enhanced
+
+
+def queue_report_replay(mod_name: str, context: str, action_type: str, token: Optional[str], event: Any, enhanced_text: Optional[str]) -> None:
+    if not token:
+        return
+    try:
+        queue_replay(get_redis(), mod_name, {
+            "kind": "report",
+            "context": context,
+            "action_type": action_type,
+            "token": token,
+            "summary": EventSummary.from_event(event).to_dict(),
+            "enhanced_text": enhanced_text,
+        })
+    except Exception as e:
+        logger.error("Could not queue the %s update for replay: %s", mod_name, e)
+
+def queue_enhancement_replay(mod_name: str, action_type: str, context: str, data: Any, token: Optional[str]) -> None:
+    from enhancement_batch import enhancement_item  # local import to avoid circulars
+
+    if not token:
+        return
+    try:
+        queue_replay(get_redis(), mod_name, dict(enhancement_item(action_type, context, data, token), kind="enhance"))
+    except Exception as e:
+        logger.error("Could not queue the %s enhancement for replay: %s", mod_name, e)
+
+async def replay_item(mod_name: str, item: Dict[str, Any]) -> None:
+    """Redo a queued module call, raising if it fails again."""
+    from enhancement_batch import item_data  # local import to avoid circulars
+
+    redis = get_redis()
+    if item["kind"] == "enhance":
+        mod = get_module("enhancements", mod_name)
+        if not mod:
+            return
+        data = item_data(item)
+        text = await call_module(mod, "run_async" if hasattr(mod, "run_async") else "run", item["action_type"], item["context"], data)
+        if isinstance(text, str) and text:
+            summary = data if isinstance(data, EventSummary) else EventSummary(info=f"Draugnet {item['context']} submission")
+            modules_update(item["context"], "modify", summary, item["token"], [], text)
+        return
 
-    return data
+    mod = get_module("reporting", mod_name)
+    if not mod:
+        return
+    event = EventSummary.from_dict(item["summary"])
+    if item["action_type"] == "modify":
+        external_id = redis.get("modules:" + mod_name + ":token:" + item["token"])
+        if not external_id:
+            raise ExternalIdPending(mod_name)
+        await call_module(mod, "update_item", item["context"], redis, external_id, event, [], item["enhanced_text"])
+    else:
+        await call_module(mod, "create_item", item["context"], redis, item["token"], event, [], item["enhanced_text"])
+
+async def replay_queue(mod_name: str, limit: int = 100) -> int:
+    # Drain the queue while the system keeps answering, put the item back and stop at the first failure
+    redis = get_redis()
+    key = REPLAY_KEY.format(name=mod_name)
+    breaker = get_breaker(mod_name)
+    max_attempts = draugnet_config.get("replay_max_attempts", 5)
+    replayed = 0
+    while replayed < limit:
+        raw = redis.lpop(key)
+        if raw is None:
+            break
+        if not breaker.allow():
+            redis.lpush(key, raw)
+            break
+        item = json.loads(raw)
+        try:
+            await replay_item(mod_name, item)
+        except ExternalIdPending as e:
+            # The record is still being created, retry on the next pass behind the other queued calls
+            item["attempts"] = item.get("attempts", 0) + 1
+            if item["attempts"] < max_attempts:
+                redis.rpush(key, json.dumps(item))
+            else:
+                logger.error("Dropping a queued %s update: %s", mod_name, e)
+            break
+        except Exception as e:
+            breaker.record_failure()
+            item["attempts"] = item.get("attempts", 0) + 1
+            if item["attempts"] < max_attempts:
+                redis.lpush(key, json.dumps(item))
+            else:
+                logger.error("Dropping a queued %s call after %d attempts: %s", mod_name, item["attempts"], e)
+            break
+        breaker.record_success()
+        replayed += 1
+    return replayed
+
+async def run_replayer():
+    # One worker replays per interval, like the token sweeper
+    interval = draugnet_config.get("replay_interval", 30)
+    prefix = REPLAY_KEY.format(name="")
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            redis = get_redis()
+            if not redis.set("replay:lock", os.getpid(), nx=True, ex=max(int(interval * 0.9), 1)):
+                continue
+            for key in redis.scan_iter(match=prefix + "*", count=100):
+                mod_name = key.decode("utf-8")[len(prefix):]
+                replayed = await replay_queue(mod_name)
+                if replayed:
+                    logger.info("Replayed %d queued %s call(s)", replayed, mod_name)
+        except Exception as e:
+            logger.warning("Replaying queued module calls failed: %s", e)